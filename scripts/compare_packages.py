@@ -4,26 +4,27 @@ import argparse
 import os
 import glob
 import subprocess
+import sys
 from datetime import datetime
 
-def list_rpms(directory):
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'rpmwatcher'))
+import rpmheaders  # noqa: E402
+
+
+def list_rpms(directory, header_cache=None):
     rpms = OrderedDict()
     for filepath in sorted(glob.glob(os.path.join(directory, '*.rpm'))):
-        info = subprocess.check_output(['rpm', '-qp', filepath, '--qf',
-                                        "%{name},,%{license},,%{vendor},,%{buildhost},,"
-                                        "%{buildtime},,%{evr},,%{sourcerpm},,%{summary}"])
-        info = info.decode('utf-8')
-        info = info.split(',,')
-        rpms[info[0]] = {
+        header = rpmheaders.get_header(filepath, header_cache)
+        rpms[header.name] = {
             'filepath': filepath,
             'filename': os.path.basename(filepath),
-            'license': info[1],
-            'vendor': info[2],
-            'buildhost': info[3],
-            'buildtime': datetime.fromtimestamp(float(info[4])),
-            'evr': info[5],
-            'sourcerpm': info[6],
-            'summary': info[7]
+            'license': rpmheaders.format_value(header.license),
+            'vendor': rpmheaders.format_value(header.vendor),
+            'buildhost': rpmheaders.format_value(header.buildhost),
+            'buildtime': datetime.fromtimestamp(header.buildtime),
+            'evr': header.evr,
+            'sourcerpm': rpmheaders.format_value(header.sourcerpm),
+            'summary': header.summary
         }
     return rpms
 
@@ -31,6 +32,7 @@ def main():
     parser = argparse.ArgumentParser(description='Compares two sets of RPM packages')
     parser.add_argument('dir1', help='first directory')
     parser.add_argument('dir2', help='second directory')
+    parser.add_argument('--header-cache', help='path to a SQLite file used to cache RPM headers between runs')
     args = parser.parse_args()
 
     DEVNULL = open(os.devnull, 'w')
@@ -39,8 +41,12 @@ def main():
     dir2 = os.path.abspath(args.dir2)
 
     # list RPMs
-    rpms1 = list_rpms(dir1)
-    rpms2 = list_rpms(dir2)
+    header_cache = rpmheaders.HeaderCache(args.header_cache) if args.header_cache else None
+    rpms1 = list_rpms(dir1, header_cache)
+    rpms2 = list_rpms(dir2, header_cache)
+    if header_cache is not None:
+        header_cache.close()
+        print(header_cache.stats(), file=sys.stderr)
 
     for name, info in rpms1.items():
         if name not in rpms2:
@@ -7,6 +7,10 @@ import subprocess
 import csv
 import shutil
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'rpmwatcher'))
+import rpmheaders  # noqa: E402
+
+
 def build_url(path):
     if path.startswith('7/'):
         return "http://mirror.centos.org/centos/" + path
@@ -57,8 +61,6 @@ def main():
     parser.add_argument('--local-epel', help='path to a local directory containing all the EPEL RPMs')
     args = parser.parse_args()
 
-    DEVNULL = open(os.devnull, 'w')
-
     rpmdir = os.path.abspath(args.rpmdir)
     srpmdir = os.path.abspath(args.srpmdir)
     downloaddir = os.path.abspath(args.downloaddir)
@@ -83,7 +85,7 @@ def main():
     for filepath in sorted(glob.glob(os.path.join(srpmdir, '*.src.rpm'))):
         filename = os.path.basename(filepath)
 
-        vendor = subprocess.check_output(['rpm', '-qp', filepath, '--qf', '%{vendor}'], stderr=DEVNULL).decode('utf-8')
+        vendor = rpmheaders.format_value(rpmheaders.read_header(filepath).vendor)
         if vendor not in ("CentOS", "Fedora Project"):
             print("Skipping %s due to unknown vendor %s" % (filename, vendor))
             continue
@@ -4,10 +4,15 @@ import argparse
 import glob
 import os
 import subprocess
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'rpmwatcher'))
+import rpmheaders  # noqa: E402
 
 
 def get_srpm_info(srpmpath):
-    return subprocess.check_output(['rpm', '-qp', srpmpath, '--qf', '%{name};;%{nvr}']).decode().split(';;')
+    header = rpmheaders.read_header(srpmpath)
+    return header.name, header.nvr
 
 def check_dir(dirpath):
     if not os.path.isdir(dirpath):
@@ -0,0 +1,93 @@
+#!/bin/env python
+
+"""
+Benchmark depgraph.py on a synthetic dependency graph.
+
+The graph mimics a distribution: a small core of packages (glibc, systemd, python...) that
+require each other and that almost every package requires, libraries that require the core
+and a few other libraries, and leaf packages that require libraries. A fraction of the
+dependencies point "upwards" to create cycles of various sizes.
+
+Optionally checks the closures against a plain graph traversal from each node.
+"""
+
+from __future__ import print_function
+
+import argparse
+import random
+import time
+
+import depgraph
+
+
+def generate_graph(size, core_size, fanout, cycle_ratio, seed):
+    rng = random.Random(seed)
+    deps = []
+    for node in range(size):
+        if node < core_size:
+            # the core: everything in it requires a few other core packages, hence cycles
+            node_deps = rng.sample(range(core_size), min(fanout, core_size))
+        else:
+            node_deps = rng.sample(range(core_size), min(2, core_size))
+            for _ in range(fanout):
+                if rng.random() < cycle_ratio:
+                    # a close node "above" this one, which may require it: sibling packages often require each other
+                    node_deps.append(min(size - 1, node + rng.randrange(1, 50)))
+                else:
+                    # a node "below" this one, with a strong bias towards the most common libraries
+                    node_deps.append(int(node * rng.random() ** 4))
+        deps.append(sorted(set(dep for dep in node_deps if dep != node)))
+    broken = [rng.random() < 0.001 for _ in range(size)]
+    return deps, broken
+
+def traverse(deps, node):
+    seen = set([node])
+    to_visit = [node]
+    while to_visit:
+        for dep in deps[to_visit.pop()]:
+            if dep not in seen:
+                seen.add(dep)
+                to_visit.append(dep)
+    return sorted(seen)
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the shared closure computation of depgraph.py')
+    parser.add_argument('--size', type=int, default=50000, help='number of packages')
+    parser.add_argument('--core-size', type=int, default=300, help='number of core packages')
+    parser.add_argument('--fanout', type=int, default=4, help='direct dependencies per package')
+    parser.add_argument('--cycle-ratio', type=float, default=0.05,
+                        help='ratio of dependencies that may create cycles')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--check', type=int, default=0, metavar='N',
+                        help='check the closures of N random nodes against a plain traversal')
+    args = parser.parse_args()
+
+    start = time.time()
+    deps, broken = generate_graph(args.size, args.core_size, args.fanout, args.cycle_ratio, args.seed)
+    print("Generated %d nodes, %d edges in %.2fs" % (len(deps), sum(len(d) for d in deps), time.time() - start))
+
+    start = time.time()
+    closures = depgraph.Closures(deps, broken)
+    print("%d strongly connected components, largest: %d nodes"
+          % (len(closures.components), max(len(c) for c in closures.components)))
+    print("Computed all closures in %.2fs" % (time.time() - start))
+
+    start = time.time()
+    total = 0
+    for node in range(len(deps)):
+        total += len(closures.closure(node))
+    print("Listed all closures in %.2fs (%d nodes in total, %.1f on average)"
+          % (time.time() - start, total, float(total) / len(deps)))
+
+    if args.check:
+        rng = random.Random(args.seed)
+        for node in rng.sample(range(len(deps)), args.check):
+            expected = traverse(deps, node)
+            if closures.closure(node) != expected:
+                raise Exception("Wrong closure for node %d" % node)
+            if closures.is_broken(node) != any(broken[n] for n in expected):
+                raise Exception("Wrong broken flag for node %d" % node)
+        print("Checked %d closures against a plain traversal" % args.check)
+
+if __name__ == "__main__":
+    main()
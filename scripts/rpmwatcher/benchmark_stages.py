@@ -0,0 +1,221 @@
+#!/bin/env python
+
+"""
+Benchmark rpmwatcher_extract_roles.py and rpmwatcher_format_reports.py on synthetic workdirs.
+
+For each size, we generate what rpmwatcher_extract_deps.py would have produced: xcp-ng_builds_WIP2.json,
+xcp-ng_rpms_WIP2.json, rpms_installed_by_default_nvra.json and extra_installable_nvra.json.
+RPM dependencies use the same model as benchmark_depgraph.py. SRPMs produce a few consecutive RPMs
+and build-require core packages and libraries.
+
+Each stage runs as its own process, like in the pipeline, and we record its duration and peak RSS:
+- extract_roles: full computation of the roles
+- extract_roles_incremental: same, after the deps of a few RPMs changed, with --incremental
+- format_reports_{format}: for each requested format
+- format_reports_all: all the requested formats in one run, as in the pipeline
+
+Results are written to a JSON file. Give the file of a previous run (e.g. on another commit) to
+--compare to print the ratios and fail if a stage got slower or bigger than --tolerance allows.
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import workdir_store
+from benchmark_depgraph import generate_graph
+
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+VERSION = '8.2'
+BUILT_BY = ['xcp-ng', 'centos', 'epel', 'xs', 'unknown']
+
+def nvra(rpm):
+    return 'pkg%06d-1.0-1.el7.x86_64' % rpm
+
+def generate_workdir(work_dir, size, core_size, fanout, build_fanout, cycle_ratio, seed):
+    rng = random.Random(seed)
+    deps, _ = generate_graph(size, core_size, fanout, cycle_ratio, seed)
+
+    # SRPMs produce 1 to 5 consecutive RPMs
+    xcp_rpms = {}
+    xcp_builds = {}
+    rpm = 0
+    while rpm < size:
+        srpm = len(xcp_builds)
+        srpm_nvr = 'src%06d-1.0-1.el7' % srpm
+        rpms = range(rpm, min(size, rpm + rng.randint(1, 5)))
+        for srpm_rpm in rpms:
+            xcp_rpms[nvra(srpm_rpm)] = {
+                'name': 'pkg%06d' % srpm_rpm,
+                'srpm_nvr': srpm_nvr,
+                'deps': [nvra(dep) for dep in deps[srpm_rpm]],
+            }
+        build_info = {
+            'name': 'src%06d' % srpm,
+            'version': '1.0',
+            'release': '1.el7',
+            'summary': 'synthetic package %d' % srpm,
+            'koji_tag': 'v%s-%s' % (VERSION, rng.choice(['base', 'updates', 'testing', 'candidates'])),
+            'built-by': rng.choice(BUILT_BY),
+            'rpms': [nvra(srpm_rpm) for srpm_rpm in rpms],
+        }
+        if rng.random() < 0.3:
+            build_info['latest-centos'] = {'version': '1.%d' % rng.randint(0, 2), 'release': '1.el7'}
+        if build_info['built-by'] == 'xcp-ng' or rng.random() < 0.5:
+            # build deps: core packages (compilers...) and libraries "below" the SRPM's own RPMs
+            direct = set(rng.sample(range(core_size), min(build_fanout, core_size)))
+            for _ in range(build_fanout):
+                direct.add(int(rpm * rng.random() ** 2))
+            direct -= set(rpms)
+            pulled = set()
+            for dep in direct:
+                pulled.update(deps[dep])
+            pulled -= direct
+            build_info['build-deps'] = [[nvra(dep) for dep in sorted(direct)], [nvra(dep) for dep in sorted(pulled)]]
+        xcp_builds[srpm_nvr] = build_info
+        rpm = rpms[-1] + 1
+
+    # like in XCP-ng: the core and a small part of the rest is installed by default, a bit more is extra
+    installed_by_default = [nvra(rpm) for rpm in range(size) if rpm < core_size or rng.random() < 0.05]
+    extra_installable = [nvra(rpm) for rpm in range(core_size, size) if rng.random() < 0.02]
+
+    workdir = workdir_store.open_workdir(work_dir)
+    workdir.write('xcp-ng_builds_WIP2.json', xcp_builds)
+    workdir.write('xcp-ng_rpms_WIP2.json', xcp_rpms)
+    workdir.write('rpms_installed_by_default_nvra.json', installed_by_default)
+    workdir.write('extra_installable_nvra.json', extra_installable)
+    workdir.close()
+    return len(xcp_builds)
+
+def change_deps(work_dir, nb_rpms, seed):
+    """ change the deps of a few RPMs, as a rebuild would """
+    rng = random.Random(seed)
+    workdir = workdir_store.open_workdir(work_dir)
+    xcp_rpms = workdir.read('xcp-ng_rpms_WIP2.json')
+    rpm_nvras = sorted(xcp_rpms)
+    for rpm_nvra in rng.sample(rpm_nvras, nb_rpms):
+        xcp_rpms[rpm_nvra]['deps'] = rng.sample(rpm_nvras, 2)
+    workdir.write('xcp-ng_rpms_WIP2.json', xcp_rpms)
+    workdir.close()
+
+def run_stage(command, base_dir):
+    """ returns (duration in seconds, peak RSS in kB) of the command """
+    start = time.time()
+    with open(os.devnull, 'w') as devnull:
+        process = subprocess.Popen(command, cwd=base_dir, stdout=devnull)
+        _, status, rusage = os.wait4(process.pid, 0)
+    duration = time.time() - start
+    if status != 0:
+        raise Exception("Command failed with status %d: %s" % (os.WEXITSTATUS(status), ' '.join(command)))
+    # ru_maxrss is in kB on Linux
+    return duration, rusage.ru_maxrss
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=SCRIPTS_DIR).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(results, previous, tolerance):
+    """ prints the ratios to the previous results and returns the list of regressions """
+    regressions = []
+    for size, stages in sorted(results.items(), key=lambda item: int(item[0])):
+        for stage, measures in sorted(stages.items()):
+            previous_measures = previous.get(size, {}).get(stage)
+            if previous_measures is None:
+                continue
+            line = []
+            for measure in ['seconds', 'max_rss_kb']:
+                ratio = float(measures[measure]) / max(previous_measures[measure], 1e-6)
+                line.append('%s x%.2f' % (measure, ratio))
+                if ratio > 1 + tolerance:
+                    regressions.append('%s packages, %s: %s x%.2f' % (size, stage, measure, ratio))
+            print("%8s packages, %-26s %s" % (size, stage, ', '.join(line)))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the roles and reports stages of rpmwatcher')
+    parser.add_argument('--sizes', default='1000,10000,100000', help='comma-separated numbers of RPMs')
+    parser.add_argument('--core-size', type=int, default=300, help='number of core packages')
+    parser.add_argument('--fanout', type=int, default=4, help='direct dependencies per RPM')
+    parser.add_argument('--build-fanout', type=int, default=8, help='direct build dependencies per SRPM')
+    parser.add_argument('--cycle-ratio', type=float, default=0.05,
+                        help='ratio of dependencies that may create cycles')
+    parser.add_argument('--formats', default='html,markdown,csv', help='comma-separated report formats')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='benchmark_stages.json', help='where to write the results')
+    parser.add_argument('--compare', metavar='FILE', help='results of a previous run to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='with --compare, fail if a duration or peak RSS grew by more than this ratio')
+    parser.add_argument('--keep', action='store_true', help='keep the generated base directories')
+    args = parser.parse_args()
+
+    python = sys.executable or 'python'
+    results = {}
+    for size in [int(size) for size in args.sizes.split(',')]:
+        base_dir = tempfile.mkdtemp(prefix='rpmwatcher_benchmark_%d_' % size)
+        work_dir = os.path.join(base_dir, 'workdir', VERSION)
+        # format_reports checks that the repositories exist
+        for path in [work_dir, os.path.join(base_dir, 'xcp-ng', VERSION), os.path.join(base_dir, 'xcp-ng_rpms', VERSION)]:
+            os.makedirs(path)
+
+        start = time.time()
+        nb_srpms = generate_workdir(work_dir, size, args.core_size, args.fanout, args.build_fanout,
+                                    args.cycle_ratio, args.seed)
+        print("%d RPMs, %d SRPMs: generated in %.2fs" % (size, nb_srpms, time.time() - start))
+
+        extract_roles = [python, os.path.join(SCRIPTS_DIR, 'rpmwatcher_extract_roles.py'), VERSION, '.']
+        stages = [('extract_roles', extract_roles, None),
+                  ('extract_roles_incremental', extract_roles + ['--incremental'],
+                   lambda: change_deps(work_dir, 5, args.seed))]
+        for format in args.formats.split(','):
+            stages.append(('format_reports_%s' % format,
+                           [python, os.path.join(SCRIPTS_DIR, 'rpmwatcher_format_reports.py'), VERSION, '.', format],
+                           None))
+        stages.append(('format_reports_all',
+                       [python, os.path.join(SCRIPTS_DIR, 'rpmwatcher_format_reports.py'), VERSION, '.', args.formats],
+                       None))
+
+        results[str(size)] = {}
+        for stage, command, prepare in stages:
+            if prepare is not None:
+                prepare()
+            duration, max_rss = run_stage(command, base_dir)
+            results[str(size)][stage] = {'seconds': round(duration, 3), 'max_rss_kb': max_rss}
+            print("%d RPMs, %s: %.2fs, peak RSS %d MB" % (size, stage, duration, max_rss // 1024))
+
+        if args.keep:
+            print("Kept %s" % base_dir)
+        else:
+            shutil.rmtree(base_dir)
+
+    with open(args.output, 'w') as f:
+        json.dump({
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'parameters': dict((key, value) for key, value in vars(args).items()
+                               if key not in ('output', 'compare', 'tolerance', 'keep')),
+            'results': results,
+        }, f, sort_keys=True, indent=4)
+    print("Results written to %s" % args.output)
+
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)
+        print("Compared with %s (commit %s):" % (args.compare, previous.get('commit')))
+        regressions = compare(results, previous['results'], args.tolerance)
+        if regressions:
+            print("Regressions:\n" + "\n".join(regressions))
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+#!/bin/env python
+
+"""
+Replay a history of inputs of rpmwatcher_extract_roles.py and check at each step that the roles
+computed incrementally, as with --incremental, are the same as those of a full computation.
+
+The history is a list of directories, oldest first, each holding the inputs of one past run:
+xcp-ng_rpms_WIP2.json, xcp-ng_builds_WIP2.json, rpms_installed_by_default_nvra.json and
+extra_installable_nvra.json, e.g. backups of workdir/{version}. Without directories, a history is
+generated from a synthetic workdir of benchmark_stages.py: at each step, a few SRPMs are rebuilt,
+which renames them and their RPMs, and the deps of a few RPMs change.
+
+Like the pipeline, each step starts from the roles, state and links of the previous incremental one.
+For each step, prints the number of RPMs that changed, the number of other RPMs processed in another
+order, the share of RPMs whose roles were recomputed and the durations of both computations.
+Fails on the first RPM or SRPM whose roles differ.
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import random
+import shutil
+import tempfile
+import time
+
+import workdir_store
+from benchmark_stages import generate_workdir
+from rpmwatcher_extract_roles import JsonSortAndEncode, RoleGraph, restrict_to_changes, roles_state
+
+INPUT_DOCUMENTS = ['xcp-ng_rpms_WIP2.json', 'xcp-ng_builds_WIP2.json',
+                   'rpms_installed_by_default_nvra.json', 'extra_installable_nvra.json']
+
+def read_inputs(work_dir):
+    """ read as rpmwatcher_extract_roles.py does: the order of the RPMs depends on it """
+    workdir = workdir_store.open_workdir(work_dir)
+    documents = [workdir.read(name) for name in INPUT_DOCUMENTS]
+    workdir.close()
+    return documents
+
+def write_inputs(work_dir, documents):
+    workdir = workdir_store.open_workdir(work_dir)
+    for name, data in zip(INPUT_DOCUMENTS, documents):
+        workdir.write(name, data)
+    workdir.close()
+
+def bump_release(nvr):
+    """ pkg-1.0-1.el7(.x86_64) -> pkg-1.0-2.el7(.x86_64) """
+    name, version, release = nvr.rsplit('-', 2)
+    number, rest = release.split('.', 1)
+    return '%s-%s-%d.%s' % (name, version, int(number) + 1, rest)
+
+def mutate(documents, rng, nb_rebuilds, nb_dep_changes):
+    """ rebuild a few SRPMs and change the deps of a few RPMs """
+    xcp_rpms, xcp_builds, installed_by_default, extra_installable = documents
+    renamed = {}
+    for srpm_nvr in rng.sample(sorted(xcp_builds), nb_rebuilds):
+        build_info = xcp_builds.pop(srpm_nvr)
+        new_srpm_nvr = bump_release(srpm_nvr)
+        xcp_builds[new_srpm_nvr] = build_info
+        for rpm_nvra in build_info['rpms']:
+            renamed[rpm_nvra] = bump_release(rpm_nvra)
+            xcp_rpms[renamed[rpm_nvra]] = xcp_rpms.pop(rpm_nvra)
+            xcp_rpms[renamed[rpm_nvra]]['srpm_nvr'] = new_srpm_nvr
+    rpm_nvras = sorted(xcp_rpms)
+    for rpm_nvra in rng.sample(rpm_nvras, nb_dep_changes):
+        xcp_rpms[rpm_nvra]['deps'] = rng.sample(rpm_nvras, 2)
+
+    def rename(rpm_nvras):
+        return [renamed.get(rpm_nvra, rpm_nvra) for rpm_nvra in rpm_nvras]
+    for rpm_info in xcp_rpms.values():
+        rpm_info['deps'] = rename(rpm_info['deps'])
+    for build_info in xcp_builds.values():
+        build_info['rpms'] = rename(build_info['rpms'])
+        if 'build-deps' in build_info:
+            build_info['build-deps'] = [rename(deps) for deps in build_info['build-deps']]
+    return [xcp_rpms, xcp_builds, rename(installed_by_default), rename(extra_installable)]
+
+def generated_history(args):
+    """ yields the directories of the generated history """
+    base_dir = tempfile.mkdtemp(prefix='rpmwatcher_history_')
+    rng = random.Random(args.seed)
+    try:
+        work_dir = os.path.join(base_dir, '0')
+        os.mkdir(work_dir)
+        generate_workdir(work_dir, args.size, min(args.core_size, args.size), args.fanout, args.build_fanout,
+                         args.cycle_ratio, args.seed)
+        yield work_dir
+        for step in range(1, args.steps + 1):
+            documents = mutate(read_inputs(work_dir), rng, args.rebuilds, args.dep_changes)
+            work_dir = os.path.join(base_dir, str(step))
+            os.mkdir(work_dir)
+            write_inputs(work_dir, documents)
+            yield work_dir
+    finally:
+        shutil.rmtree(base_dir)
+
+def with_roles(graph, xcp_rpms, xcp_builds):
+    """ xcp-ng_rpms.json and xcp-ng_builds.json as rpmwatcher_extract_roles.py writes them, read back """
+    for rpm, rpm_nvra in enumerate(graph.rpm_nvras):
+        xcp_rpms[rpm_nvra]['roles'] = graph.rpm_roles(rpm)
+    for srpm_nvr, build_info in xcp_builds.items():
+        build_info['roles'] = graph.srpm_roles(graph.srpm_ids[srpm_nvr])
+    return [json.loads(json.dumps(data, cls=JsonSortAndEncode)) for data in (xcp_rpms, xcp_builds)]
+
+def first_difference(graph, full_graph):
+    """ NVRA or SRPM NVR of the first package whose roles differ, None if there are none """
+    for rpm, rpm_nvra in enumerate(graph.rpm_nvras):
+        if graph.rpm_roles(rpm) != full_graph.rpm_roles(rpm):
+            return rpm_nvra
+    for srpm, srpm_nvr in enumerate(graph.srpm_nvrs):
+        if graph.srpm_roles(srpm) != full_graph.srpm_roles(srpm):
+            return srpm_nvr
+    return None
+
+def main():
+    parser = argparse.ArgumentParser(description='Check incremental role computations against full ones '
+                                                 'on a history of inputs')
+    parser.add_argument('history', nargs='*',
+                        help='directories holding the inputs of past runs, oldest first. '
+                             'By default, a history is generated.')
+    parser.add_argument('--steps', type=int, default=10, help='number of generated steps')
+    parser.add_argument('--size', type=int, default=3000, help='number of RPMs of the generated workdir')
+    parser.add_argument('--rebuilds', type=int, default=2, help='SRPMs rebuilt at each generated step')
+    parser.add_argument('--dep-changes', type=int, default=3, help='RPMs whose deps change at each generated step')
+    parser.add_argument('--core-size', type=int, default=300, help='number of core packages')
+    parser.add_argument('--fanout', type=int, default=4, help='direct dependencies per RPM')
+    parser.add_argument('--build-fanout', type=int, default=8, help='direct build dependencies per SRPM')
+    parser.add_argument('--cycle-ratio', type=float, default=0.05,
+                        help='ratio of dependencies that may create cycles')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    previous = None
+    for step, work_dir in enumerate(args.history or generated_history(args)):
+        xcp_rpms, xcp_builds, installed_by_default, extra_installable = read_inputs(work_dir)
+        start = time.time()
+        graph = RoleGraph(xcp_rpms, xcp_builds)
+        if previous is not None:
+            state, previous_rpms, previous_builds, previous_links = previous
+            nb_changed, nb_reordered = restrict_to_changes(graph, xcp_rpms, xcp_builds,
+                                                           [installed_by_default, extra_installable], state,
+                                                           previous_rpms, previous_builds, previous_links)
+        graph.compute_roles(installed_by_default, extra_installable)
+        duration = time.time() - start
+
+        if previous is None:
+            print("%s: %d RPMs, full computation in %.2fs" % (work_dir, len(graph.rpm_nvras), duration))
+        else:
+            start = time.time()
+            full_graph = RoleGraph(xcp_rpms, xcp_builds)
+            full_graph.compute_roles(installed_by_default, extra_installable)
+            full_duration = time.time() - start
+            different = first_difference(graph, full_graph)
+            if different is not None:
+                raise Exception("%s: incremental roles of %s differ from a full computation" % (work_dir, different))
+            print("%s: %d RPMs changed, %d reordered, %.1f%% of %d RPMs recomputed in %.2fs, full computation "
+                  "in %.2fs" % (work_dir, nb_changed, nb_reordered, 100.0 * sum(graph.region) / len(graph.rpm_nvras),
+                                len(graph.rpm_nvras), duration, full_duration))
+
+        state = json.loads(json.dumps(roles_state(graph, installed_by_default, extra_installable)))
+        previous = [state] + with_roles(graph, xcp_rpms, xcp_builds) + [list(graph.link_rows())]
+    print("OK")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,286 @@
+#!/bin/env python
+
+"""
+Check the roles computed by RoleGraph in rpmwatcher_extract_roles.py, in particular the indirect builddep
+roles, against the implementation it replaced, which made a fixed number of passes (10) over all the RPMs.
+
+The reference, baseline_roles(), is the former code of rpmwatcher_extract_roles.py ported verbatim:
+same dicts and sets, same iteration order over the RPMs, only the number of passes is a parameter.
+Its lint findings are kept, not fixed.
+Each computation reads its own copy of the documents, so that they all iterate in the order
+rpmwatcher_extract_roles.py sees.
+
+The roles are computed on synthetic workdirs generated by benchmark_stages.py, to which we add
+a chain of SRPMs, each build-requiring the RPM of the next one, far deeper than 10.
+
+For each workdir, we fail if the roles of an RPM or SRPM differ:
+- from those of the 10-pass reference, when an 11th pass wouldn't have changed them (it reached the fixpoint)
+- from those of the reference run with enough passes to reach the fixpoint, in every case
+and if the deep chain didn't make the 10-pass reference stop before the fixpoint.
+The links recorded for rpmwatcher_why.py aren't compared: the former code had none.
+"""
+
+from __future__ import print_function
+
+import argparse
+import shutil
+import tempfile
+
+import workdir_store
+from benchmark_stages import generate_workdir
+from rpmwatcher_extract_roles import RoleGraph
+
+REFERENCE_PASSES = 10
+
+def baseline_roles(xcp_rpms, xcp_builds, rpms_installed_by_default, extra_installable_nvra, iterations=10):
+    """ the role computation of rpmwatcher_extract_roles.py before RoleGraph, updates xcp_rpms and xcp_builds """
+    for rpm_nvra in xcp_rpms:
+        xcp_rpms[rpm_nvra]['roles'] = {}
+
+    def add_rpm_role(xcp_rpms, rpm_nvra, role, related_rpm_nvra):
+        if role not in xcp_rpms[rpm_nvra]['roles']:
+            xcp_rpms[rpm_nvra]['roles'][role] = set()
+        xcp_rpms[rpm_nvra]['roles'][role].add(related_rpm_nvra)
+
+    for rpm_nvra in xcp_rpms:
+        if rpm_nvra in rpms_installed_by_default:
+            # for now the related RPM for the 'main' role is the RPM itself
+            # in the future we may want to improve this and detail the dependency chain more
+            add_rpm_role(xcp_rpms, rpm_nvra, 'main', rpm_nvra)
+
+        if rpm_nvra in extra_installable_nvra:
+            add_rpm_role(xcp_rpms, rpm_nvra, 'extra', rpm_nvra)
+
+    for rpm_nvra in xcp_rpms:
+        if rpm_nvra in extra_installable_nvra:
+            for dep in xcp_rpms[rpm_nvra]['deps']:
+                if not xcp_rpms[dep]['roles']:
+                    add_rpm_role(xcp_rpms, dep, 'extra_dep', rpm_nvra)
+
+    def intersect_or_both_empty(list1, list2):
+        if not list1 and not list2:
+            return True
+        return bool(list(set(list1) & set(list2)))
+
+    def srpm_rpms_have_roles(xcp_rpms, xcp_builds, srpm_nvr):
+        for rpm_nvra in xcp_builds[srpm_nvr]['rpms']:  # noqa: SIM110
+            if xcp_rpms[rpm_nvra]['roles']:
+                return True
+        return False
+
+    def update_builddep_role(xcp_rpms, xcp_builds, roles_from, role_to, direct):
+        """
+        Identify and flag RPMs that are builddeps or deps of builddeps
+        """
+        for rpm_nvra in xcp_rpms:
+            if intersect_or_both_empty(xcp_rpms[rpm_nvra]['roles'].keys(), roles_from):
+                srpm_nvr = xcp_rpms[rpm_nvra]['srpm_nvr']
+                # if roles_from is empty and the RPM belongs to a SRPM that already has RPMs with roles,
+                # don't retain that RPM. We don't want other_builddep and other_builddep_dep to pop everywhere
+                # a SRPM produces an unused RPM among other useful RPMs
+                if not roles_from and srpm_rpms_have_roles(xcp_rpms, xcp_builds, srpm_nvr):
+                    continue
+                if srpm_nvr in xcp_builds and 'build-deps' in xcp_builds[srpm_nvr]:
+                    for dep_rpm_nvra in xcp_builds[srpm_nvr]['build-deps'][0 if direct else 1]:
+                        add_rpm_role(xcp_rpms, dep_rpm_nvra, role_to, srpm_nvr)
+
+    def update_indirect_builddep_role(xcp_rpms, xcp_builds, role_prefix, role_to, iterations=10):
+        """
+        Identify and flag RPMs that are builddeps for builddeps themselves.
+        Or deps of builddeps of builddeps.
+        Or builddeps of deps of builddeps of deps of builddeps.
+        Or builddeps of builddeps of deps of builddeps of builddeps of builddeps
+        All of them.
+        """
+        # Start with builddeps (direct or not) of RPMs whose role starts with role_prefix
+        for i in xrange(iterations):
+            if i == 0:  # noqa: SIM108
+                roles_to_scan = [role_prefix + '_builddep', role_prefix + '_builddep_dep']
+            else:
+                roles_to_scan = [role_to] # after the first iteration
+            for rpm_nvra in xcp_rpms:
+                if intersect_or_both_empty(xcp_rpms[rpm_nvra]['roles'].keys(), roles_to_scan):
+                    # if roles_to_scan is empty and the RPM belongs to a SRPM that already has RPMs with roles,
+                    # don't retain that RPM. We don't want other_indirect_builddep to pop everywhere
+                    # a SRPM produces an unused RPM among other useful RPMs
+                    if not roles_to_scan and srpm_rpms_have_roles(xcp_rpms, xcp_builds, srpm_nvr):  # noqa: F823
+                        continue
+                    # scan the builddeps of its SRPM
+                    srpm_nvr = xcp_rpms[rpm_nvra]['srpm_nvr']
+                    if srpm_nvr in xcp_builds and 'build-deps' in xcp_builds[srpm_nvr]:
+                        for dep_type in [0, 1]:
+                            for dep_rpm_nvra in xcp_builds[srpm_nvr]['build-deps'][dep_type]:
+                                # since the roles_to_scan are already build deps, the SRPMs to point
+                                # as target of the indirect builddep must be those that the build deps
+                                # themselves target
+                                for role_from in roles_to_scan:
+                                    for upper_srpm_nvr in xcp_rpms[rpm_nvra]['roles'].get(role_from, []):
+                                        # Interpretation:
+                                        # If...
+                                        # 1. dep_rpm_nvra   ---(direct or pulled build dep of)--->     srpm_nvr
+                                        # 2. srpm_nvr       -------------(produces)-------------->     rpm_nvra
+                                        # 3. rpm_nvra       ------("role_from" build dep of)----->     upper_srpm_nvr
+                                        # Then...
+                                        # dep_rpm_nvra      -------("role_to" build dep of)------>     upper_srpm_nvr
+                                        add_rpm_role(xcp_rpms, dep_rpm_nvra, role_to, upper_srpm_nvr)
+
+    update_builddep_role(xcp_rpms, xcp_builds, roles_from=['main'], role_to='main_builddep', direct=True)
+    update_builddep_role(xcp_rpms, xcp_builds, roles_from=['main'], role_to='main_builddep_dep', direct=False)
+    update_indirect_builddep_role(xcp_rpms, xcp_builds, role_prefix='main', role_to='main_indirect_builddep',
+                                  iterations=iterations)
+    update_builddep_role(xcp_rpms, xcp_builds, roles_from=['extra', 'extra_dep'], role_to='extra_builddep', direct=True)
+    update_builddep_role(xcp_rpms, xcp_builds, roles_from=['extra', 'extra_dep'], role_to='extra_builddep_dep', direct=False)
+    update_indirect_builddep_role(xcp_rpms, xcp_builds, role_prefix='extra', role_to='extra_indirect_builddep',
+                                  iterations=iterations)
+
+    # Now deps of RPMs that still have no roles
+    update_builddep_role(xcp_rpms, xcp_builds, roles_from=[], role_to='other_builddep', direct=True)
+    update_builddep_role(xcp_rpms, xcp_builds, roles_from=[], role_to='other_builddep_dep', direct=False)
+    update_indirect_builddep_role(xcp_rpms, xcp_builds, role_prefix='other', role_to='other_indirect_builddep',
+                                  iterations=iterations)
+    for rpm_nvra in xcp_rpms:
+        if not xcp_rpms[rpm_nvra]['roles']:
+            for dep in xcp_rpms[rpm_nvra]['deps']:
+                # other_dep possible only if has no other role than 'other_*'
+                if not [x for x in xcp_rpms[dep]['roles'] if not x.startswith('other_')]:
+                    add_rpm_role(xcp_rpms, dep, 'other_dep', rpm_nvra)
+
+    # Update SRPM roles based on RPM roles
+    for srpm_nvr, build_info in xcp_builds.iteritems():
+        srpm_roles = {}
+        for rpm_nvra in build_info['rpms']:
+            for rpm_role, role_data in xcp_rpms[rpm_nvra]['roles'].iteritems():
+                if rpm_role in ('extra_dep', 'other_dep'):
+                    # ignore deps towards RPM of the same SRPM
+                    role_data = [x for x in role_data if xcp_rpms[x]['srpm_nvr'] != srpm_nvr]
+
+                if not role_data:
+                    continue
+
+                if rpm_role not in srpm_roles:
+                    srpm_roles[rpm_role] = set()
+                srpm_roles[rpm_role].update(role_data)
+        build_info['roles'] = srpm_roles
+
+def read_documents(work_dir):
+    workdir = workdir_store.open_workdir(work_dir)
+    documents = [workdir.read('xcp-ng_rpms_WIP2.json'), workdir.read('xcp-ng_builds_WIP2.json'),
+                 workdir.read('rpms_installed_by_default_nvra.json'), workdir.read('extra_installable_nvra.json')]
+    workdir.close()
+    return documents
+
+def add_builddep_chain(work_dir, depth):
+    """
+    SRPMs chain{depth} to chain000, each producing one RPM and build-requiring the RPM of the next one.
+    The RPM of chain{depth} is installed by default, so the one of chain000 is a main_indirect_builddep
+    through depth - 1 SRPMs.
+    """
+    xcp_rpms, xcp_builds, installed_by_default, _ = read_documents(work_dir)
+    for level in range(depth, -1, -1):
+        name = 'chain%03d' % level
+        srpm_nvr = '%s-1.0-1.el7' % name
+        rpm_nvra = '%s-1.0-1.el7.x86_64' % name
+        xcp_rpms[rpm_nvra] = {'name': name, 'srpm_nvr': srpm_nvr, 'deps': []}
+        xcp_builds[srpm_nvr] = {
+            'name': name,
+            'rpms': [rpm_nvra],
+            'build-deps': [['chain%03d-1.0-1.el7.x86_64' % (level - 1)] if level else [], []],
+        }
+    installed_by_default.append('chain%03d-1.0-1.el7.x86_64' % depth)
+    workdir = workdir_store.open_workdir(work_dir)
+    workdir.write('xcp-ng_rpms_WIP2.json', xcp_rpms)
+    workdir.write('xcp-ng_builds_WIP2.json', xcp_builds)
+    workdir.write('rpms_installed_by_default_nvra.json', installed_by_default)
+    workdir.close()
+    return 'chain000-1.0-1.el7.x86_64'
+
+def reference(work_dir, passes):
+    """ [xcp_rpms, xcp_builds] with the roles the former implementation gives with this number of passes """
+    documents = read_documents(work_dir)
+    baseline_roles(*documents, iterations=passes)
+    return documents[:2]
+
+def fixpoint_reference(work_dir, reference_10):
+    """ (passes, reference) for a number of passes after which one more pass changes no roles """
+    passes, roles = REFERENCE_PASSES, reference_10
+    while True:
+        next_roles = reference(work_dir, passes + 1)
+        if next_roles == roles:
+            return passes, roles
+        passes *= 2
+        roles = reference(work_dir, passes)
+
+def first_difference(graph, roles):
+    """ NVRA or SRPM NVR of the first package whose roles differ from the reference, None if there are none """
+    xcp_rpms, xcp_builds = roles
+    for rpm_nvra, rpm_info in xcp_rpms.iteritems():
+        if graph.rpm_roles(graph.rpm_ids[rpm_nvra]) != rpm_info['roles']:
+            return rpm_nvra
+    for srpm_nvr, build_info in xcp_builds.iteritems():
+        if graph.srpm_roles(graph.srpm_ids[srpm_nvr]) != build_info['roles']:
+            return srpm_nvr
+    return None
+
+def check(work_dir, chain_rpm):
+    """ returns (whether the 10-pass reference reached the fixpoint, passes needed), fails on any difference """
+    xcp_rpms, xcp_builds, installed_by_default, extra_installable = read_documents(work_dir)
+    graph = RoleGraph(xcp_rpms, xcp_builds)
+    graph.compute_roles(installed_by_default, extra_installable)
+    reference_10 = reference(work_dir, REFERENCE_PASSES)
+    passes, fixpoint = fixpoint_reference(work_dir, reference_10)
+    converged = passes == REFERENCE_PASSES
+
+    if converged:
+        different = first_difference(graph, reference_10)
+        if different is not None:
+            raise Exception("Roles of %s differ from the %d-pass reference" % (different, REFERENCE_PASSES))
+    different = first_difference(graph, fixpoint)
+    if different is not None:
+        raise Exception("Roles of %s differ from the reference run until the fixpoint" % different)
+    if chain_rpm is not None:
+        if converged:
+            raise Exception("The builddep chain didn't need more than %d passes" % REFERENCE_PASSES)
+        if 'main_indirect_builddep' not in graph.rpm_roles(graph.rpm_ids[chain_rpm]):
+            raise Exception("%s, at the end of the builddep chain, isn't a main_indirect_builddep" % chain_rpm)
+    return converged, passes
+
+def main():
+    parser = argparse.ArgumentParser(description='Check the roles against the former %d-pass implementation'
+                                                 % REFERENCE_PASSES)
+    parser.add_argument('--sizes', default='200,1000,2000', help='comma-separated numbers of RPMs')
+    parser.add_argument('--seeds', type=int, default=3, help='number of workdirs generated for each size')
+    parser.add_argument('--chain-depth', type=int, default=40,
+                        help='depth of the builddep chain added to the workdirs, must be more than %d'
+                             % REFERENCE_PASSES)
+    parser.add_argument('--core-size', type=int, default=50, help='number of core packages')
+    parser.add_argument('--fanout', type=int, default=4, help='direct dependencies per RPM')
+    parser.add_argument('--build-fanout', type=int, default=8, help='direct build dependencies per SRPM')
+    parser.add_argument('--cycle-ratio', type=float, default=0.05,
+                        help='ratio of dependencies that may create cycles')
+    args = parser.parse_args()
+
+    if args.chain_depth <= REFERENCE_PASSES:
+        parser.error('--chain-depth must be more than %d' % REFERENCE_PASSES)
+
+    for size in [int(size) for size in args.sizes.split(',')]:
+        for seed in range(args.seeds):
+            work_dir = tempfile.mkdtemp(prefix='rpmwatcher_check_%d_' % size)
+            try:
+                generate_workdir(work_dir, size, min(args.core_size, size), args.fanout, args.build_fanout,
+                                 args.cycle_ratio, seed)
+                for chain_depth in [None, args.chain_depth]:
+                    chain_rpm = None
+                    if chain_depth is not None:
+                        chain_rpm = add_builddep_chain(work_dir, chain_depth)
+                    converged, passes = check(work_dir, chain_rpm)
+                    print("%d RPMs, seed %d, %s: %s" % (
+                        size, seed, 'builddep chain of depth %d' % chain_depth if chain_depth else 'no chain',
+                        'same roles as the %d-pass reference' % REFERENCE_PASSES if converged
+                        else 'same roles as the reference with %d passes, the %d-pass one stops before'
+                        % (passes, REFERENCE_PASSES)))
+            finally:
+                shutil.rmtree(work_dir)
+    print("OK")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""
+Persistent cache of the results of rpmwatcher_extract_deps.py.
+
+Each RPM's runtime dependencies and each SRPM's build dependencies are written to a SQLite
+database as soon as they are computed. So if the stage dies after hours, the next run resumes
+where it stopped, and a run against unchanged repositories only reads results back.
+
+Results are only valid for a given state of the repositories and for a given way of resolving
+dependencies, so every entry is stored along with a fingerprint of those. Entries with another
+fingerprint than the current one are dropped when the cache is opened.
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+
+# Bump when the format of the cached records changes
+CACHE_VERSION = 1
+
+def repo_fingerprint(repo_dir, *extra):
+    """
+    Fingerprint of the list of RPMs in repo_dir and of any additional values.
+    RPM filenames are unique and the files are never modified in place, so the list of filenames is enough.
+    """
+    h = hashlib.sha256()
+    h.update(('%d\n' % CACHE_VERSION).encode('utf-8'))
+    for value in extra:
+        h.update(('%s\n' % value).encode('utf-8'))
+    for filename in sorted(filename for filename in os.listdir(repo_dir) if filename.endswith('.rpm')):
+        h.update(('%s\n' % filename).encode('utf-8'))
+    return h.hexdigest()
+
+class DepsCache(object):
+    """
+    SQLite-backed cache of dependency results, keyed on (fingerprint, NVRA) or (fingerprint, SRPM NVR)
+    """
+    def __init__(self, dbpath, fingerprint):
+        self.fingerprint = fingerprint
+        self.conn = sqlite3.connect(dbpath)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS runtime_deps ('
+                          'fingerprint TEXT, rpm_nvra TEXT, installable INTEGER, deps TEXT, '
+                          'PRIMARY KEY (fingerprint, rpm_nvra))')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS build_deps ('
+                          'fingerprint TEXT, srpm_nvr TEXT, direct_deps TEXT, deps_deps TEXT, '
+                          'PRIMARY KEY (fingerprint, srpm_nvr))')
+        self.conn.execute('DELETE FROM runtime_deps WHERE fingerprint != ?', (fingerprint,))
+        self.conn.execute('DELETE FROM build_deps WHERE fingerprint != ?', (fingerprint,))
+        self.conn.commit()
+        self.hits = 0
+        self.misses = 0
+
+    def get_runtime_deps(self, rpm_nvra):
+        """ returns (installable, deps) or None if not in cache """
+        row = self.conn.execute('SELECT installable, deps FROM runtime_deps WHERE fingerprint = ? AND rpm_nvra = ?',
+                                (self.fingerprint, rpm_nvra)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return bool(row[0]), json.loads(row[1])
+
+    def store_runtime_deps(self, rpm_nvra, installable, deps):
+        self.conn.execute('INSERT OR REPLACE INTO runtime_deps (fingerprint, rpm_nvra, installable, deps) '
+                          'VALUES (?, ?, ?, ?)', (self.fingerprint, rpm_nvra, installable, json.dumps(deps)))
+        # commit right away: each result can take seconds to compute, and must survive a crash
+        self.conn.commit()
+
+    def get_build_deps(self, srpm_nvr):
+        """ returns (direct_deps, deps_deps) or None if not in cache """
+        row = self.conn.execute('SELECT direct_deps, deps_deps FROM build_deps WHERE fingerprint = ? AND srpm_nvr = ?',
+                                (self.fingerprint, srpm_nvr)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return json.loads(row[0]), json.loads(row[1])
+
+    def store_build_deps(self, srpm_nvr, build_deps):
+        direct_deps, deps_deps = build_deps
+        self.conn.execute('INSERT OR REPLACE INTO build_deps (fingerprint, srpm_nvr, direct_deps, deps_deps) '
+                          'VALUES (?, ?, ?, ?)',
+                          (self.fingerprint, srpm_nvr, json.dumps(direct_deps), json.dumps(deps_deps)))
+        self.conn.commit()
+
+    def stats(self):
+        return "Dependency cache: %d hits, %d misses" % (self.hits, self.misses)
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
@@ -0,0 +1,128 @@
+"""
+Transitive closures of a dependency graph, computed once for all nodes.
+
+Runtime dependency closures overlap heavily: glibc, systemd, python... are under almost
+everything. So rather than walking the graph from every package, we condense its strongly
+connected components (packages that require each other all have the same closure), then
+compute the closure of each component bottom-up: a component's closure is the union of its
+own nodes and of the closures of the components it depends on, which are already known
+since Tarjan's algorithm emits components in reverse topological order.
+
+Closures are Python integers used as bitsets, bit i standing for node i, so that unions
+of closures are computed in C, one machine word at a time.
+
+The graph is given as a list of lists: deps[i] is the list of direct dependencies of node i.
+"""
+
+def strongly_connected_components(deps):
+    """
+    Iterative version of Tarjan's algorithm.
+
+    returns the list of components (lists of nodes), each component listed after all the
+    components it depends on.
+    """
+    n = len(deps)
+    index = [-1] * n
+    lowlink = [0] * n
+    on_stack = [False] * n
+    stack = []
+    components = []
+    counter = 0
+    for root in range(n):
+        if index[root] != -1:
+            continue
+        index[root] = lowlink[root] = counter
+        counter += 1
+        stack.append(root)
+        on_stack[root] = True
+        # (node, position of the next dependency to visit)
+        work = [(root, 0)]
+        while work:
+            node, i = work[-1]
+            node_deps = deps[node]
+            if i < len(node_deps):
+                work[-1] = (node, i + 1)
+                dep = node_deps[i]
+                if index[dep] == -1:
+                    index[dep] = lowlink[dep] = counter
+                    counter += 1
+                    stack.append(dep)
+                    on_stack[dep] = True
+                    work.append((dep, 0))
+                elif on_stack[dep] and index[dep] < lowlink[node]:
+                    lowlink[node] = index[dep]
+                continue
+            work.pop()
+            if work:
+                parent = work[-1][0]
+                if lowlink[node] < lowlink[parent]:
+                    lowlink[parent] = lowlink[node]
+            if lowlink[node] == index[node]:
+                component = []
+                while True:
+                    member = stack.pop()
+                    on_stack[member] = False
+                    component.append(member)
+                    if member == node:
+                        break
+                components.append(component)
+    return components
+
+def bit_positions(bitset):
+    """ positions of the bits set in bitset, in increasing order """
+    # bin() and str.find run in C, much faster than shifting a big integer bit by bit
+    digits = bin(bitset)[:1:-1]
+    positions = []
+    pos = digits.find('1')
+    while pos != -1:
+        positions.append(pos)
+        pos = digits.find('1', pos + 1)
+    return positions
+
+class Closures(object):
+    """
+    Transitive closures of all the nodes of a graph.
+
+    broken, when given, is a list of booleans, e.g. whether a package has unresolvable requirements.
+    A node is then broken if any node of its closure is.
+    """
+    def __init__(self, deps, broken=None):
+        n = len(deps)
+        self.components = strongly_connected_components(deps)
+        self.component_of = [0] * n
+        for c, component in enumerate(self.components):
+            for node in component:
+                self.component_of[node] = c
+
+        self.bitsets = [0] * len(self.components)
+        self.broken = [False] * len(self.components)
+        for c, component in enumerate(self.components):
+            bitset = 0
+            is_broken = False
+            dep_components = set()
+            for node in component:
+                bitset |= 1 << node
+                if broken is not None and broken[node]:
+                    is_broken = True
+                for dep in deps[node]:
+                    dep_components.add(self.component_of[dep])
+            dep_components.discard(c)
+            for dep_component in dep_components:
+                bitset |= self.bitsets[dep_component]
+                is_broken = is_broken or self.broken[dep_component]
+            self.bitsets[c] = bitset
+            self.broken[c] = is_broken
+
+    def closure_bitset(self, node):
+        """ nodes reachable from node, including node itself, as a bitset """
+        return self.bitsets[self.component_of[node]]
+
+    def closure(self, node):
+        """ sorted list of the nodes reachable from node, including node itself """
+        return bit_positions(self.bitsets[self.component_of[node]])
+
+    def closure_size(self, node):
+        return bin(self.bitsets[self.component_of[node]]).count('1')
+
+    def is_broken(self, node):
+        return self.broken[self.component_of[node]]
@@ -0,0 +1,306 @@
+"""
+In-process dependency resolution over the repodata of a local RPM mirror.
+
+rpmwatcher_extract_deps.py used to run yumdownloader --resolve once per RPM, each run
+loading all the yum metadata again. Here, the provides / requires index is built once
+from the primary metadata (see repodata.py) and every runtime closure is computed in the
+same process, without network access.
+
+The resolution follows what yum does for a simple install:
+- requirements already satisfied by the packages installed in the install root are not pulled
+- neither are requirements satisfied by a package already pulled for the same closure
+- otherwise, among the packages that provide the requirement, the newest version of each name.arch
+  is considered, then we prefer, in that order: the arch of the requiring package, noarch, the
+  best arch of the host (for noarch requiring packages, see BEST_ARCH), the package whose name is
+  the requirement, a package from the same SRPM as the requiring package, the longest common name
+  prefix with the requiring package, the shortest name, the first name alphabetically.
+Conflicts and obsoletes are not taken into account.
+
+File requirements for files that aren't part of the primary metadata are resolved by
+loading filelists.xml, the first time such a requirement is met.
+
+get_all_runtime_deps() walks the requirements from the requested package. Alternatively,
+get_runtime_deps_from_graph() picks a provider for each requirement of each package once,
+then uses depgraph.py to compute all the closures at once. The result only differs when
+two packages of a closure require the same capability and different providers get
+picked for each, in which case both providers are listed.
+"""
+
+import subprocess
+from collections import deque
+
+import depgraph
+import evrkey
+import repodata
+
+# Bump when the choice of providers changes, to invalidate the results cached by rpmwatcher_extract_deps.py
+RESOLUTION_VERSION = 2
+
+# arch of the XCP-ng repositories. Like yum on such a host, it is preferred to the multilib arches
+# (i686) when the requiring package is noarch.
+BEST_ARCH = 'x86_64'
+
+# same values as RPMSENSE_* in rpm
+SENSE_LT = 2
+SENSE_GT = 4
+SENSE_EQ = 8
+FLAGS = {
+    None: 0,
+    'LT': SENSE_LT,
+    'GT': SENSE_GT,
+    'EQ': SENSE_EQ,
+    'LE': SENSE_LT | SENSE_EQ,
+    'GE': SENSE_GT | SENSE_EQ,
+}
+OPERATORS = {
+    '<': SENSE_LT,
+    '>': SENSE_GT,
+    '=': SENSE_EQ,
+    '<=': SENSE_LT | SENSE_EQ,
+    '>=': SENSE_GT | SENSE_EQ,
+}
+
+def parse_evr(evr):
+    """ 'E:V-R' => (E or None, V, R or None) """
+    epoch = None
+    if ':' in evr:
+        epoch, evr = evr.split(':', 1)
+    release = None
+    if '-' in evr:
+        evr, release = evr.rsplit('-', 1)
+    return epoch, evr, release
+
+def _compare_evr(evr1, evr2):
+    """ compare two (epoch, version, release), ignoring the release when one of them has none """
+    epoch1, version1, release1 = evr1
+    epoch2, version2, release2 = evr2
+    key1 = [evrkey.version_key(epoch1 or '0'), evrkey.version_key(version1)]
+    key2 = [evrkey.version_key(epoch2 or '0'), evrkey.version_key(version2)]
+    if release1 is not None and release2 is not None:
+        key1.append(evrkey.version_key(release1))
+        key2.append(evrkey.version_key(release2))
+    return (key1 > key2) - (key1 < key2)
+
+def overlaps(provide_flags, provide_evr, require_flags, require_evr):
+    """ whether a provide satisfies a requirement on the same name, as rpmdsCompare does it """
+    if not provide_flags or not require_flags:
+        return True
+    sense = _compare_evr(provide_evr, require_evr)
+    if sense < 0:
+        return bool(provide_flags & SENSE_GT or require_flags & SENSE_LT)
+    if sense > 0:
+        return bool(provide_flags & SENSE_LT or require_flags & SENSE_GT)
+    return bool(provide_flags & require_flags & (SENSE_EQ | SENSE_LT | SENSE_GT))
+
+class Package(object):
+    __slots__ = ['name', 'arch', 'epoch', 'version', 'release', 'sourcerpm', 'requires', 'nvra', 'key']
+
+    def __init__(self, pkg):
+        self.name = pkg['name']
+        self.arch = pkg['arch']
+        self.epoch = pkg['epoch']
+        self.version = pkg['version']
+        self.release = pkg['release']
+        self.sourcerpm = pkg['sourcerpm']
+        self.requires = [(name, FLAGS[flags], (epoch, version, release))
+                         for name, flags, epoch, version, release in pkg['requires']
+                         if not name.startswith('rpmlib(')]
+        self.nvra = '%s-%s-%s.%s' % (self.name, self.version, self.release, self.arch)
+        self.key = evrkey.evr_key(self.epoch, self.version, self.release)
+
+class InstalledPackages(object):
+    """ provides and files of the packages installed in an install root """
+    def __init__(self, provides=None, files=None):
+        # {name: [(flags, evr)]}
+        self.provides = provides or {}
+        self.files = files or set()
+
+    def satisfies(self, name, flags, evr):
+        if name.startswith('/') and name in self.files:
+            return True
+        for provide_flags, provide_evr in self.provides.get(name, []):
+            if overlaps(provide_flags, provide_evr, flags, evr):
+                return True
+        return False
+
+def read_installed(install_root):
+    """ InstalledPackages for the RPM database of install_root """
+    output = subprocess.check_output(['rpm', '--root', install_root, '-qa', '--qf', '[%{PROVIDENEVRS}\n]'])
+    provides = {}
+    for line in output.decode('utf-8').splitlines():
+        fields = line.split()
+        if len(fields) == 3:
+            provides.setdefault(fields[0], []).append((OPERATORS[fields[1]], parse_evr(fields[2])))
+        elif fields:
+            provides.setdefault(fields[0], []).append((0, (None, None, None)))
+    output = subprocess.check_output(['rpm', '--root', install_root, '-qa', '--qf', '[%{FILENAMES}\n]'])
+    return InstalledPackages(provides, set(output.decode('utf-8').splitlines()))
+
+class DepSolver(object):
+    """
+    Index of the provides of all packages of a repository, used to compute runtime closures.
+    """
+    def __init__(self, repo_dir, installed=None):
+        if not repodata.has_repodata(repo_dir):
+            raise Exception("No repodata in %s, run createrepo_c on it first" % repo_dir)
+        self.repo_dir = repo_dir
+        self.installed = installed or InstalledPackages()
+        self.packages_by_nvra = {}
+        self.packages_by_name = {}
+        # {provide name: [(flags, evr, package)]}
+        self.provides = {}
+        # {file path: [package]}
+        self.files = {}
+        self.filelists_loaded = False
+        # built on demand by get_runtime_deps_from_graph()
+        self.graph = None
+
+        for pkg in repodata.iter_primary(repo_dir, with_deps=True):
+            if pkg['arch'] == 'src':
+                continue
+            package = Package(pkg)
+            self.packages_by_nvra[package.nvra] = package
+            self.packages_by_name.setdefault(package.name, []).append(package)
+            for name, flags, epoch, version, release in pkg['provides']:
+                self.provides.setdefault(name, []).append((FLAGS[flags], (epoch, version, release), package))
+            for filepath in pkg['files']:
+                self.files.setdefault(filepath, []).append(package)
+
+    def _load_filelists(self):
+        packages_by_nevra = dict(((p.name, p.arch, p.epoch, p.version, p.release), p)
+                                 for p in self.packages_by_nvra.values())
+        self.files = {}
+        for name, arch, epoch, version, release, files in repodata.iter_filelists(self.repo_dir):
+            package = packages_by_nevra.get((name, arch, epoch, version, release))
+            if package is None:
+                continue
+            for filepath in files:
+                self.files.setdefault(filepath, []).append(package)
+        self.filelists_loaded = True
+
+    def what_provides(self, name, flags, evr):
+        """ list of the packages of the repository that satisfy the requirement """
+        if name.startswith('/'):
+            if name not in self.files and not self.filelists_loaded:
+                self._load_filelists()
+            providers = list(self.files.get(name, []))
+        else:
+            providers = []
+        for provide_flags, provide_evr, package in self.provides.get(name, []):
+            if overlaps(provide_flags, provide_evr, flags, evr):
+                providers.append(package)
+        return providers
+
+    def best_provider(self, providers, name, requiring_package):
+        # only keep the newest version of each name.arch
+        newest = {}
+        for package in providers:
+            current = newest.get((package.name, package.arch))
+            if current is None or package.key > current.key:
+                newest[(package.name, package.arch)] = package
+
+        def common_prefix_length(package):
+            length = 0
+            for c1, c2 in zip(package.name, requiring_package.name):
+                if c1 != c2:
+                    break
+                length += 1
+            return length
+
+        return min(newest.values(), key=lambda package: (
+            package.arch != requiring_package.arch,
+            package.arch != 'noarch',
+            package.arch != BEST_ARCH,
+            package.name != name,
+            package.sourcerpm != requiring_package.sourcerpm,
+            -common_prefix_length(package),
+            len(package.name),
+            package.name,
+            package.arch))
+
+    def latest(self, name):
+        """ newest package with that name, or None """
+        packages = self.packages_by_name.get(name)
+        if not packages:
+            return None
+        return max(packages, key=lambda package: package.key)
+
+    def get_all_runtime_deps(self, name, include_self=False, installed=None):
+        """
+        Same as rpmwatcher_extract_deps.get_all_runtime_deps() with yumdownloader:
+        name can be either a "short" rpm package name ("n") or the full "nvra".
+        installed replaces the packages of the install root for this resolution only.
+        returns (installable, sorted list of the NVRAs of the packages to install)
+        When not installable, the list contains the packages that could be resolved.
+        """
+        package = self.packages_by_nvra.get(name) or self.latest(name)
+        if package is None:
+            return False, []
+        if installed is None:
+            installed = self.installed
+        installable = True
+        selected = set([package])
+        to_process = deque([package])
+        while to_process:
+            current = to_process.popleft()
+            for req_name, req_flags, req_evr in current.requires:
+                if installed.satisfies(req_name, req_flags, req_evr):
+                    continue
+                providers = self.what_provides(req_name, req_flags, req_evr)
+                if not providers:
+                    installable = False
+                    continue
+                if selected.intersection(providers):
+                    continue
+                provider = self.best_provider(providers, req_name, current)
+                selected.add(provider)
+                to_process.append(provider)
+        if not include_self:
+            selected.remove(package)
+        deps = sorted(p.nvra for p in selected)
+        if include_self:
+            # yumdownloader lists the requested package first
+            deps.remove(package.nvra)
+            deps.insert(0, package.nvra)
+        return installable, deps
+
+    def direct_deps(self, package):
+        """ returns (whether all requirements can be satisfied, packages that package directly pulls) """
+        resolvable = True
+        deps = set()
+        for req_name, req_flags, req_evr in package.requires:
+            if self.installed.satisfies(req_name, req_flags, req_evr):
+                continue
+            providers = self.what_provides(req_name, req_flags, req_evr)
+            if not providers:
+                resolvable = False
+                continue
+            if package in providers:
+                continue
+            deps.add(self.best_provider(providers, req_name, package))
+        return resolvable, deps
+
+    def _build_graph(self):
+        packages = sorted(self.packages_by_nvra.values(), key=lambda package: package.nvra)
+        index = dict((package, i) for i, package in enumerate(packages))
+        deps = []
+        broken = []
+        for package in packages:
+            resolvable, direct_deps = self.direct_deps(package)
+            deps.append(sorted(index[dep] for dep in direct_deps))
+            broken.append(not resolvable)
+        self.graph = (packages, index, depgraph.Closures(deps, broken))
+
+    def get_runtime_deps_from_graph(self, name, include_self=False):
+        """ same as get_all_runtime_deps, from the closures of the whole dependency graph """
+        package = self.packages_by_nvra.get(name) or self.latest(name)
+        if package is None:
+            return False, []
+        if self.graph is None:
+            self._build_graph()
+        packages, index, closures = self.graph
+        i = index[package]
+        deps = [packages[node].nvra for node in closures.closure(i) if node != i]
+        if include_self:
+            deps.insert(0, package.nvra)
+        return not closures.is_broken(i), deps
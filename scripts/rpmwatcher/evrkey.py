@@ -0,0 +1,295 @@
+#!/bin/env python
+
+"""
+Sortable keys for RPM (epoch, version, release) tuples.
+
+evr_key() converts an EVR once into a tuple of tuples that compares exactly the way
+rpm.labelCompare (i.e. rpmvercmp) would compare the EVRs, including '~' and '^'.
+This lets us use max() and sorted() with key= instead of calling labelCompare pairwise
+through a cmp function. Keys for version strings are memoized in a bounded LRU cache.
+
+When run as a script, checks evr_key() against the expected results of KNOWN_COMPARISONS,
+which needs no rpm bindings. With files (e.g. data/*_rpm_sourcerpm-*.txt), also compares
+evr_key() with rpm.labelCompare() on the NVRs they list. Reports any difference.
+"""
+
+from __future__ import print_function
+
+import argparse
+import re
+import sys
+from collections import OrderedDict
+
+try:
+    from functools import lru_cache
+except ImportError:
+    # python 2
+    lru_cache = None
+
+# Max number of version strings whose key we keep in cache
+CACHE_SIZE = 65536
+
+# rpmvercmp only considers ASCII alphanumeric segments, '~' and '^'. Anything else is a separator.
+SEGMENT_RE = re.compile(r'[A-Za-z]+|[0-9]+|~|\^')
+
+# Ranks of the segments in a key. At the same position:
+# - '~' sorts before anything, even the end of the string
+# - '^' sorts after the end of the string, but before anything else
+# - numeric segments sort after alphabetic segments
+RANK_TILDE = 0
+RANK_END = 1
+RANK_CARET = 2
+RANK_ALPHA = 3
+RANK_NUMERIC = 4
+
+def _version_key(version):
+    key = []
+    for segment in SEGMENT_RE.findall(version):
+        if segment == '~':
+            key.append((RANK_TILDE,))
+        elif segment == '^':
+            key.append((RANK_CARET,))
+        elif segment.isdigit():
+            key.append((RANK_NUMERIC, int(segment)))
+        else:
+            key.append((RANK_ALPHA, segment))
+    key.append((RANK_END,))
+    return tuple(key)
+
+def _memoize(func, maxsize):
+    if lru_cache is not None:
+        return lru_cache(maxsize=maxsize)(func)
+
+    cache = OrderedDict()
+
+    def wrapper(arg):
+        try:
+            value = cache.pop(arg)
+        except KeyError:
+            value = func(arg)
+            if len(cache) >= maxsize:
+                cache.popitem(last=False)
+        cache[arg] = value
+        return value
+    return wrapper
+
+_cached_version_key = _memoize(_version_key, CACHE_SIZE)
+
+def version_key(version):
+    """ key for a version or release string, compares like rpmvercmp """
+    if version is None:
+        # labelCompare considers a missing value older than anything
+        return ()
+    return _cached_version_key(version)
+
+def evr_key(epoch, version, release):
+    """ key for an EVR, compares like rpm.labelCompare((epoch, version, release), ...) """
+    # labelCompare treats a missing epoch as epoch 0
+    return (version_key('0' if epoch is None else str(epoch)), version_key(version), version_key(release))
+
+def evr_tuple_key(evr):
+    """ same as evr_key, for use as key= on (epoch, version, release) tuples """
+    return evr_key(*evr)
+
+def compare(evr1, evr2):
+    """ same as rpm.labelCompare(evr1, evr2) """
+    key1 = evr_tuple_key(evr1)
+    key2 = evr_tuple_key(evr2)
+    return (key1 > key2) - (key1 < key2)
+
+# (version1, version2, rpmvercmp(version1, version2)), mostly from the test cases of rpm (tests/rpmvercmp.at)
+KNOWN_COMPARISONS = [
+    ('1.0', '1.0', 0),
+    ('1.0', '2.0', -1),
+    ('2.0', '1.0', 1),
+    ('2.0.1', '2.0.1', 0),
+    ('2.0', '2.0.1', -1),
+    ('2.0.1', '2.0', 1),
+    ('2.0.1a', '2.0.1a', 0),
+    ('2.0.1a', '2.0.1', 1),
+    ('2.0.1', '2.0.1a', -1),
+    ('5.5p1', '5.5p1', 0),
+    ('5.5p1', '5.5p2', -1),
+    ('5.5p2', '5.5p1', 1),
+    ('5.5p10', '5.5p10', 0),
+    ('5.5p1', '5.5p10', -1),
+    ('5.5p10', '5.5p1', 1),
+    ('10xyz', '10.1xyz', -1),
+    ('10.1xyz', '10xyz', 1),
+    ('xyz10', 'xyz10', 0),
+    ('xyz10', 'xyz10.1', -1),
+    ('xyz10.1', 'xyz10', 1),
+    ('xyz.4', 'xyz.4', 0),
+    ('xyz.4', '8', -1),
+    ('8', 'xyz.4', 1),
+    ('xyz.4', '2', -1),
+    ('2', 'xyz.4', 1),
+    ('5.5p2', '5.6p1', -1),
+    ('5.6p1', '5.5p2', 1),
+    ('5.6p1', '6.5p1', -1),
+    ('6.5p1', '5.6p1', 1),
+    ('6.0.rc1', '6.0', 1),
+    ('6.0', '6.0.rc1', -1),
+    ('10b2', '10a1', 1),
+    ('10a2', '10b2', -1),
+    ('1.0aa', '1.0aa', 0),
+    ('1.0a', '1.0aa', -1),
+    ('1.0aa', '1.0a', 1),
+    ('1.0a', '1.0.1', -1),
+    # leading zeros
+    ('10.0001', '10.0001', 0),
+    ('10.0001', '10.1', 0),
+    ('10.1', '10.0001', 0),
+    ('10.0001', '10.0039', -1),
+    ('10.0039', '10.0001', 1),
+    ('4.999.9', '5.0', -1),
+    ('5.0', '4.999.9', 1),
+    ('20101121', '20101121', 0),
+    ('20101121', '20101122', -1),
+    ('20101122', '20101121', 1),
+    # separators
+    ('2_0', '2_0', 0),
+    ('2.0', '2_0', 0),
+    ('2_0', '2.0', 0),
+    ('a', 'a', 0),
+    ('a+', 'a+', 0),
+    ('a+', 'a_', 0),
+    ('a_', 'a+', 0),
+    ('+a', '+a', 0),
+    ('+a', '_a', 0),
+    ('_a', '+a', 0),
+    ('+_', '+_', 0),
+    ('_+', '+_', 0),
+    ('_+', '_', 0),
+    ('+', '_', 0),
+    # tilde
+    ('1.0~rc1', '1.0~rc1', 0),
+    ('1.0~rc1', '1.0', -1),
+    ('1.0', '1.0~rc1', 1),
+    ('1.0~rc1', '1.0~rc2', -1),
+    ('1.0~rc2', '1.0~rc1', 1),
+    ('1.0~rc1~git123', '1.0~rc1~git123', 0),
+    ('1.0~rc1~git123', '1.0~rc1', -1),
+    ('1.0~rc1', '1.0~rc1~git123', 1),
+    # caret
+    ('1.0^', '1.0^', 0),
+    ('1.0^', '1.0', 1),
+    ('1.0', '1.0^', -1),
+    ('1.0^git1', '1.0^git1', 0),
+    ('1.0^git1', '1.0', 1),
+    ('1.0', '1.0^git1', -1),
+    ('1.0^git1', '1.0^git2', -1),
+    ('1.0^git2', '1.0^git1', 1),
+    ('1.0^git1', '1.01', -1),
+    ('1.01', '1.0^git1', 1),
+    ('1.0^20160101', '1.0^20160101', 0),
+    ('1.0^20160101', '1.0.1', -1),
+    ('1.0.1', '1.0^20160101', 1),
+    ('1.0^20160101^git1', '1.0^20160101^git1', 0),
+    ('1.0^20160102', '1.0^20160101^git1', 1),
+    ('1.0^20160101^git1', '1.0^20160102', -1),
+    # tilde and caret
+    ('1.0~rc1^git1', '1.0~rc1^git1', 0),
+    ('1.0~rc1^git1', '1.0~rc1', 1),
+    ('1.0~rc1', '1.0~rc1^git1', -1),
+    ('1.0^git1~pre', '1.0^git1~pre', 0),
+    ('1.0^git1', '1.0^git1~pre', 1),
+    ('1.0^git1~pre', '1.0^git1', -1),
+]
+
+# (evr1, evr2, rpm.labelCompare(evr1, evr2)), for epochs and missing values
+KNOWN_EVR_COMPARISONS = [
+    ((None, '1.0', '1'), ('0', '1.0', '1'), 0),
+    (('1', '1.0', '1'), ('0', '2.0', '1'), 1),
+    (('1', '1.0', '1'), (None, '2.0', '1'), 1),
+    (('0', '2.0', '1'), ('1', '1.0', '1'), -1),
+    (('2', '1.0', '1'), ('10', '1.0', '1'), -1),
+    (('01', '1.0', '1'), ('1', '1.0', '1'), 0),
+    (('0', '1.0', '2'), ('0', '1.0', '10'), -1),
+    (('0', '1.0', '1.el7'), ('0', '1.0', '1.el7_9'), -1),
+    (('0', '1.0', None), ('0', '1.0', '1'), -1),
+    (('0', '1.0', '1'), ('0', '1.0', None), 1),
+    (('0', None, None), ('0', None, None), 0),
+]
+
+def check_known_comparisons():
+    """
+    Compare the results of evr_key with the expected ones of KNOWN_COMPARISONS, as versions and as releases,
+    and of KNOWN_EVR_COMPARISONS. returns the number of mismatches
+    """
+    cases = []
+    for version1, version2, expected in KNOWN_COMPARISONS:
+        cases.append((('0', version1, '1'), ('0', version2, '1'), expected))
+        cases.append((('0', '1', version1), ('0', '1', version2), expected))
+    cases.extend(KNOWN_EVR_COMPARISONS)
+
+    mismatches = 0
+    for evr1, evr2, expected in cases:
+        if compare(evr1, evr2) != expected:
+            mismatches += 1
+            print("Mismatch: %s vs %s, expected %d" % (evr1, evr2, expected))
+    print("%d known comparisons, %d mismatches" % (len(cases), mismatches))
+    return mismatches
+
+def parse_nvra_filename(filename):
+    """ returns (name, version, release) from a name-version-release.arch.rpm filename """
+    nvr = filename[:-len('.rpm')].rsplit('.', 1)[0]
+    name, version, release = nvr.rsplit('-', 2)
+    return name, version, release
+
+def check_against_labelcompare(filepaths):
+    """
+    Compare the results of evr_key with those of rpm.labelCompare on the NVRs found in filepaths.
+
+    Each line of the files is a comma-separated list of RPM filenames.
+    All pairs of EVRs for a given package name are compared, and the sort order of all EVRs is checked.
+    returns the number of mismatches
+    """
+    import rpm
+
+    evrs_by_name = {}
+    for filepath in filepaths:
+        with open(filepath) as f:
+            for line in f:
+                for filename in line.strip().split(','):
+                    if not filename.endswith('.rpm'):
+                        continue
+                    name, version, release = parse_nvra_filename(filename)
+                    evrs_by_name.setdefault(name, set()).add((None, version, release))
+
+    mismatches = 0
+    comparisons = 0
+    for name in sorted(evrs_by_name):
+        evrs = sorted(evrs_by_name[name])
+        for i, evr1 in enumerate(evrs):
+            for evr2 in evrs[i:]:
+                comparisons += 1
+                expected = rpm.labelCompare(evr1, evr2)
+                if compare(evr1, evr2) != expected:
+                    mismatches += 1
+                    print("Mismatch for %s: %s vs %s, labelCompare says %d" % (name, evr1, evr2, expected))
+
+    all_evrs = sorted(set(evr for evrs in evrs_by_name.values() for evr in evrs), key=evr_tuple_key)
+    for evr1, evr2 in zip(all_evrs, all_evrs[1:]):
+        comparisons += 1
+        if rpm.labelCompare(evr1, evr2) > 0:
+            mismatches += 1
+            print("Sort mismatch: %s sorted before %s" % (evr1, evr2))
+
+    print("%d comparisons, %d mismatches" % (comparisons, mismatches))
+    return mismatches
+
+def main():
+    parser = argparse.ArgumentParser(description='Check EVR keys against known results and rpm.labelCompare')
+    parser.add_argument('files', nargs='*',
+                        help='files listing RPM filenames, e.g. data/*_rpm_sourcerpm-*.txt, to compare with '
+                             'rpm.labelCompare, which needs the rpm bindings')
+    args = parser.parse_args()
+    mismatches = check_known_comparisons()
+    if args.files:
+        mismatches += check_against_labelcompare(args.files)
+    if mismatches:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
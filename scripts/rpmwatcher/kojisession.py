@@ -0,0 +1,180 @@
+#!/bin/env python
+
+"""
+Query koji through its XML-RPC API rather than the koji CLI.
+
+A single ClientSession is opened for the whole run, and independent queries can be
+batched into one request with session.multicall(), which avoids paying the CLI startup
+and SSL handshake for every query.
+
+The hub URL can be overridden, e.g. to point at a local fake hub for testing.
+StubSession is an in-process stand-in for a ClientSession, which needs neither a hub nor
+the koji module. When run as a script, checks the koji queries of rpmwatcher_update.py
+against it: the filtering of the tags, the results, and that they take two requests.
+"""
+
+from __future__ import print_function
+
+import fnmatch
+import sys
+
+
+def open_session(profile='koji', server=None):
+    """ open a session using the koji configuration for profile, e.g. from ~/.koji/config """
+    import koji
+
+    config = koji.read_config(profile)
+    return koji.ClientSession(server or config['server'], koji.grab_session_options(config))
+
+def list_tags(session, pattern):
+    """ same as koji list-tags PATTERN """
+    return sorted(tag['name'] for tag in session.listTags() if fnmatch.fnmatch(tag['name'], pattern))
+
+def tagged_nvrs(tagged_builds):
+    """ sorted build NVRs from the result of listTagged, as listed by koji list-tagged """
+    return sorted(build['nvr'] for build in tagged_builds)
+
+def group_packages(tag_groups, group_name):
+    """ package names of a group from the result of getTagGroups, as listed by koji list-groups """
+    for group in tag_groups:
+        if group['name'] == group_name:
+            return sorted(pkg['package'] for pkg in group['packagelist'])
+    raise Exception("Group %s not found" % group_name)
+
+class StubVirtualCall(object):
+    """ call made within a StubSession multicall, its result is available once the multicall is sent """
+    def __init__(self, method, args, kwargs):
+        self.method = method
+        self.args = args
+        self.kwargs = kwargs
+        self.done = False
+        self.value = None
+
+    @property
+    def result(self):
+        if not self.done:
+            raise Exception("The multicall including %s hasn't been sent yet" % self.method)
+        return self.value
+
+class StubMulticall(object):
+    """ records the calls, then runs them all in one request when the with block ends """
+    def __init__(self, session, strict):
+        self.session = session
+        self.strict = strict
+        self.calls = []
+
+    def __getattr__(self, method):
+        def call(*args, **kwargs):
+            virtual_call = StubVirtualCall(method, args, kwargs)
+            self.calls.append(virtual_call)
+            return virtual_call
+        return call
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            return False
+        self.session.requests += 1
+        for virtual_call in self.calls:
+            try:
+                virtual_call.value = self.session.run(virtual_call.method, virtual_call.args, virtual_call.kwargs)
+            except Exception as e:
+                if self.strict:
+                    raise
+                # what koji gives for a failed call of a non-strict multicall
+                virtual_call.value = {'faultCode': 1000, 'faultString': str(e)}
+            virtual_call.done = True
+        return False
+
+class StubSession(object):
+    """
+    Answers listTags, listTagged and getTagGroups, directly or within multicall(), from:
+    - tags: {tag name: [build dicts with at least 'nvr' and 'name', newest first]}
+    - groups: {tag name: [group dicts, as returned by getTagGroups]}
+    requests counts the requests a ClientSession would have sent: one per direct call, one per multicall.
+    """
+    def __init__(self, tags, groups):
+        self.tags = tags
+        self.groups = groups
+        self.requests = 0
+
+    def run(self, method, args, kwargs):
+        if method == 'listTags':
+            return [{'name': name} for name in sorted(self.tags)]
+        if method == 'listTagged':
+            return self.list_tagged(*args, **kwargs)
+        if method == 'getTagGroups':
+            return self.groups.get(args[0], [])
+        raise Exception("Method %s not supported by StubSession" % method)
+
+    def list_tagged(self, tag, latest=False):
+        if tag not in self.tags:
+            raise Exception("No such tag: %s" % tag)
+        builds = []
+        names = set()
+        for build in self.tags[tag]:
+            if latest and build['name'] in names:
+                continue
+            names.add(build['name'])
+            builds.append(dict(build))
+        return builds
+
+    def multicall(self, strict=False):
+        return StubMulticall(self, strict)
+
+    def __getattr__(self, method):
+        def call(*args, **kwargs):
+            self.requests += 1
+            return self.run(method, args, kwargs)
+        return call
+
+def check_update_queries():
+    """ check rpmwatcher_update.query_koji() against a StubSession, returns the number of failures """
+    import rpmwatcher_update
+
+    def build(nvr):
+        return {'nvr': nvr, 'name': nvr.rsplit('-', 2)[0]}
+
+    tags = {
+        'v8.2-base': [build('b-1.0-2'), build('b-1.0-1'), build('a-1.0-1')],
+        'v8.2-updates': [build('c-2.0-1')],
+        'v8.2-testing': [],
+        'v8.2-incoming': [build('d-1.0-1')],
+        'v8.3-base': [build('e-1.0-1')],
+        'xs8.2-base': [build('f-1.0-1')],
+        'built-by-centos': [build('a-1.0-1')],
+        'built-by-epel': [],
+        'built-by-xs': [build('b-1.0-1')],
+        'built-by-xcp-ng': [build('c-2.0-1'), build('b-1.0-2')],
+    }
+    groups = {
+        'V8.2': [{'name': 'build', 'packagelist': [{'package': 'x'}]},
+                 {'name': 'installable_extras', 'packagelist': [{'package': 'c'}, {'package': 'a'}]}],
+    }
+    session = StubSession(tags, groups)
+    built_by, tagged_builds, extra_rpms = rpmwatcher_update.query_koji(session, '8.2')
+
+    checks = [
+        ('tags matching v8.2*, main tags only, in MAIN_TAGS order', [tag for tag, _ in tagged_builds],
+         ['v8.2-base', 'v8.2-updates', 'v8.2-testing']),
+        ('latest builds of each tag', tagged_builds,
+         [('v8.2-base', ['a-1.0-1', 'b-1.0-2']), ('v8.2-updates', ['c-2.0-1']), ('v8.2-testing', [])]),
+        ('builds of the built-by-* tags', built_by,
+         {'centos': ['a-1.0-1'], 'epel': [], 'xs': ['b-1.0-1'], 'xcp-ng': ['b-1.0-2', 'c-2.0-1']}),
+        ('extra installable packages', extra_rpms, ['a', 'c']),
+        ('requests: listTags, then one multicall', session.requests, 2),
+        ('list_tags with a pattern', list_tags(session, 'v8.?-base'), ['v8.2-base', 'v8.3-base']),
+    ]
+    failures = 0
+    for description, value, expected in checks:
+        if value != expected:
+            failures += 1
+            print("Mismatch for %s: %s, expected %s" % (description, value, expected))
+    print("%d checks, %d failures" % (len(checks), failures))
+    return failures
+
+if __name__ == "__main__":
+    if check_update_queries():
+        sys.exit(1)
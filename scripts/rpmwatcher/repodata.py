@@ -0,0 +1,207 @@
+"""
+Read package metadata from the repodata produced by createrepo / createrepo_c.
+
+Reading the metadata for a whole repository at once is much faster than querying
+every RPM file with rpm -qp, so this is what we use whenever repodata is available.
+
+Both the XML flavour (primary.xml, optionally compressed) and the SQLite flavour
+(primary.sqlite, optionally compressed) of the primary metadata are supported.
+The XML is parsed in a streaming fashion so that memory usage stays low even for
+large repositories such as CentOS or EPEL.
+
+Dependency information (provides, requires and files) is only read when asked for,
+see iter_primary(repo_dir, with_deps=True) and iter_filelists().
+"""
+
+import bz2
+import gzip
+import os
+import shutil
+import sqlite3
+import tempfile
+import xml.etree.ElementTree as ET
+
+try:
+    import lzma
+except ImportError:
+    # python 2
+    lzma = None
+
+NS_REPO = '{http://linux.duke.edu/metadata/repo}'
+NS_COMMON = '{http://linux.duke.edu/metadata/common}'
+NS_RPM = '{http://linux.duke.edu/metadata/rpm}'
+NS_FILELISTS = '{http://linux.duke.edu/metadata/filelists}'
+
+def has_repodata(repo_dir):
+    return os.path.exists(os.path.join(repo_dir, 'repodata', 'repomd.xml'))
+
+def get_metadata_locations(repo_dir):
+    """ returns a dict {data type: absolute path} read from repodata/repomd.xml """
+    locations = {}
+    tree = ET.parse(os.path.join(repo_dir, 'repodata', 'repomd.xml'))
+    for data in tree.getroot().findall(NS_REPO + 'data'):
+        location = data.find(NS_REPO + 'location')
+        if location is not None:
+            locations[data.get('type')] = os.path.join(repo_dir, location.get('href'))
+    return locations
+
+def open_compressed(filepath):
+    if filepath.endswith('.gz'):
+        return gzip.open(filepath, 'rb')
+    if filepath.endswith('.bz2'):
+        return bz2.BZ2File(filepath, 'rb')
+    if filepath.endswith('.xz'):
+        if lzma is None:
+            raise Exception("Can't read %s: xz compression is not supported by this python version" % filepath)
+        return lzma.open(filepath, 'rb')
+    return open(filepath, 'rb')
+
+def _xml_entries(fmt, tag):
+    """ (name, flags, epoch, version, release) for each rpm:entry of the rpm:provides / rpm:requires element """
+    entries = []
+    elem = fmt.find(NS_RPM + tag)
+    if elem is not None:
+        for entry in elem.findall(NS_RPM + 'entry'):
+            entries.append((entry.get('name'), entry.get('flags'), entry.get('epoch'), entry.get('ver'),
+                            entry.get('rel')))
+    return entries
+
+def iter_primary_xml(filepath, with_deps=False):
+    """
+    Stream packages from a primary.xml file.
+
+    Each package element is cleared once processed, so that the whole document never sits in memory.
+    """
+    f = open_compressed(filepath)
+    try:
+        context = ET.iterparse(f, events=('start', 'end'))
+        _, root = next(context)
+        for event, elem in context:
+            if event != 'end' or elem.tag != NS_COMMON + 'package':
+                continue
+            version = elem.find(NS_COMMON + 'version')
+            fmt = elem.find(NS_COMMON + 'format')
+            pkg = {
+                'name': elem.findtext(NS_COMMON + 'name'),
+                'arch': elem.findtext(NS_COMMON + 'arch'),
+                'epoch': version.get('epoch'),
+                'version': version.get('ver'),
+                'release': version.get('rel'),
+                'summary': elem.findtext(NS_COMMON + 'summary') or '',
+                'vendor': fmt.findtext(NS_RPM + 'vendor') or '',
+                'sourcerpm': fmt.findtext(NS_RPM + 'sourcerpm') or '',
+                'location': elem.find(NS_COMMON + 'location').get('href'),
+                'size': int(elem.find(NS_COMMON + 'size').get('package')),
+            }
+            if with_deps:
+                pkg['provides'] = _xml_entries(fmt, 'provides')
+                pkg['requires'] = _xml_entries(fmt, 'requires')
+                pkg['files'] = [file_elem.text for file_elem in fmt.findall(NS_COMMON + 'file')]
+            yield pkg
+            root.clear()
+    finally:
+        f.close()
+
+def _sqlite_entries(conn, table):
+    """ {pkgKey: [(name, flags, epoch, version, release)]} from the provides or requires table """
+    entries = {}
+    for row in conn.execute('SELECT pkgKey, name, flags, epoch, version, release FROM %s' % table):
+        entries.setdefault(row[0], []).append(tuple(row[1:]))
+    return entries
+
+def iter_primary_sqlite(filepath, with_deps=False):
+    """ Read packages from a primary.sqlite database, decompressing it first if needed """
+    tmpdir = None
+    try:
+        if filepath.endswith('.sqlite'):
+            dbpath = filepath
+        else:
+            tmpdir = tempfile.mkdtemp()
+            dbpath = os.path.join(tmpdir, 'primary.sqlite')
+            src = open_compressed(filepath)
+            try:
+                with open(dbpath, 'wb') as dst:
+                    shutil.copyfileobj(src, dst)
+            finally:
+                src.close()
+        conn = sqlite3.connect(dbpath)
+        try:
+            if with_deps:
+                provides = _sqlite_entries(conn, 'provides')
+                requires = _sqlite_entries(conn, 'requires')
+                files = {}
+                for pkg_key, name in conn.execute('SELECT pkgKey, name FROM files'):
+                    files.setdefault(pkg_key, []).append(name)
+            cursor = conn.execute('SELECT name, arch, epoch, version, release, summary, rpm_vendor, rpm_sourcerpm, '
+                                  'location_href, size_package, pkgKey FROM packages')
+            for row in cursor:
+                pkg = {
+                    'name': row[0],
+                    'arch': row[1],
+                    'epoch': row[2],
+                    'version': row[3],
+                    'release': row[4],
+                    'summary': row[5] or '',
+                    'vendor': row[6] or '',
+                    'sourcerpm': row[7] or '',
+                    'location': row[8],
+                    'size': row[9],
+                }
+                if with_deps:
+                    pkg['provides'] = provides.get(row[10], [])
+                    pkg['requires'] = requires.get(row[10], [])
+                    pkg['files'] = files.get(row[10], [])
+                yield pkg
+        finally:
+            conn.close()
+    finally:
+        if tmpdir is not None:
+            shutil.rmtree(tmpdir)
+
+def iter_primary(repo_dir, with_deps=False):
+    """
+    Yield a dict for each package listed in the primary metadata of repo_dir.
+
+    The SQLite database is preferred when present since it avoids XML parsing altogether.
+    With with_deps, the dicts also contain:
+    - provides and requires: lists of (name, flags, epoch, version, release), flags being e.g. 'GE' or None
+    - files: the files listed in the primary metadata, which is only a subset of the files of the package
+    """
+    locations = get_metadata_locations(repo_dir)
+    if 'primary_db' in locations:
+        return iter_primary_sqlite(locations['primary_db'], with_deps)
+    if 'primary' in locations:
+        return iter_primary_xml(locations['primary'], with_deps)
+    raise Exception("No primary metadata found in %s" % os.path.join(repo_dir, 'repodata'))
+
+def get_packages_by_filename(repo_dir):
+    """ returns a dict {RPM filename: package metadata}, or {} if repo_dir has no repodata """
+    if not has_repodata(repo_dir):
+        return {}
+    packages = {}
+    for pkg in iter_primary(repo_dir):
+        packages[os.path.basename(pkg['location'])] = pkg
+    return packages
+
+def iter_filelists(repo_dir):
+    """
+    Stream (name, arch, epoch, version, release, files) for each package from filelists.xml.
+
+    Only needed for file dependencies on files that are not listed in the primary metadata.
+    """
+    locations = get_metadata_locations(repo_dir)
+    if 'filelists' not in locations:
+        raise Exception("No filelists metadata found in %s" % os.path.join(repo_dir, 'repodata'))
+    f = open_compressed(locations['filelists'])
+    try:
+        context = ET.iterparse(f, events=('start', 'end'))
+        _, root = next(context)
+        for event, elem in context:
+            if event != 'end' or elem.tag != NS_FILELISTS + 'package':
+                continue
+            version = elem.find(NS_FILELISTS + 'version')
+            yield (elem.get('name'), elem.get('arch'), version.get('epoch'), version.get('ver'), version.get('rel'),
+                   [file_elem.text for file_elem in elem.findall(NS_FILELISTS + 'file')])
+            root.clear()
+    finally:
+        f.close()
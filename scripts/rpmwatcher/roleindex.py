@@ -0,0 +1,73 @@
+"""
+Persistent index of why each RPM has each of its roles, written by rpmwatcher_extract_roles.py.
+
+When an RPM is given a role, we record which RPM it got it from (the predecessor) and that RPM's
+own role. Following predecessors leads to an RPM whose role needs no other justification: a main
+or extra RPM, or an RPM with no roles for other_* roles. See rpmwatcher_why.py.
+
+Links are stored in a SQLite database indexed on (NVRA, role), so that explaining a role only
+takes one lookup per step of the chain, without loading the whole graph.
+"""
+
+import sqlite3
+
+# Bump when the format of the links changes
+INDEX_VERSION = 1
+INDEX_FILENAME = 'roles_index.sqlite'
+
+class RoleIndex(object):
+    """
+    Rows are (rpm_nvra, role, pred_nvra, pred_role, srpm_nvr):
+    - pred_nvra: the RPM the role comes from, None for main and extra RPMs
+    - pred_role: the role of pred_nvra which the role comes from, None if it has no roles
+    - srpm_nvr: for build dependency roles, the SRPM of pred_nvra that build-requires rpm_nvra
+    """
+    def __init__(self, dbpath):
+        self.conn = sqlite3.connect(dbpath)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS meta (version INTEGER)')
+        version = self.conn.execute('SELECT version FROM meta').fetchone()
+        if version is None or version[0] != INDEX_VERSION:
+            self.conn.execute('DROP TABLE IF EXISTS links')
+            self.conn.execute('DELETE FROM meta')
+            self.conn.execute('INSERT INTO meta (version) VALUES (?)', (INDEX_VERSION,))
+        self.conn.execute('CREATE TABLE IF NOT EXISTS links ('
+                          'rpm_nvra TEXT, role TEXT, pred_nvra TEXT, pred_role TEXT, srpm_nvr TEXT, '
+                          'PRIMARY KEY (rpm_nvra, role))')
+        self.conn.commit()
+
+    def is_empty(self):
+        return self.conn.execute('SELECT 1 FROM links LIMIT 1').fetchone() is None
+
+    def write(self, rows):
+        """ replace all the links """
+        self.conn.execute('DELETE FROM links')
+        self.conn.executemany('INSERT INTO links (rpm_nvra, role, pred_nvra, pred_role, srpm_nvr) '
+                              'VALUES (?, ?, ?, ?, ?)', rows)
+        self.conn.commit()
+
+    def read(self):
+        return self.conn.execute('SELECT rpm_nvra, role, pred_nvra, pred_role, srpm_nvr FROM links').fetchall()
+
+    def why(self, rpm_nvra, role):
+        """
+        Chain of links from (rpm_nvra, role) to an RPM whose role needs no other justification.
+        Returns an empty list if the RPM doesn't have this role.
+        """
+        chain = []
+        seen = set()
+        while rpm_nvra is not None and role is not None:
+            if (rpm_nvra, role) in seen:
+                raise Exception("Loop in the roles index at %s (%s)" % (rpm_nvra, role))
+            seen.add((rpm_nvra, role))
+            row = self.conn.execute('SELECT rpm_nvra, role, pred_nvra, pred_role, srpm_nvr FROM links '
+                                    'WHERE rpm_nvra = ? AND role = ?', (rpm_nvra, role)).fetchone()
+            if row is None:
+                if chain:
+                    raise Exception("Missing link in the roles index for %s (%s)" % (rpm_nvra, role))
+                break
+            chain.append(row)
+            rpm_nvra, role = row[2], row[3]
+        return chain
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,269 @@
+"""
+Read RPM headers in-process, with a persistent on-disk cache.
+
+Headers are read with the rpm python bindings when they are available, with signature
+and digest checks disabled since we only want metadata. Without the bindings, a small
+pure-python parser of the lead and header structures is used instead. Either way, this
+avoids forking rpm -qp for each package, which costs several milliseconds per file.
+
+Most RPMs in our mirrors don't change from one run to the next, so we also keep the
+header fields we use in a SQLite database, keyed on the path of the RPM and invalidated
+automatically when its size, mtime or inode change. On a second run over an unchanged
+mirror, this leaves only one stat() call per file.
+"""
+
+import json
+import multiprocessing
+import os
+import sqlite3
+import struct
+from collections import namedtuple
+
+try:
+    import rpm
+except ImportError:
+    rpm = None
+
+# Header fields we read and keep in cache
+HEADER_FIELDS = ['name', 'epoch', 'version', 'release', 'arch', 'vendor', 'summary', 'license', 'buildhost',
+                 'buildtime', 'sourcerpm']
+
+# Bump when the format of the cached records changes
+CACHE_VERSION = 2
+
+# How many new entries we accept before committing them to the cache database
+COMMIT_INTERVAL = 1000
+
+class RpmHeader(namedtuple('RpmHeader', HEADER_FIELDS)):
+    """
+    Header fields of a RPM.
+
+    epoch and buildtime are integers, the other fields are strings.
+    Fields missing from the header are None, e.g. epoch when the package has none,
+    or sourcerpm for source RPMs.
+    """
+    __slots__ = ()
+
+    @property
+    def nvr(self):
+        return '%s-%s-%s' % (self.name, self.version, self.release)
+
+    @property
+    def evr(self):
+        """ same as rpm's %{evr} """
+        vr = '%s-%s' % (self.version, self.release)
+        return vr if self.epoch is None else '%s:%s' % (self.epoch, vr)
+
+    @property
+    def is_source(self):
+        return self.sourcerpm is None
+
+def format_value(value):
+    """ format a header value the way rpm -qp --qf would """
+    return '(none)' if value is None else str(value)
+
+def _to_str(value):
+    """ convert text values to the native str type """
+    if isinstance(value, bytes) and not isinstance(value, str):
+        # python 3 with rpm bindings older than 4.15
+        return value.decode('utf-8', 'replace')
+    if isinstance(value, type(u'')) and not isinstance(value, str):
+        # python 2 unicode, e.g. loaded from JSON
+        return value.encode('utf-8')
+    return value
+
+# Pure-python header parsing
+# See https://rpm-software-management.github.io/rpm/manual/format.html
+LEAD_SIZE = 96
+LEAD_MAGIC = b'\xed\xab\xee\xdb'
+HEADER_MAGIC = b'\x8e\xad\xe8\x01'
+
+RPM_INT32_TYPE = 4
+RPM_STRING_TYPE = 6
+RPM_STRING_ARRAY_TYPE = 8
+RPM_I18NSTRING_TYPE = 9
+
+HEADER_TAGS = {
+    'name': 1000,
+    'version': 1001,
+    'release': 1002,
+    'epoch': 1003,
+    'summary': 1004,
+    'buildtime': 1006,
+    'buildhost': 1007,
+    'vendor': 1011,
+    'license': 1014,
+    'arch': 1022,
+    'sourcerpm': 1044,
+}
+
+def _read_header_structure(f, filepath):
+    """
+    Read the header at the current position of f.
+
+    returns ({tag: (type, offset, count)}, data store, size of the header structure)
+    """
+    intro = f.read(16)
+    if len(intro) != 16 or intro[:4] != HEADER_MAGIC:
+        raise Exception("Invalid RPM header in %s" % filepath)
+    index_length, data_length = struct.unpack('>II', intro[8:])
+    index = f.read(16 * index_length)
+    store = f.read(data_length)
+    if len(index) != 16 * index_length or len(store) != data_length:
+        raise Exception("Truncated RPM header in %s" % filepath)
+    entries = {}
+    for i in range(index_length):
+        tag, tag_type, offset, count = struct.unpack('>iIiI', index[16 * i:16 * (i + 1)])
+        entries[tag] = (tag_type, offset, count)
+    return entries, store, 16 + len(index) + data_length
+
+def _header_value(entries, store, tag):
+    if tag not in entries:
+        return None
+    tag_type, offset, count = entries[tag]
+    if tag_type == RPM_INT32_TYPE:
+        return struct.unpack('>i', store[offset:offset + 4])[0]
+    if tag_type in (RPM_STRING_TYPE, RPM_STRING_ARRAY_TYPE, RPM_I18NSTRING_TYPE):
+        # first string only, which for I18N strings is the untranslated one
+        return _to_str(store[offset:store.index(b'\0', offset)])
+    raise Exception("Unsupported type %d for tag %d" % (tag_type, tag))
+
+def read_header_python(filepath):
+    with open(filepath, 'rb') as f:
+        lead = f.read(LEAD_SIZE)
+        if len(lead) != LEAD_SIZE or lead[:4] != LEAD_MAGIC:
+            raise Exception("%s is not a RPM file" % filepath)
+        # skip the signature header, which is padded to a multiple of 8 bytes
+        _, _, size = _read_header_structure(f, filepath)
+        f.read((8 - size % 8) % 8)
+        entries, store, _ = _read_header_structure(f, filepath)
+    return RpmHeader(**dict((field, _header_value(entries, store, tag)) for field, tag in HEADER_TAGS.items()))
+
+# Header parsing through the rpm bindings
+_transaction_set = None
+
+def read_header_bindings(filepath):
+    global _transaction_set
+    if _transaction_set is None:
+        _transaction_set = rpm.TransactionSet()
+        # the bindings only expose these flags under their underscore names, see rpm.TransactionSet docs
+        _transaction_set.setVSFlags(rpm._RPMVSF_NOSIGNATURES | rpm._RPMVSF_NODIGESTS)  # noqa: SLF001
+    fd = os.open(filepath, os.O_RDONLY)
+    try:
+        hdr = _transaction_set.hdrFromFdno(fd)
+    finally:
+        os.close(fd)
+    return RpmHeader(
+        name=_to_str(hdr[rpm.RPMTAG_NAME]),
+        epoch=hdr[rpm.RPMTAG_EPOCH],
+        version=_to_str(hdr[rpm.RPMTAG_VERSION]),
+        release=_to_str(hdr[rpm.RPMTAG_RELEASE]),
+        arch=_to_str(hdr[rpm.RPMTAG_ARCH]),
+        vendor=_to_str(hdr[rpm.RPMTAG_VENDOR]),
+        summary=_to_str(hdr[rpm.RPMTAG_SUMMARY]),
+        license=_to_str(hdr[rpm.RPMTAG_LICENSE]),
+        buildhost=_to_str(hdr[rpm.RPMTAG_BUILDHOST]),
+        buildtime=hdr[rpm.RPMTAG_BUILDTIME],
+        sourcerpm=_to_str(hdr[rpm.RPMTAG_SOURCERPM]),
+    )
+
+def read_header(filepath):
+    """ returns a RpmHeader for the RPM at filepath """
+    if rpm is not None:
+        return read_header_bindings(filepath)
+    return read_header_python(filepath)
+
+class HeaderCache(object):
+    """
+    SQLite-backed cache of RPM header fields, keyed on (path, size, mtime, inode)
+    """
+    def __init__(self, dbpath):
+        self.conn = sqlite3.connect(dbpath)
+        if self.conn.execute('PRAGMA user_version').fetchone()[0] != CACHE_VERSION:
+            self.conn.execute('DROP TABLE IF EXISTS headers')
+            self.conn.execute('PRAGMA user_version = %d' % CACHE_VERSION)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS headers ('
+                          'path TEXT PRIMARY KEY, size INTEGER, mtime REAL, inode INTEGER, header TEXT)')
+        self.hits = 0
+        self.misses = 0
+        self.uncommitted = 0
+
+    def lookup(self, filepath):
+        """ returns (RpmHeader or None if not in cache, stat result) """
+        st = os.stat(filepath)
+        row = self.conn.execute('SELECT header FROM headers WHERE path = ? AND size = ? AND mtime = ? AND inode = ?',
+                                (os.path.abspath(filepath), st.st_size, st.st_mtime, st.st_ino)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None, st
+        self.hits += 1
+        return RpmHeader(*[_to_str(v) for v in json.loads(row[0])]), st
+
+    def store(self, filepath, st, header):
+        self.conn.execute('INSERT OR REPLACE INTO headers (path, size, mtime, inode, header) VALUES (?, ?, ?, ?, ?)',
+                          (os.path.abspath(filepath), st.st_size, st.st_mtime, st.st_ino, json.dumps(list(header))))
+        self.uncommitted += 1
+        if self.uncommitted >= COMMIT_INTERVAL:
+            self.conn.commit()
+            self.uncommitted = 0
+
+    def get(self, filepath):
+        header, st = self.lookup(filepath)
+        if header is None:
+            header = read_header(filepath)
+            self.store(filepath, st, header)
+        return header
+
+    def stats(self):
+        return "RPM header cache: %d hits, %d misses" % (self.hits, self.misses)
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
+
+def get_header(filepath, cache=None):
+    """ read the header of filepath, through the cache if one is given """
+    if cache is None:
+        return read_header(filepath)
+    return cache.get(filepath)
+
+def _read_headers_shard(filepaths):
+    """ process pool worker: returns compact tuples rather than RpmHeader objects """
+    return [tuple(read_header(filepath)) for filepath in filepaths]
+
+def get_headers(filepaths, cache=None, jobs=1):
+    """
+    Read the headers of several RPMs, through the cache if one is given.
+
+    With jobs > 1, the headers missing from the cache are read by a pool of processes,
+    each one handling a contiguous shard of the list.
+    Returns the list of RpmHeader in the same order as filepaths.
+    """
+    headers = [None] * len(filepaths)
+    stats = {}
+    to_read = []
+    for i, filepath in enumerate(filepaths):
+        if cache is not None:
+            headers[i], stats[i] = cache.lookup(filepath)
+        if headers[i] is None:
+            to_read.append(i)
+
+    if jobs > 1 and len(to_read) > 1:
+        # a few shards per worker so that a slow shard doesn't leave the others idle
+        shard_size = max(1, -(-len(to_read) // (jobs * 4)))
+        shards = [[filepaths[i] for i in to_read[start:start + shard_size]]
+                  for start in range(0, len(to_read), shard_size)]
+        pool = multiprocessing.Pool(jobs)
+        try:
+            results = [RpmHeader(*values) for shard in pool.map(_read_headers_shard, shards) for values in shard]
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [read_header(filepaths[i]) for i in to_read]
+
+    for i, header in zip(to_read, results):
+        headers[i] = header
+        if cache is not None:
+            cache.store(filepaths[i], stats[i], header)
+    return headers
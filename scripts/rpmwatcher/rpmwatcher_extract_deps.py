@@ -19,10 +19,20 @@ from __future__ import print_function
 import argparse
 import subprocess
 import os
-import json
 import glob
+import multiprocessing
+import shutil
 import tempfile
 
+import depcache
+import depsolver
+import evrkey
+import repodata
+import workdir_store
+
+# Bump when the way the install root is prepared changes, to invalidate existing snapshots
+INSTALL_ROOT_SNAPSHOT_VERSION = 1
+
 def check_dir(dirpath):
     if not os.path.isdir(dirpath):
         raise Exception("Directory %s doesn't exist" % dirpath)
@@ -56,6 +66,34 @@ def get_latest_rpm_nvra(name, install_root, allow_missing=False):
     rpm_nvra = output.splitlines()[0].split('/')[-1][:-4]
     return rpm_nvra
 
+def get_latest_rpm_nvras(names, repo_dir, install_root):
+    """
+    Same as get_latest_rpm_nvra for several names at once.
+
+    When repo_dir has repodata, it is read once to answer for all names.
+    Else, falls back to one yumdownloader call per name.
+    returns ({name: nvra}, [names with no package])
+    """
+    if not repodata.has_repodata(repo_dir):
+        latest = {}
+        for name in names:
+            nvra = get_latest_rpm_nvra(name, install_root, allow_missing=True)
+            if nvra:
+                latest[name] = nvra
+        return latest, [name for name in names if name not in latest]
+
+    wanted = set(names)
+    best = {}
+    for pkg in repodata.iter_primary(repo_dir):
+        if pkg['name'] not in wanted or pkg['arch'] == 'src':
+            continue
+        # newest first, then prefer the native arch over noarch, as yum does
+        key = (evrkey.evr_key(pkg['epoch'], pkg['version'], pkg['release']), pkg['arch'] != 'noarch')
+        if pkg['name'] not in best or key > best[pkg['name']][0]:
+            best[pkg['name']] = (key, os.path.basename(pkg['location'])[:-len('.rpm')])
+    latest = dict((name, nvra) for name, (key, nvra) in best.items())
+    return latest, [name for name in names if name not in latest]
+
 def get_build_deps(filepath, install_root, download_dir):
     output = subprocess.check_output(['yum-builddep', filepath, '--downloadonly', '--quiet',
                                       '--downloaddir=' + download_dir, '--installroot=' + install_root])
@@ -99,11 +137,155 @@ def get_build_deps(filepath, install_root, download_dir):
 
     return direct_deps, deps_deps
 
+def check_repodata(repo_dir):
+    """ fail unless the repodata of repo_dir lists exactly its RPMs. It is generated by sync_repos.sh. """
+    # rsync preserves mtimes, so compare the RPMs listed in the repodata with those in the directory instead
+    rpm_filenames = set(filename for filename in os.listdir(repo_dir) if filename.endswith('.rpm'))
+    if rpm_filenames and set(repodata.get_packages_by_filename(repo_dir)) == rpm_filenames:
+        return
+    raise Exception("%s has no up-to-date repodata. Run sync_repos.sh with createrepo_c or createrepo "
+                    "installed first: the CentOS container has neither." % repo_dir)
+
+def clone_install_root(install_root):
+    """
+    Copy the install root for use by another yum process.
+    Uses reflinks when the filesystem supports them, which makes the copy almost free.
+    Hardlinks would not do: the rpm database files are modified in place even when only reading.
+    """
+    clone = tempfile.mkdtemp()
+    os.rmdir(clone)
+    subprocess.check_call(['cp', '-a', '--reflink=auto', install_root, clone])
+    return clone
+
+def clone_download_dir(download_dir):
+    """
+    Private download directory for a yum-builddep worker, next to download_dir so that they share a filesystem.
+    It starts with hardlinks to the RPMs of download_dir, so that yum doesn't download them again,
+    while the RPMs yum downloads are only written there. See merge_download_dir().
+    """
+    clone = tempfile.mkdtemp(prefix='.yum-builddep-', dir=os.path.dirname(download_dir))
+    for filename in os.listdir(download_dir):
+        if filename.endswith('.rpm'):
+            os.link(os.path.join(download_dir, filename), os.path.join(clone, filename))
+    return clone
+
+def merge_download_dir(clone, download_dir):
+    """ move the RPMs downloaded in clone to download_dir, then remove clone """
+    for filename in os.listdir(clone):
+        if not filename.endswith('.rpm'):
+            continue
+        path = os.path.join(clone, filename)
+        dest = os.path.join(download_dir, filename)
+        if os.path.exists(dest) and os.path.samefile(path, dest):
+            continue
+        # atomic, and both files are complete if two workers downloaded the same RPM
+        os.rename(path, dest)
+    shutil.rmtree(clone)
+
+def save_install_root(install_root, snapshot_dir, replaced_prefix):
+    """
+    Save a copy of install_root as snapshot_dir.
+    The snapshots it replaces are removed: those whose name starts with replaced_prefix, the leftovers
+    of interrupted copies and the snapshots of other INSTALL_ROOT_SNAPSHOT_VERSIONs.
+    The others, e.g. for another version of xcp-ng-deps, are kept for the runs that may need them.
+    """
+    snapshots_dir = os.path.dirname(snapshot_dir)
+    if not os.path.isdir(snapshots_dir):
+        os.makedirs(snapshots_dir)
+    current_prefix = 'v%d_' % INSTALL_ROOT_SNAPSHOT_VERSION
+    for name in os.listdir(snapshots_dir):
+        if name.startswith(replaced_prefix) or not name.startswith(current_prefix) or name.endswith('.tmp'):
+            shutil.rmtree(os.path.join(snapshots_dir, name))
+    # copy then rename, so that an interrupted copy is never taken for a valid snapshot
+    subprocess.check_call(['cp', '-a', '--reflink=auto', install_root, snapshot_dir + '.tmp'])
+    os.rename(snapshot_dir + '.tmp', snapshot_dir)
+
+def restore_install_root(snapshot_dir, install_root):
+    shutil.rmtree(install_root)
+    subprocess.check_call(['cp', '-a', '--reflink=auto', snapshot_dir, install_root])
+
+# install root and download directory of the current build deps worker process, see get_all_build_deps()
+_worker_dirs = None
+
+def _init_build_deps_worker(worker_dirs):
+    global _worker_dirs
+    _worker_dirs = worker_dirs.get()
+
+def _get_build_deps_worker(task):
+    srpm_nvr, filepath = task
+    install_root, download_dir = _worker_dirs
+    return srpm_nvr, get_build_deps(filepath, install_root, download_dir)
+
+def get_all_build_deps(srpm_paths, install_root, download_dir, jobs=1, deps_cache=None):
+    """
+    Get the build deps for each SRPM of the {srpm_nvr: filepath} dict.
+
+    With jobs > 1, the SRPMs are processed by a pool of processes, each one using its own copy
+    of install_root and its own download directory, merged into download_dir at the end:
+    concurrent downloads of the same RPM to download_dir could leave it truncated.
+    With a deps_cache, known results are read from it, and new ones are stored as soon as they arrive.
+    returns {srpm_nvr: (direct_deps, deps_deps)}
+    """
+    results = {}
+    tasks = []
+    for srpm_nvr in sorted(srpm_paths):
+        cached = deps_cache.get_build_deps(srpm_nvr) if deps_cache is not None else None
+        if cached is not None:
+            results[srpm_nvr] = cached
+        else:
+            tasks.append((srpm_nvr, srpm_paths[srpm_nvr]))
+
+    def add_result(srpm_nvr, build_deps):
+        results[srpm_nvr] = build_deps
+        if deps_cache is not None:
+            deps_cache.store_build_deps(srpm_nvr, build_deps)
+
+    if jobs <= 1 or len(tasks) <= 1:
+        for srpm_nvr, filepath in tasks:
+            add_result(srpm_nvr, get_build_deps(filepath, install_root, download_dir))
+        return results
+
+    jobs = min(jobs, len(tasks))
+    worker_dirs = multiprocessing.Queue()
+    clones = [(clone_install_root(install_root), clone_download_dir(download_dir)) for _ in range(jobs)]
+    for clone in clones:
+        worker_dirs.put(clone)
+    pool = multiprocessing.Pool(jobs, initializer=_init_build_deps_worker, initargs=(worker_dirs,))
+    try:
+        for srpm_nvr, build_deps in pool.imap_unordered(_get_build_deps_worker, tasks):
+            add_result(srpm_nvr, build_deps)
+        return results
+    finally:
+        pool.close()
+        pool.join()
+        for install_root_clone, download_dir_clone in clones:
+            shutil.rmtree(install_root_clone)
+            merge_download_dir(download_dir_clone, download_dir)
+
 def main():
     parser = argparse.ArgumentParser(description='Extract package roles for XCP-ng RPMs')
     parser.add_argument('version', help='XCP-ng 2-digit version, e.g. 8.0')
     parser.add_argument('basedir', help='path to the base directory where repos must be present and where '
                                         'we\'ll read data / output results.')
+    parser.add_argument('--sqlite-store', action='store_true',
+                        help='read and write the data shared between stages in workdir/{version}/%s '
+                             'instead of JSON files' % workdir_store.SQLITE_FILENAME)
+    parser.add_argument('--resolver', choices=['yum', 'index', 'graph', 'compare'], default='yum',
+                        help='how runtime dependencies are resolved. yum: one yumdownloader call per RPM. '
+                             'index: in-process resolution using the repodata of xcp-ng_rpms/{version} '
+                             '(see depsolver.py). graph: same as index, but all closures are computed at once '
+                             'from the dependency graph (see depgraph.py). '
+                             'compare: use yum but report any difference with index.')
+    parser.add_argument('--jobs', type=int, default=1,
+                        help='number of yum-builddep processes run concurrently, each with its own copy '
+                             'of the install root')
+    parser.add_argument('--no-install-root-snapshot', action='store_true',
+                        help='always build the install root from scratch, and don\'t save it for later runs')
+    parser.add_argument('--local-mirror', action='store_true',
+                        help='resolve dependencies against the local xcp-ng_rpms/{version} mirror rather than '
+                             'the online XCP-ng repositories. No network access is needed.')
+    parser.add_argument('--no-deps-cache', action='store_true',
+                        help='don\'t read or store results in workdir/{version}/deps_cache.sqlite')
     args = parser.parse_args()
 
     base_dir = os.path.abspath(check_dir(args.basedir))
@@ -114,10 +296,16 @@ def main():
     work_dir = check_dir(os.path.join(base_dir, 'workdir', xcp_version))
 
     # Read data from workdir
-    with open(os.path.join(work_dir, 'xcp-ng_builds_WIP.json')) as f:
-        xcp_builds = json.load(f)
-    with open(os.path.join(work_dir, 'xcp-ng-rpms-srpms.json')) as f:
-        xcp_ng_rpms_srpms = json.load(f)
+    workdir = workdir_store.open_workdir(work_dir, args.sqlite_store)
+    xcp_builds = workdir.read('xcp-ng_builds_WIP.json')
+    xcp_ng_rpms_srpms = workdir.read('xcp-ng-rpms-srpms.json')
+
+    # Results computed by previous runs against the same repository contents, see depcache.py
+    deps_cache = None
+    if not args.no_deps_cache:
+        fingerprint = depcache.repo_fingerprint(xcp_rpm_repo, args.resolver, args.local_mirror,
+                                                INSTALL_ROOT_SNAPSHOT_VERSION, depsolver.RESOLUTION_VERSION)
+        deps_cache = depcache.DepsCache(os.path.join(work_dir, 'deps_cache.sqlite'), fingerprint)
 
     # Prepare CentOS container
     for f in glob.glob('/etc/yum.repos.d/*.repo'):
@@ -125,9 +313,27 @@ def main():
 
     repofilepath = '/etc/yum.repos.d/xcp-ng-rpmwatcher.repo'
 
-    with open(repofilepath, 'w') as f:
-        for repo in ['base', 'updates', 'candidates', 'testing', 'ci']:
+    # the local mirror and the in-process resolvers use the repodata of the RPMs synced by sync_repos.sh
+    if args.local_mirror or args.resolver != 'yum':
+        check_repodata(xcp_rpm_repo)
+
+    if args.local_mirror:
+        # Use the RPMs synced by sync_repos.sh: no network access needed.
+        # They come from the same signed repos, and are not installed for real, so no GPG checks.
+        with open(repofilepath, 'w') as f:
             f.write("""
+[xcp-ng-local]
+name = XCP-ng {xcp_version} local mirror
+baseurl = file://{repo_dir}
+enabled = 1
+gpgcheck = 0
+repo_gpgcheck = 0
+metadata_expire = 0
+""".format(xcp_version=xcp_version, repo_dir=xcp_rpm_repo))
+    else:
+        with open(repofilepath, 'w') as f:
+            for repo in ['base', 'updates', 'candidates', 'testing', 'ci']:
+                f.write("""
 [xcp-ng-{repo}]
 name = XCP-ng {repo} Repository
 baseurl = http://mirrors.xcp-ng.org/{xcp_major}/{xcp_version}/{repo}/x86_64/ http://updates.xcp-ng.org/{xcp_major}/{xcp_version}/{repo}/x86_64/
@@ -137,14 +343,14 @@ repo_gpgcheck = 1
 gpgkey = file:///etc/pki/rpm-gpg/RPM-GPG-KEY-xcpng
 """.format(repo=repo, xcp_major=xcp_major, xcp_version=xcp_version))
 
-    subprocess.check_call(
-        [
-            'curl',
-            '-sSf',
-            'https://xcp-ng.org/RPM-GPG-KEY-xcpng',
-            '-o', '/etc/pki/rpm-gpg/RPM-GPG-KEY-xcpng'
-        ]
-    )
+        subprocess.check_call(
+            [
+                'curl',
+                '-sSf',
+                'https://xcp-ng.org/RPM-GPG-KEY-xcpng',
+                '-o', '/etc/pki/rpm-gpg/RPM-GPG-KEY-xcpng'
+            ]
+        )
 
     # Prepare temporary directory that will serve as installroot
     install_root = tempfile.mkdtemp()
@@ -154,39 +360,96 @@ gpgkey = file:///etc/pki/rpm-gpg/RPM-GPG-KEY-xcpng
     subprocess.check_call(['yumdownloader', '-q', '-y', '--urls', 'xcp-ng-deps', '--installroot=%s' % install_root])
 
     # Get the list of RPMs that are installed by default (deps of xcp-ng-deps)
+    # yum must resolve them before base packages are installed in the install root, else those would be left out
     print("\n*** Get list of RPMs installed by default on XCP-ng (deps of xcp-ng-deps) ***")
-    installable, rpms_installed_by_default = get_all_runtime_deps('xcp-ng-deps', install_root, include_self=True)
+    if args.resolver in ('yum', 'compare'):
+        installed_by_default = get_all_runtime_deps('xcp-ng-deps', install_root, include_self=True)
+
+    # The install root with base packages is saved as a snapshot, reused as long as the packages
+    # that determine its contents don't change.
+    snapshot_dir = None
+    if not args.no_install_root_snapshot:
+        base_nvras, _ = get_latest_rpm_nvras(['xcp-ng-deps', 'kernel'], xcp_rpm_repo, install_root)
+        if base_nvras.get('xcp-ng-deps') is None or base_nvras.get('kernel') is None:
+            # without them, the key wouldn't change when the contents of the install root do
+            print("xcp-ng-deps or kernel not found in the repository, not using an install root snapshot")
+        else:
+            # a new kernel for the same xcp-ng-deps replaces the previous snapshot, see save_install_root()
+            snapshot_prefix = 'v%d_%s%s_' % (INSTALL_ROOT_SNAPSHOT_VERSION,
+                                             'local_' if args.local_mirror else '',
+                                             base_nvras['xcp-ng-deps'])
+            snapshot_dir = os.path.join(work_dir, 'install_root_snapshots', snapshot_prefix + base_nvras['kernel'])
+
+    if snapshot_dir is not None and os.path.isdir(snapshot_dir):
+        print("\n*** Restore install root from %s ***" % snapshot_dir)
+        restore_install_root(snapshot_dir, install_root)
+    else:
+        # Add a few base packages to the install root, e.g. kernel to avoid other packages such as kernel-alt
+        # to be seen as better fit for the "kernel" provides than standard kernel because of higher version
+        # Note: this simple command pulls more than 100 base packages :o
+        # This could be either a very good thing or a bad one...
+        a_few_base_packages = ['kernel']
+        print("\n*** Install base packages in install root (kernel and its deps) ***")
+        subprocess.check_call(['yum', 'install', '-q', '-y', ' '.join(a_few_base_packages), '--installroot=%s' % install_root])
+
+        # Remove any yum repo file that may have been installed inside the install root.
+        # We don't want them to interfere / take precedence over our /etc/yum.repos.d/xcp-ng-rpmwatcher.repo,
+        # which is outside the install root.
+        print("\n*** Remove extraneous repo files ***")
+        subprocess.check_call(['rm', '-rf', install_root + '/etc/yum.repos.d'])
+
+        # Install GPG keys again, becomes needed again after installing the 100+ packages above
+        # We do it now, after actually installing packages in installroot.
+        print("\n*** Install GPG keys again in install_root ***")
+        subprocess.check_call(['yumdownloader', '-y', '--urls', 'xcp-ng-deps', '--installroot=%s' % install_root])
+        if snapshot_dir is not None:
+            print("\n*** Save install root to %s ***" % snapshot_dir)
+            save_install_root(install_root, snapshot_dir, snapshot_prefix)
+
+    # The in-process resolvers are built from the install root as it is for the rest of the run
+    solver = None
+    if args.resolver != 'yum':
+        solver = depsolver.DepSolver(xcp_rpm_repo, depsolver.read_installed(install_root))
+
+    def compare_resolvers(name, result, solver_result):
+        installable, deps = solver_result
+        if installable != result[0] or sorted(deps) != sorted(result[1]):
+            print("Resolver difference for %s: yum says %s %s, index says %s %s"
+                  % (name, result[0], sorted(result[1]), installable, deps))
+
+    def runtime_deps(name, include_self=False):
+        if args.resolver == 'index':
+            return solver.get_all_runtime_deps(name, include_self)
+        if args.resolver == 'graph':
+            return solver.get_runtime_deps_from_graph(name, include_self)
+        result = get_all_runtime_deps(name, install_root, include_self)
+        if args.resolver == 'compare':
+            compare_resolvers(name, result, solver.get_all_runtime_deps(name, include_self))
+        return result
+
+    if solver is not None:
+        # with nothing installed, as when yum resolved them above
+        solver_result = solver.get_all_runtime_deps('xcp-ng-deps', include_self=True,
+                                                    installed=depsolver.InstalledPackages())
+        if args.resolver == 'compare':
+            compare_resolvers('xcp-ng-deps', installed_by_default, solver_result)
+        else:
+            installed_by_default = solver_result
+    installable, rpms_installed_by_default = installed_by_default
     if not installable:
         raise Exception("What? xcp-ng-deps is not installable?")
 
-    # Add a few base packages to the install root, e.g. kernel to avoid other packages such as kernel-alt
-    # to be seen as better fit for the "kernel" provides than standard kernel because of higher version
-    # Note: this simple command pulls more than 100 base packages :o
-    # This could be either a very good thing or a bad one...
-    a_few_base_packages = ['kernel']
-    print("\n*** Install base packages in install root (kernel and its deps) ***")
-    subprocess.check_call(['yum', 'install', '-q', '-y', ' '.join(a_few_base_packages), '--installroot=%s' % install_root])
-
-    # Remove any yum repo file that may have been installed inside the install root.
-    # We don't want them to interfere / take precedence over our /etc/yum.repos.d/xcp-ng-rpmwatcher.repo,
-    # which is outside the install root.
-    print("\n*** Remove extraneous repo files ***")
-    subprocess.check_call(['rm', '-rf', install_root + '/etc/yum.repos.d'])
-
-    # Install GPG keys again, becomes needed again after installing the 100+ packages above
-    # We do it now, after actually installing packages in installroot.
-    print("\n*** Install GPG keys again in install_root ***")
-    subprocess.check_call(['yumdownloader', '-y', '--urls', 'xcp-ng-deps', '--installroot=%s' % install_root])
-
 
     # For every SRPM built by ourselves, get its build dependencies
     # We use our local RPMs directory as target directory to avoid downloads
     print("\n*** Get build deps for every SRPM built by XCP-ng ***")
+    srpm_paths = {}
     for srpm_nvr, build_info in xcp_builds.iteritems():
         if build_info['built-by'] == 'xcp-ng':
-            build_info['build-deps'] = get_build_deps(os.path.join(xcp_srpm_repo, srpm_nvr + ".src.rpm"),
-                                                      install_root,
-                                                      xcp_rpm_repo)
+            srpm_paths[srpm_nvr] = os.path.join(xcp_srpm_repo, srpm_nvr + ".src.rpm")
+    build_deps = get_all_build_deps(srpm_paths, install_root, xcp_rpm_repo, args.jobs, deps_cache)
+    for srpm_nvr in sorted(build_deps):
+        xcp_builds[srpm_nvr]['build-deps'] = build_deps[srpm_nvr]
 
 
     # dict to store data about RPMs, with rpm_nvra as the key
@@ -196,7 +459,13 @@ gpgkey = file:///etc/pki/rpm-gpg/RPM-GPG-KEY-xcpng
     print("\n*** Get runtime deps for all RPMs ***")
     for srpm_nvr, build_info in xcp_builds.iteritems():
         for rpm_nvra in build_info['rpms']:
-            installable, deps = get_all_runtime_deps(rpm_nvra, install_root)
+            cached = deps_cache.get_runtime_deps(rpm_nvra) if deps_cache is not None else None
+            if cached is not None:
+                installable, deps = cached
+            else:
+                installable, deps = runtime_deps(rpm_nvra)
+                if deps_cache is not None:
+                    deps_cache.store_runtime_deps(rpm_nvra, installable, deps)
             xcp_rpms[rpm_nvra] = {
                 'deps': deps,
                 'installable':  installable,
@@ -204,27 +473,26 @@ gpgkey = file:///etc/pki/rpm-gpg/RPM-GPG-KEY-xcpng
                 'srpm_nvr': xcp_ng_rpms_srpms[rpm_nvra]['srpm_nvr']
             }
 
-    with open(os.path.join(work_dir, 'xcp-ng_rpms_WIP2.json'), 'w') as f:
-        f.write(json.dumps(xcp_rpms, sort_keys=True, indent=4))
-    with open(os.path.join(work_dir, 'xcp-ng_builds_WIP2.json'), 'w') as f:
-        f.write(json.dumps(xcp_builds, sort_keys=True, indent=4))
-    with open(os.path.join(work_dir, 'rpms_installed_by_default_nvra.json'), 'w') as f:
-        f.write(json.dumps(rpms_installed_by_default, sort_keys=True, indent=4))
+    workdir.write('xcp-ng_rpms_WIP2.json', xcp_rpms)
+    workdir.write('xcp-ng_builds_WIP2.json', xcp_builds)
+    workdir.write('rpms_installed_by_default_nvra.json', rpms_installed_by_default)
 
     # Get the list of extra installable RPMs, as RPM NVRA.
     print("\n*** Get list of extra_installable packages ***")
     with open(os.path.join(work_dir, 'extra_installable.txt')) as f:
         extra_installable = f.read().splitlines()
-    rpms_extra_installable = []
-    for name in extra_installable:
-        nvra = get_latest_rpm_nvra(name, install_root, allow_missing=True)
-        # the package may be missing if it's still in xcp-ng-incoming and already listed
-        # there's an xcp-ng-tests test which will verify all extra packages are actually installable
-        # so let's not fail here.
-        if nvra:
-            rpms_extra_installable.append(nvra)
-    with open(os.path.join(work_dir, 'extra_installable_nvra.json'), 'w') as f:
-        f.write(json.dumps(rpms_extra_installable, sort_keys=True, indent=4))
+    latest_nvras, missing = get_latest_rpm_nvras(extra_installable, xcp_rpm_repo, install_root)
+    # the package may be missing if it's still in xcp-ng-incoming and already listed
+    # there's an xcp-ng-tests test which will verify all extra packages are actually installable
+    # so let's not fail here.
+    if missing:
+        print("Extra installable packages not found: %s" % " ".join(missing))
+    rpms_extra_installable = [latest_nvras[name] for name in extra_installable if name in latest_nvras]
+    workdir.write('extra_installable_nvra.json', rpms_extra_installable)
+    workdir.close()
+    if deps_cache is not None:
+        deps_cache.close()
+        print(deps_cache.stats())
 
 if __name__ == "__main__":
     main()
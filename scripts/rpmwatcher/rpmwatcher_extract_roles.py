@@ -11,6 +11,9 @@ to run it fast to test the changes.
 Prerequisites:
 - a /data directory that contains the workdir dir updated by rpmwatcher_extract_deps.py
 
+With --incremental, only the roles of the RPMs that changed since the previous run, and of the RPMs
+whose roles could depend on theirs, are recomputed. See RoleGraph.restrict_to().
+
 Note, in what follows:
 - NVR means Name Version Release
 - NVRA means Name Version Release Arch
@@ -18,9 +21,15 @@ Those are common concepts in the RPM world.
 """
 
 from __future__ import print_function
+
 import argparse
 import os
-import json
+from array import array
+
+import roleindex
+import workdir_store
+from workdir_store import JsonSortAndEncode
+
 
 def check_dir(dirpath):
     if not os.path.isdir(dirpath):
@@ -31,185 +40,573 @@ def are_siblings(rpm_nvra1, rpm_nvra2, xcp_rpms):
     """ checks whether two RPMs are from the same SRPM """
     return xcp_rpms[rpm_nvra1]['srpm_nvr'] == xcp_rpms[rpm_nvra2]['srpm_nvr']
 
-class JsonSortAndEncode(json.JSONEncoder):
-    def default(self, obj):
-        if isinstance(obj, list):
-            return sorted(list)
-        if isinstance(obj, set):
-            return sorted(list(obj))
-        return json.JSONEncoder.default(self, obj)
+class Adjacency(object):
+    """
+    Compressed sparse rows: the successors of node i are targets[offsets[i]:offsets[i + 1]]
+    Two flat arrays of integers instead of one list of strings per node.
+    """
+    __slots__ = ['offsets', 'targets']
 
-def main():
-    parser = argparse.ArgumentParser(description='Extract package roles for XCP-ng RPMs')
-    parser.add_argument('version', help='XCP-ng 2-digit version, e.g. 8.0')
-    parser.add_argument('basedir', help='path to the base directory where repos must be present and where '
-                                        'we\'ll read data / output results.')
-    args = parser.parse_args()
+    def __init__(self, rows):
+        self.offsets = array('I', [0])
+        self.targets = array('I')
+        for row in rows:
+            self.targets.extend(row)
+            self.offsets.append(len(self.targets))
 
-    base_dir = os.path.abspath(check_dir(args.basedir))
-    xcp_version = args.version
-    work_dir = check_dir(os.path.join(base_dir, 'workdir', xcp_version))
+    def __getitem__(self, node):
+        return self.targets[self.offsets[node]:self.offsets[node + 1]]
 
-    # Read data from workdir
-    with open(os.path.join(work_dir, 'extra_installable_nvra.json')) as f:
-        extra_installable_nvra = json.load(f)
-    with open(os.path.join(work_dir, 'rpms_installed_by_default_nvra.json')) as f:
-        rpms_installed_by_default = json.load(f)
-    with open(os.path.join(work_dir, 'xcp-ng_builds_WIP2.json')) as f:
-        xcp_builds = json.load(f)
-    with open(os.path.join(work_dir, 'xcp-ng_rpms_WIP2.json')) as f:
-        xcp_rpms = json.load(f)
-
-    # Update RPM roles
-    # For each RPM we store mosts roles as well as the related RPMs or SRPMs:
-    # - main: RPMs installed by default
-    # - extra: RPMs available in the repos and available for installation on dom0
-    # - extra_dep: RPMs that are pulled as dependencies for extra RPMs and aren't extra or main
-    # - main_builddep: direct build dependency for a SRPM that produces main RPMs
-    # - main_builddep_dep: dependency of a main_builddep RPM
-    # - main_indirect_builddep: builddep of a builddep or of a dep of a builddep, with no limits of depth
-    # - extra_builddep: build dependency for a SRPM that produces an extra package or one of its dependencies
-    # - extra_builddep_dep: dependency of an extra_builddep RPM
-    # - extra_indirect_builddep: builddep of a builddep or of a dep of a builddep, with no limits of depth
-    # - other_builddep: direct build dependency for a SRPM that has no RPM with a role
-    # - other_builddep_dep: dependency of a other_builddep
-    # - other_indirect_builddep: builddep of a builddep or of a dep of a builddep, with no limits of depth
-    # - other_dep: dependency for a package that has no roles, not even other_builddep_xxx or other_indirect_builddep
-    #              the "other_dep" package must also have no roles itself, except other_*
-    # - None: no roles
-
-    for rpm_nvra in xcp_rpms:
-        xcp_rpms[rpm_nvra]['roles'] = {}
-
-    def add_rpm_role(xcp_rpms, rpm_nvra, role, related_rpm_nvra):
-        if role not in xcp_rpms[rpm_nvra]['roles']:
-            xcp_rpms[rpm_nvra]['roles'][role] = set()
-        xcp_rpms[rpm_nvra]['roles'][role].add(related_rpm_nvra)
-
-    for rpm_nvra in xcp_rpms:
-        if rpm_nvra in rpms_installed_by_default:
-            # for now the related RPM for the 'main' role is the RPM itself
-            # in the future we may want to improve this and detail the dependency chain more
-            add_rpm_role(xcp_rpms, rpm_nvra, 'main', rpm_nvra)
-
-        if rpm_nvra in extra_installable_nvra:
-            add_rpm_role(xcp_rpms, rpm_nvra, 'extra', rpm_nvra)
-
-    for rpm_nvra in xcp_rpms:
-        if rpm_nvra in extra_installable_nvra:
-            for dep in xcp_rpms[rpm_nvra]['deps']:
-                if not xcp_rpms[dep]['roles']:
-                    add_rpm_role(xcp_rpms, dep, 'extra_dep', rpm_nvra)
-
-    def intersect_or_both_empty(list1, list2):
-        if not list1 and not list2:
-            return True
-        return bool(list(set(list1) & set(list2)))
-
-    def srpm_rpms_have_roles(xcp_rpms, xcp_builds, srpm_nvr):
-        for rpm_nvra in xcp_builds[srpm_nvr]['rpms']:
-            if xcp_rpms[rpm_nvra]['roles']:
-                return True
-        return False
-
-    def update_builddep_role(xcp_rpms, xcp_builds, roles_from, role_to, direct):
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def reverse(self, size):
+        """ Adjacency of the reverse graph, whose nodes are 0..size-1 """
+        rows = [[] for _ in xrange(size)]
+        for node in xrange(len(self)):
+            for target in self[node]:
+                rows[target].append(node)
+        return Adjacency(rows)
+
+# Each role is a bit in the role mask of an RPM
+ROLES = ['main', 'extra', 'extra_dep',
+         'main_builddep', 'main_builddep_dep', 'main_indirect_builddep',
+         'extra_builddep', 'extra_builddep_dep', 'extra_indirect_builddep',
+         'other_builddep', 'other_builddep_dep', 'other_indirect_builddep',
+         'other_dep']
+ROLE_BITS = dict((role, 1 << i) for i, role in enumerate(ROLES))
+BIT_ROLES = dict((bit, role) for role, bit in ROLE_BITS.items())
+OTHER_ROLES_MASK = sum(bit for role, bit in ROLE_BITS.items() if role.startswith('other_'))
+# roles whose related packages are RPMs. For the others, they are SRPMs.
+RPM_RELATED_ROLES_MASK = ROLE_BITS['main'] | ROLE_BITS['extra'] | ROLE_BITS['extra_dep'] | ROLE_BITS['other_dep']
+# roles given by RPMs which must have no roles at the time they are processed, see RoleGraph.restrict_to()
+ORDER_SENSITIVE_ROLES = ['other_builddep', 'other_builddep_dep', 'other_dep']
+
+STATE_DOCUMENT = 'xcp-ng_roles_state.json'
+
+class RoleGraph(object):
+    """
+    Dependency and build dependency graph of the XCP-ng RPMs, and their roles.
+
+    NVRAs and SRPM NVRs are interned to integer ids, in the iteration order of xcp_rpms
+    and xcp_builds, and only converted back to strings when the roles are output.
+    RPMs are processed in the order of their ids, i.e. in the iteration order of xcp_rpms.
+    The roles of an RPM are a bitmask, plus the set of related RPM or SRPM ids for each role.
+    """
+    def __init__(self, xcp_rpms, xcp_builds):
+        self.rpm_nvras = list(xcp_rpms)
+        self.rpm_ids = dict((rpm_nvra, rpm) for rpm, rpm_nvra in enumerate(self.rpm_nvras))
+        self.srpm_nvrs = list(xcp_builds)
+        self.srpm_ids = dict((srpm_nvr, srpm) for srpm, srpm_nvr in enumerate(self.srpm_nvrs))
+        for rpm_nvra in self.rpm_nvras:
+            srpm_nvr = xcp_rpms[rpm_nvra]['srpm_nvr']
+            if srpm_nvr not in self.srpm_ids:
+                self.srpm_ids[srpm_nvr] = len(self.srpm_nvrs)
+                self.srpm_nvrs.append(srpm_nvr)
+
+        rpm_ids = self.rpm_ids
+        self.srpm_of = array('I', (self.srpm_ids[xcp_rpms[rpm_nvra]['srpm_nvr']] for rpm_nvra in self.rpm_nvras))
+        self.deps = Adjacency([rpm_ids[dep] for dep in xcp_rpms[rpm_nvra]['deps']] for rpm_nvra in self.rpm_nvras)
+
+        def build_deps(dep_type):
+            for srpm_nvr in self.srpm_nvrs:
+                build_info = xcp_builds.get(srpm_nvr, {})
+                if 'build-deps' in build_info:
+                    yield [rpm_ids[dep] for dep in build_info['build-deps'][dep_type]]
+                else:
+                    yield []
+        # [direct build deps, deps of the build deps]
+        self.build_deps = [Adjacency(build_deps(0)), Adjacency(build_deps(1))]
+        # RPMs listed by each build, and reverse
+        self.srpm_rpms = Adjacency([rpm_ids[rpm_nvra] for rpm_nvra in xcp_builds[srpm_nvr]['rpms']]
+                                   if srpm_nvr in xcp_builds else []
+                                   for srpm_nvr in self.srpm_nvrs)
+        self.listed_by = self.srpm_rpms.reverse(len(self.rpm_nvras))
+
+        self.role_masks = array('H', [0]) * len(self.rpm_nvras)
+        # {role bit: {rpm: set of related RPMs or SRPMs}}
+        self.related = dict((bit, {}) for bit in ROLE_BITS.values())
+        # {role bit: {rpm: (RPM the role was given by, its role bit or 0 if it has no roles)}}
+        # None for main and extra RPMs. See roleindex.py.
+        self.links = dict((bit, {}) for bit in ROLE_BITS.values())
+        # whether any of the RPMs of a SRPM has a role
+        self.srpm_has_roles = bytearray(len(self.srpm_nvrs))
+        # {role bit: whether each RPM had no roles yet when processed}, for ORDER_SENSITIVE_ROLES
+        self.qualified = dict((ROLE_BITS[role], bytearray(len(self.rpm_nvras))) for role in ORDER_SENSITIVE_ROLES)
+        # with restrict_to(): the RPMs whose roles are computed, and those processed to compute them
+        self.region = None
+        self.sources = xrange(len(self.rpm_nvras))
+        self._influence = None
+
+    def influence(self):
         """
-        Identify and flag RPMs that are builddeps or deps of builddeps
+        Adjacency of the RPMs whose roles can depend on the roles of each RPM:
+        its deps, the build deps of its SRPM and the other RPMs of its SRPM.
         """
-        for rpm_nvra in xcp_rpms:
-            if intersect_or_both_empty(xcp_rpms[rpm_nvra]['roles'].keys(), roles_from):
-                srpm_nvr = xcp_rpms[rpm_nvra]['srpm_nvr']
-                # if roles_from is empty and the RPM belongs to a SRPM that already has RPMs with roles,
-                # don't retain that RPM. We don't want other_builddep and other_builddep_dep to pop everywhere
-                # a SRPM produces an unused RPM among other useful RPMs
-                if not roles_from and srpm_rpms_have_roles(xcp_rpms, xcp_builds, srpm_nvr):
-                    continue
-                if srpm_nvr in xcp_builds and 'build-deps' in xcp_builds[srpm_nvr]:
-                    for dep_rpm_nvra in xcp_builds[srpm_nvr]['build-deps'][0 if direct else 1]:
-                        add_rpm_role(xcp_rpms, dep_rpm_nvra, role_to, srpm_nvr)
+        if self._influence is not None:
+            return self._influence
+        members = [set(self.srpm_rpms[srpm]) for srpm in xrange(len(self.srpm_nvrs))]
+        for rpm in xrange(len(self.rpm_nvras)):
+            members[self.srpm_of[rpm]].add(rpm)
+        rows = []
+        for rpm in xrange(len(self.rpm_nvras)):
+            srpm = self.srpm_of[rpm]
+            row = set(self.deps[rpm])
+            row.update(self.build_deps[0][srpm])
+            row.update(self.build_deps[1][srpm])
+            for member_of in set(self.listed_by[rpm]) | set([srpm]):
+                row.update(members[member_of])
+            row.discard(rpm)
+            rows.append(sorted(row))
+        self._influence = Adjacency(rows)
+        return self._influence
+
+    def influenced(self, rpm_nvras):
+        """ NVRAs of the given RPMs of this graph and of all the RPMs whose roles can depend on theirs """
+        influence = self.influence()
+        seen = bytearray(len(self.rpm_nvras))
+        todo = [self.rpm_ids[rpm_nvra] for rpm_nvra in rpm_nvras if rpm_nvra in self.rpm_ids]
+        for rpm in todo:
+            seen[rpm] = 1
+        while todo:
+            rpm = todo.pop()
+            for target in influence[rpm]:
+                if not seen[target]:
+                    seen[target] = 1
+                    todo.append(target)
+        return set(self.rpm_nvras[rpm] for rpm in xrange(len(self.rpm_nvras)) if seen[rpm])
+
+    def reordered(self, previous_order):
+        """
+        NVRAs of the RPMs of both this run and the previous one, processed in previous_order, whose
+        roles can depend on the new order.
+
+        The iteration order of xcp_rpms changes when RPMs are added or removed. Whether an RPM gets a role,
+        or which related RPM it gets it from, can depend on whether it was processed before or after the
+        RPMs that can give roles to it or to the RPMs of its SRPM, and on the order of those.
+        If the relative order of this group of RPMs changed, the RPM is reordered.
+        """
+        previous_positions = dict((rpm_nvra, position) for position, rpm_nvra in enumerate(previous_order))
+        previous = [previous_positions.get(rpm_nvra) for rpm_nvra in self.rpm_nvras]
+        common = [rpm for rpm in xrange(len(self.rpm_nvras)) if previous[rpm] is not None]
+        if common == sorted(common, key=previous.__getitem__):
+            return set()
+
+        influencers = self.influence().reverse(len(self.rpm_nvras))
+        reordered = set()
+        for rpm in common:
+            group = set([rpm])
+            group.update(influencers[rpm])
+            for sibling in self.srpm_rpms[self.srpm_of[rpm]]:
+                group.add(sibling)
+                group.update(influencers[sibling])
+            # ids are in the current order
+            group = sorted(other for other in group if previous[other] is not None)
+            if group != sorted(group, key=previous.__getitem__):
+                reordered.add(self.rpm_nvras[rpm])
+        return reordered
+
+    def restrict_to(self, region_nvras, previous_rpms, previous_qualified, previous_links):
+        """
+        Only compute the roles of the RPMs of region_nvras. The others get the roles they have in
+        previous_rpms, i.e. the previous xcp-ng_rpms.json, and the links from previous_links,
+        i.e. the rows of the previous roles index.
+
+        The region must contain all the RPMs whose roles can depend on those of an RPM of the region,
+        see influenced(). The roles of the other RPMs then only depend on each other, so they are the
+        same as in the previous run. When computing the region, RPMs outside of it are still processed
+        in the same order as in a full computation, as they may give roles to RPMs of the region.
+        Whether they had no roles yet at the time (ORDER_SENSITIVE_ROLES) can't be recomputed from
+        their final roles, so it is taken from previous_qualified {role: NVRAs}, which the previous
+        run recorded (see qualified).
+        """
+        nb_rpms = len(self.rpm_nvras)
+        self.region = bytearray(nb_rpms)
+        for rpm_nvra in region_nvras:
+            if rpm_nvra in self.rpm_ids:
+                self.region[self.rpm_ids[rpm_nvra]] = 1
+        for role in ORDER_SENSITIVE_ROLES:
+            qualified = self.qualified[ROLE_BITS[role]]
+            for rpm_nvra in previous_qualified[role]:
+                rpm = self.rpm_ids.get(rpm_nvra)
+                if rpm is not None and not self.region[rpm]:
+                    qualified[rpm] = 1
 
-    def update_indirect_builddep_role(xcp_rpms, xcp_builds, role_prefix, role_to, iterations=10):
+        for rpm in xrange(nb_rpms):
+            if self.region[rpm]:
+                continue
+            for role, related_nvrs in previous_rpms[self.rpm_nvras[rpm]]['roles'].items():
+                role_bit = ROLE_BITS[role]
+                ids = self.rpm_ids if role_bit & RPM_RELATED_ROLES_MASK else self.srpm_ids
+                self.role_masks[rpm] |= role_bit
+                self.related[role_bit][rpm] = set(ids[related_nvr] for related_nvr in related_nvrs)
+            if self.role_masks[rpm]:
+                for srpm in self.listed_by[rpm]:
+                    self.srpm_has_roles[srpm] = 1
+        for rpm_nvra, role, pred_nvra, pred_role, _ in previous_links:
+            rpm = self.rpm_ids.get(rpm_nvra)
+            if rpm is None or self.region[rpm]:
+                continue
+            link = None
+            if pred_nvra is not None:
+                link = (self.rpm_ids[pred_nvra], ROLE_BITS[pred_role] if pred_role is not None else 0)
+            self.links[ROLE_BITS[role]][rpm] = link
+
+        # the RPMs of the region and those which can give them roles
+        influence = self.influence()
+        sources = bytearray(self.region)
+        for rpm in xrange(nb_rpms):
+            if not sources[rpm]:
+                for target in influence[rpm]:
+                    if self.region[target]:
+                        sources[rpm] = 1
+                        break
+        self.sources = [rpm for rpm in xrange(nb_rpms) if sources[rpm]]
+
+    def qualified_nvras(self):
+        """ {role: NVRAs}, to be given to restrict_to() in the next run """
+        return dict((role, [self.rpm_nvras[rpm] for rpm, qualified in enumerate(self.qualified[ROLE_BITS[role]])
+                            if qualified])
+                    for role in ORDER_SENSITIVE_ROLES)
+
+    def in_region(self, rpm):
+        return self.region is None or self.region[rpm]
+
+    def has_no_roles(self, rpm, role_bit, srpm_too=False):
+        """
+        Whether the RPM (and with srpm_too, any RPM of its SRPM) has no roles when processed to give
+        role_bit to other RPMs. Outside of the region, that's what the previous run recorded.
+        """
+        if not self.in_region(rpm):
+            return self.qualified[role_bit][rpm]
+        qualified = not self.role_masks[rpm] and not (srpm_too and self.srpm_has_roles[self.srpm_of[rpm]])
+        self.qualified[role_bit][rpm] = qualified
+        return qualified
+
+    def add_rpm_role(self, rpm, role_bit, related, link=None):
+        """ link: (RPM which gives the role, its role bit that gives it), recorded the first time """
+        if not self.in_region(rpm):
+            # already has its roles from the previous run
+            return
+        mask = self.role_masks[rpm]
+        if not mask:
+            for srpm in self.listed_by[rpm]:
+                self.srpm_has_roles[srpm] = 1
+        if mask & role_bit:
+            self.related[role_bit][rpm].add(related)
+        else:
+            self.role_masks[rpm] = mask | role_bit
+            self.related[role_bit][rpm] = set([related])
+            self.links[role_bit][rpm] = link
+
+    def compute_roles(self, rpms_installed_by_default, extra_installable_nvra):
+        """
+        Update RPM roles
+        For each RPM we store mosts roles as well as the related RPMs or SRPMs:
+        - main: RPMs installed by default
+        - extra: RPMs available in the repos and available for installation on dom0
+        - extra_dep: RPMs that are pulled as dependencies for extra RPMs and aren't extra or main
+        - main_builddep: direct build dependency for a SRPM that produces main RPMs
+        - main_builddep_dep: dependency of a main_builddep RPM
+        - main_indirect_builddep: builddep of a builddep or of a dep of a builddep, with no limits of depth
+        - extra_builddep: build dependency for a SRPM that produces an extra package or one of its dependencies
+        - extra_builddep_dep: dependency of an extra_builddep RPM
+        - extra_indirect_builddep: builddep of a builddep or of a dep of a builddep, with no limits of depth
+        - other_builddep: direct build dependency for a SRPM that has no RPM with a role
+        - other_builddep_dep: dependency of a other_builddep
+        - other_indirect_builddep: builddep of a builddep or of a dep of a builddep, with no limits of depth
+        - other_dep: dependency for a package that has no roles, not even other_builddep_xxx or other_indirect_builddep
+                     the "other_dep" package must also have no roles itself, except other_*
+        - None: no roles
+
+        RPMs are processed in the iteration order of xcp_rpms, as they always were: whether
+        a role is given can depend on the roles given before. See reordered().
+        """
+        installed_by_default = set(rpms_installed_by_default)
+        extra_installable = set(extra_installable_nvra)
+        for rpm in self.sources:
+            rpm_nvra = self.rpm_nvras[rpm]
+            if rpm_nvra in installed_by_default:
+                # for now the related RPM for the 'main' role is the RPM itself
+                # in the future we may want to improve this and detail the dependency chain more
+                self.add_rpm_role(rpm, ROLE_BITS['main'], rpm)
+
+            if rpm_nvra in extra_installable:
+                self.add_rpm_role(rpm, ROLE_BITS['extra'], rpm)
+
+        for rpm in self.sources:
+            if self.rpm_nvras[rpm] in extra_installable:
+                for dep in self.deps[rpm]:
+                    if not self.role_masks[dep]:
+                        self.add_rpm_role(dep, ROLE_BITS['extra_dep'], rpm, (rpm, ROLE_BITS['extra']))
+
+        self.update_builddep_role(roles_from=['main'], role_to='main_builddep', direct=True)
+        self.update_builddep_role(roles_from=['main'], role_to='main_builddep_dep', direct=False)
+        self.update_indirect_builddep_role(role_prefix='main', role_to='main_indirect_builddep')
+        self.update_builddep_role(roles_from=['extra', 'extra_dep'], role_to='extra_builddep', direct=True)
+        self.update_builddep_role(roles_from=['extra', 'extra_dep'], role_to='extra_builddep_dep', direct=False)
+        self.update_indirect_builddep_role(role_prefix='extra', role_to='extra_indirect_builddep')
+
+        # Now deps of RPMs that still have no roles
+        self.update_builddep_role(roles_from=[], role_to='other_builddep', direct=True)
+        self.update_builddep_role(roles_from=[], role_to='other_builddep_dep', direct=False)
+        self.update_indirect_builddep_role(role_prefix='other', role_to='other_indirect_builddep')
+        for rpm in self.sources:
+            if self.has_no_roles(rpm, ROLE_BITS['other_dep']):
+                for dep in self.deps[rpm]:
+                    # other_dep possible only if has no other role than 'other_*'
+                    if not self.role_masks[dep] & ~OTHER_ROLES_MASK:
+                        self.add_rpm_role(dep, ROLE_BITS['other_dep'], rpm, (rpm, 0))
+
+    def update_builddep_role(self, roles_from, role_to, direct):
+        """
+        Identify and flag RPMs that are builddeps or deps of builddeps.
+        With no roles_from, flag those of RPMs that have no roles.
+        """
+        from_mask = sum(ROLE_BITS[role] for role in roles_from)
+        role_bit = ROLE_BITS[role_to]
+        build_deps = self.build_deps[0 if direct else 1]
+        for rpm in self.sources:
+            # if roles_from is empty and the RPM belongs to a SRPM that already has RPMs with roles,
+            # don't retain that RPM. We don't want other_builddep and other_builddep_dep to pop everywhere
+            # a SRPM produces an unused RPM among other useful RPMs
+            if (self.role_masks[rpm] & from_mask) if from_mask else self.has_no_roles(rpm, role_bit, srpm_too=True):
+                # the lowest role bit, i.e. main or extra rather than extra_dep
+                from_bits = self.role_masks[rpm] & from_mask
+                link = (rpm, from_bits & -from_bits)
+                srpm = self.srpm_of[rpm]
+                for dep in build_deps[srpm]:
+                    self.add_rpm_role(dep, role_bit, srpm, link)
+
+    def update_indirect_builddep_role(self, role_prefix, role_to):
         """
         Identify and flag RPMs that are builddeps for builddeps themselves.
         Or deps of builddeps of builddeps.
         Or builddeps of deps of builddeps of deps of builddeps.
         Or builddeps of builddeps of deps of builddeps of builddeps of builddeps
         All of them.
+
+        Interpretation:
+        If...
+        1. dep_rpm        ---(direct or pulled build dep of)--->     srpm
+        2. srpm           -------------(produces)-------------->     rpm
+        3. rpm            ------("role_from" build dep of)----->     upper_srpm
+        Then...
+        dep_rpm           -------("role_to" build dep of)------>     upper_srpm
+        Since the roles_from are already build deps, the SRPMs to point as target of the
+        indirect builddep must be those that the build deps themselves target.
+
+        Evaluated until nothing changes: after the first round, only the upper SRPMs that were
+        newly added to an RPM in the previous round are propagated to the builddeps of its SRPM.
         """
-        # Start with builddeps (direct or not) of RPMs whose role starts with role_prefix
-        for i in xrange(iterations):
-            if i == 0:
-                roles_to_scan = [role_prefix + '_builddep', role_prefix + '_builddep_dep']
-            else:
-                roles_to_scan = [role_to] # after the first iteration
-            for rpm_nvra in xcp_rpms:
-                if intersect_or_both_empty(xcp_rpms[rpm_nvra]['roles'].keys(), roles_to_scan):
-                    # if roles_to_scan is empty and the RPM belongs to a SRPM that already has RPMs with roles,
-                    # don't retain that RPM. We don't want other_indirect_builddep to pop everywhere
-                    # a SRPM produces an unused RPM among other useful RPMs
-                    if not roles_to_scan and srpm_rpms_have_roles(xcp_rpms, xcp_builds, srpm_nvr):
-                        continue
-                    # scan the builddeps of its SRPM
-                    srpm_nvr = xcp_rpms[rpm_nvra]['srpm_nvr']
-                    if srpm_nvr in xcp_builds and 'build-deps' in xcp_builds[srpm_nvr]:
-                        for dep_type in [0, 1]:
-                            for dep_rpm_nvra in xcp_builds[srpm_nvr]['build-deps'][dep_type]:
-                                # since the roles_to_scan are already build deps, the SRPMs to point
-                                # as target of the indirect builddep must be those that the build deps
-                                # themselves target
-                                for role_from in roles_to_scan:
-                                    for upper_srpm_nvr in xcp_rpms[rpm_nvra]['roles'].get(role_from, []):
-                                        # Interpretation:
-                                        # If...
-                                        # 1. dep_rpm_nvra   ---(direct or pulled build dep of)--->     srpm_nvr
-                                        # 2. srpm_nvr       -------------(produces)-------------->     rpm_nvra
-                                        # 3. rpm_nvra       ------("role_from" build dep of)----->     upper_srpm_nvr
-                                        # Then...
-                                        # dep_rpm_nvra      -------("role_to" build dep of)------>     upper_srpm_nvr
-                                        add_rpm_role(xcp_rpms, dep_rpm_nvra, role_to, upper_srpm_nvr)
-
-    update_builddep_role(xcp_rpms, xcp_builds, roles_from=['main'], role_to='main_builddep', direct=True)
-    update_builddep_role(xcp_rpms, xcp_builds, roles_from=['main'], role_to='main_builddep_dep', direct=False)
-    update_indirect_builddep_role(xcp_rpms, xcp_builds, role_prefix='main', role_to='main_indirect_builddep')
-    update_builddep_role(xcp_rpms, xcp_builds, roles_from=['extra', 'extra_dep'], role_to='extra_builddep', direct=True)
-    update_builddep_role(xcp_rpms, xcp_builds, roles_from=['extra', 'extra_dep'], role_to='extra_builddep_dep', direct=False)
-    update_indirect_builddep_role(xcp_rpms, xcp_builds, role_prefix='extra', role_to='extra_indirect_builddep')
-
-    # Now deps of RPMs that still have no roles
-    update_builddep_role(xcp_rpms, xcp_builds, roles_from=[], role_to='other_builddep', direct=True)
-    update_builddep_role(xcp_rpms, xcp_builds, roles_from=[], role_to='other_builddep_dep', direct=False)
-    update_indirect_builddep_role(xcp_rpms, xcp_builds, role_prefix='other', role_to='other_indirect_builddep')
-    for rpm_nvra in xcp_rpms:
-        if not xcp_rpms[rpm_nvra]['roles']:
-            for dep in xcp_rpms[rpm_nvra]['deps']:
-                # other_dep possible only if has no other role than 'other_*'
-                if not [x for x in xcp_rpms[dep]['roles'] if not x.startswith('other_')]:
-                    add_rpm_role(xcp_rpms, dep, 'other_dep', rpm_nvra)
+        role_bit = ROLE_BITS[role_to]
+        related_to = self.related[role_bit]
+        from_bits = [ROLE_BITS[role_prefix + '_builddep'], ROLE_BITS[role_prefix + '_builddep_dep']]
+        from_mask = from_bits[0] | from_bits[1]
 
-    # Write RPM data to file
-    with open(os.path.join(work_dir, 'xcp-ng_rpms.json'), 'w') as f:
-        f.write(json.dumps(xcp_rpms, sort_keys=True, indent=4, cls=JsonSortAndEncode))
+        # Start with builddeps (direct or not) of RPMs whose role is role_prefix_builddep(_dep)
+        for rpm in self.sources:
+            if self.role_masks[rpm] & from_mask:
+                srpm = self.srpm_of[rpm]
+                for build_deps in self.build_deps:
+                    for dep_rpm in build_deps[srpm]:
+                        for from_bit in from_bits:
+                            for upper_srpm in self.related[from_bit].get(rpm, ()):
+                                self.add_rpm_role(dep_rpm, role_bit, upper_srpm, (rpm, from_bit))
 
-    # Update SRPM roles based on RPM roles
-    for srpm_nvr, build_info in xcp_builds.iteritems():
+        # Then propagate role_to itself: {srpm: (upper SRPMs not propagated yet to its builddeps, RPM to link to)}
+        # The related SRPMs only depend on the SRPM the RPM comes from, so work per SRPM.
+        # Outside of the region, RPMs already have all their upper SRPMs.
+        # Links are set the first time an RPM gets the role: propagating in rounds, that's by a shortest chain.
+        to_propagate = {}
+        for rpm in self.sources:
+            if rpm in related_to:
+                to_propagate.setdefault(self.srpm_of[rpm], (set(), rpm))[0].update(related_to[rpm])
+        while to_propagate:
+            next_to_propagate = {}
+            for srpm, (upper_srpms, link_rpm) in to_propagate.iteritems():
+                for build_deps in self.build_deps:
+                    for dep_rpm in build_deps[srpm]:
+                        if not self.in_region(dep_rpm):
+                            continue
+                        new = upper_srpms - related_to.get(dep_rpm, set())
+                        if not new:
+                            continue
+                        for upper_srpm in new:
+                            self.add_rpm_role(dep_rpm, role_bit, upper_srpm, (link_rpm, role_bit))
+                        next_to_propagate.setdefault(self.srpm_of[dep_rpm], (set(), dep_rpm))[0].update(new)
+            to_propagate = next_to_propagate
+
+    def link_rows(self):
+        """ rows of the roles index, see roleindex.RoleIndex """
+        for role in ROLES:
+            role_bit = ROLE_BITS[role]
+            for rpm, link in self.links[role_bit].iteritems():
+                if link is None:
+                    yield (self.rpm_nvras[rpm], role, None, None, None)
+                    continue
+                pred, pred_bit = link
+                srpm_nvr = None if role_bit & RPM_RELATED_ROLES_MASK else self.srpm_nvrs[self.srpm_of[pred]]
+                yield (self.rpm_nvras[rpm], role, self.rpm_nvras[pred], BIT_ROLES.get(pred_bit), srpm_nvr)
+
+    def _names(self, role_bit, ids):
+        return set((self.rpm_nvras if role_bit & RPM_RELATED_ROLES_MASK else self.srpm_nvrs)[i] for i in ids)
+
+    def rpm_roles(self, rpm):
+        """ {role: set of related NVRAs or SRPM NVRs} """
+        roles = {}
+        mask = self.role_masks[rpm]
+        for role in ROLES:
+            role_bit = ROLE_BITS[role]
+            if mask & role_bit:
+                roles[role] = self._names(role_bit, self.related[role_bit][rpm])
+        return roles
+
+    def srpm_roles(self, srpm):
+        """ {role: set of related NVRAs or SRPM NVRs}, union of the roles of the RPMs of the SRPM """
         srpm_roles = {}
-        for rpm_nvra in build_info['rpms']:
-            for rpm_role, role_data in xcp_rpms[rpm_nvra]['roles'].iteritems():
-                if rpm_role in ('extra_dep', 'other_dep'):
+        for rpm in self.srpm_rpms[srpm]:
+            mask = self.role_masks[rpm]
+            for role in ROLES:
+                role_bit = ROLE_BITS[role]
+                if not mask & role_bit:
+                    continue
+                role_data = self.related[role_bit][rpm]
+                if role in ('extra_dep', 'other_dep'):
                     # ignore deps towards RPM of the same SRPM
-                    role_data = [x for x in role_data if xcp_rpms[x]['srpm_nvr'] != srpm_nvr]
+                    role_data = [x for x in role_data if self.srpm_of[x] != srpm]
 
                 if not role_data:
                     continue
 
-                if rpm_role not in srpm_roles:
-                    srpm_roles[rpm_role] = set()
-                srpm_roles[rpm_role].update(role_data)
-        build_info['roles'] = srpm_roles
+                if role not in srpm_roles:
+                    srpm_roles[role] = set()
+                srpm_roles[role].update(role_data)
+        return dict((role, self._names(ROLE_BITS[role], ids)) for role, ids in srpm_roles.items())
+
+def get_changed_rpms(xcp_rpms, xcp_builds, previous_rpms, previous_builds, main_and_extra, previous_main_and_extra):
+    """
+    NVRAs of the RPMs that were added or removed since the previous run, whose deps, SRPM or build
+    deps of their SRPM changed, or which became or stopped being main or extra packages.
+    """
+    changed = set()
+    for rpm_nvra in set(xcp_rpms) | set(previous_rpms):
+        rpm_info = xcp_rpms.get(rpm_nvra)
+        prev_rpm_info = previous_rpms.get(rpm_nvra)
+        if (rpm_info is None or prev_rpm_info is None or rpm_info['deps'] != prev_rpm_info['deps']
+                or rpm_info['srpm_nvr'] != prev_rpm_info['srpm_nvr']):
+            changed.add(rpm_nvra)
+    for srpm_nvr in set(xcp_builds) | set(previous_builds):
+        build_info = xcp_builds.get(srpm_nvr, {})
+        prev_build_info = previous_builds.get(srpm_nvr, {})
+        if (build_info.get('build-deps') != prev_build_info.get('build-deps')
+                or build_info.get('rpms') != prev_build_info.get('rpms')):
+            changed.update(build_info.get('rpms', []))
+            changed.update(prev_build_info.get('rpms', []))
+    for main_or_extra, prev_main_or_extra in zip(main_and_extra, previous_main_and_extra):
+        changed.update(set(main_or_extra) ^ set(prev_main_or_extra))
+    return changed
+
+def get_region(graph, previous_graph, changed):
+    """ the changed RPMs and all those whose roles can depend on theirs, now or in the previous run """
+    region = set(changed)
+    while True:
+        grown = region | graph.influenced(region) | previous_graph.influenced(region)
+        if len(grown) == len(region):
+            return region
+        region = grown
+
+def restrict_to_changes(graph, xcp_rpms, xcp_builds, main_and_extra, state, previous_rpms, previous_builds,
+                        previous_links):
+    """
+    Restrict the graph to the RPMs whose roles can have changed since the previous run, which wrote
+    state, previous_rpms, previous_builds and previous_links. See RoleGraph.restrict_to().
+    Returns the numbers of RPMs that changed, and of the other RPMs that are processed in another order.
+    """
+    changed = get_changed_rpms(xcp_rpms, xcp_builds, previous_rpms, previous_builds, main_and_extra,
+                               [state['rpms_installed_by_default'], state['extra_installable']])
+    reordered = graph.reordered(state['order'])
+    region = get_region(graph, RoleGraph(previous_rpms, previous_builds), changed | reordered)
+    graph.restrict_to(region, previous_rpms, state['qualified'], previous_links)
+    return len(changed), len(reordered - changed)
+
+def roles_state(graph, rpms_installed_by_default, extra_installable_nvra):
+    """ what the next run needs to know about this one, besides the roles, for restrict_to_changes() """
+    return {'rpms_installed_by_default': sorted(rpms_installed_by_default),
+            'extra_installable': sorted(extra_installable_nvra),
+            'order': graph.rpm_nvras,
+            'qualified': graph.qualified_nvras()}
+
+def main():
+    parser = argparse.ArgumentParser(description='Extract package roles for XCP-ng RPMs')
+    parser.add_argument('version', help='XCP-ng 2-digit version, e.g. 8.0')
+    parser.add_argument('basedir', help='path to the base directory where repos must be present and where '
+                                        'we\'ll read data / output results.')
+    parser.add_argument('--sqlite-store', action='store_true',
+                        help='read and write the data shared between stages in workdir/{version}/%s '
+                             'instead of JSON files' % workdir_store.SQLITE_FILENAME)
+    parser.add_argument('--incremental', action='store_true',
+                        help='only recompute the roles that can have changed since the previous run, '
+                             'reusing the previous xcp-ng_rpms.json for the others')
+    parser.add_argument('--check', action='store_true',
+                        help='with --incremental, also compute all the roles from scratch and fail if they differ')
+    args = parser.parse_args()
+
+    base_dir = os.path.abspath(check_dir(args.basedir))
+    xcp_version = args.version
+    work_dir = check_dir(os.path.join(base_dir, 'workdir', xcp_version))
+
+    # Read data from workdir
+    workdir = workdir_store.open_workdir(work_dir, args.sqlite_store)
+    extra_installable_nvra = workdir.read('extra_installable_nvra.json')
+    rpms_installed_by_default = workdir.read('rpms_installed_by_default_nvra.json')
+    xcp_builds = workdir.read('xcp-ng_builds_WIP2.json')
+    xcp_rpms = workdir.read('xcp-ng_rpms_WIP2.json')
+
+    role_index = roleindex.RoleIndex(os.path.join(work_dir, roleindex.INDEX_FILENAME))
+
+    # Update RPM roles, see RoleGraph.compute_roles()
+    graph = RoleGraph(xcp_rpms, xcp_builds)
+    state = None
+    if args.incremental and not role_index.is_empty() and (workdir.exists(STATE_DOCUMENT)
+                                                           and workdir.exists('xcp-ng_rpms.json')
+                                                           and workdir.exists('xcp-ng_builds.json')):
+        state = workdir.read(STATE_DOCUMENT)
+    if args.incremental and (state is None or 'order' not in state):
+        print("No previous roles to start from, computing all of them")
+    elif args.incremental:
+        nb_changed, nb_reordered = restrict_to_changes(graph, xcp_rpms, xcp_builds,
+                                                       [rpms_installed_by_default, extra_installable_nvra], state,
+                                                       workdir.read('xcp-ng_rpms.json'),
+                                                       workdir.read('xcp-ng_builds.json'), role_index.read())
+        print("%d RPMs changed, %d others are processed in another order, recomputing the roles of %d RPMs "
+              "out of %d" % (nb_changed, nb_reordered, sum(graph.region), len(graph.rpm_nvras)))
+    graph.compute_roles(rpms_installed_by_default, extra_installable_nvra)
+
+    if args.check and graph.region is not None:
+        full_graph = RoleGraph(xcp_rpms, xcp_builds)
+        full_graph.compute_roles(rpms_installed_by_default, extra_installable_nvra)
+        different = [rpm_nvra for rpm, rpm_nvra in enumerate(graph.rpm_nvras)
+                     if graph.rpm_roles(rpm) != full_graph.rpm_roles(rpm)]
+        if different:
+            raise Exception("Incremental roles differ from a full computation for %d RPMs, e.g. %s"
+                            % (len(different), different[0]))
+
+    # Write RPM data to file
+    for rpm, rpm_nvra in enumerate(graph.rpm_nvras):
+        xcp_rpms[rpm_nvra]['roles'] = graph.rpm_roles(rpm)
+    workdir.write('xcp-ng_rpms.json', xcp_rpms, cls=JsonSortAndEncode)
+    workdir.write(STATE_DOCUMENT, roles_state(graph, rpms_installed_by_default, extra_installable_nvra))
+    role_index.write(graph.link_rows())
+    role_index.close()
+
+    # Update SRPM roles based on RPM roles
+    for srpm_nvr, build_info in xcp_builds.iteritems():
+        build_info['roles'] = graph.srpm_roles(graph.srpm_ids[srpm_nvr])
 
     # Write SRPM data to file
-    with open(os.path.join(work_dir, 'xcp-ng_builds.json'), 'w') as f:
-        f.write(json.dumps(xcp_builds, sort_keys=True, indent=4, cls=JsonSortAndEncode))
+    workdir.write('xcp-ng_builds.json', xcp_builds, cls=JsonSortAndEncode)
+    workdir.close()
 
 if __name__ == "__main__":
     main()
@@ -18,11 +18,14 @@ import argparse
 import os
 import json
 import codecs
+import operator
 import StringIO
 import markdown
-import rpm
 import urllib
 
+import evrkey
+import workdir_store
+
 KOJI_URL = "https://koji.xcp-ng.org"
 KOJI_BUILD_URL = KOJI_URL + "/search?match=exact&type=build&terms=%s"
 # Unless you know an exact *binary* RPM name, there's no better URL than a simple search on the name, without the version
@@ -34,6 +37,10 @@ CENTOS_RPM_URL = "https://pkgs.org/download/%s"
 # and I don't want to put too much burden on it (if for example a crawler tries every URL)
 EPEL_RPM_URL = "https://pkgs.org/download/%s"
 
+# fields that can be in a report, see row_formatter()
+ROW_FIELDS = ['srpm_name', 'repo', 'version', 'centos_version', 'epel_version', 'summary', 'built_by', 'added_by',
+              'import_reason', 'main_role', 'roles', 'direct_build_deps', 'rpms']
+
 def check_dir(dirpath):
     if not os.path.isdir(dirpath):
         raise Exception("Directory %s doesn't exist" % dirpath)
@@ -66,26 +73,6 @@ def js_color_cell_values(values=[], color='black'):
     }
 """ % (json.dumps(values), color)
 
-# From https://docs.python.org/3/howto/sorting.html
-def cmp_to_key(mycmp):
-    'Convert a cmp= function into a key= function'
-    class K(object):
-        def __init__(self, obj, *args):
-            self.obj = obj
-        def __lt__(self, other):
-            return mycmp(self.obj, other.obj) < 0
-        def __gt__(self, other):
-            return mycmp(self.obj, other.obj) > 0
-        def __eq__(self, other):
-            return mycmp(self.obj, other.obj) == 0
-        def __le__(self, other):
-            return mycmp(self.obj, other.obj) <= 0
-        def __ge__(self, other):
-            return mycmp(self.obj, other.obj) >= 0
-        def __ne__(self, other):
-            return mycmp(self.obj, other.obj) != 0
-    return K
-
 def simplify_roles(roles):
     # Most packages have lots of roles, so we need to simplify visually
     # Rules:
@@ -123,18 +110,117 @@ def simplify_roles(roles):
             if role.startswith('other'):
                 del roles[role]
 
+def row_formatter(fields):
+    """ returns a function which makes a row out of a dict {field: value} """
+    for field in fields:
+        if field not in ROW_FIELDS:
+            raise Exception("Couldn't handle field '%s'" % field)
+    if len(fields) == 1:
+        return lambda values: [values[fields[0]]]
+    get_fields = operator.itemgetter(*fields)
+    return lambda values: list(get_fields(values))
+
+def row_sort_key(headers, role_ranks, built_by_ranks):
+    """ sort by main role, then by who built the SRPM, then by name """
+    role_index = headers.index('main_role')
+    built_by_index = headers.index('built_by')
+    name_index = headers.index('srpm_name')
+    return lambda row: (role_ranks[row[role_index]], built_by_ranks[row[built_by_index]], row[name_index])
+
+def write_csv(path, report):
+    with codecs.open(path, 'w', encoding='utf8') as f:
+        for row in report:
+            row = [field.replace('\n', ' - ') for field in row]
+            f.write(';'.join(row) + '\n')
+
+def markdown_table(report):
+    s = StringIO.StringIO()
+    try:
+        s.write(' | '.join(report[0]) + '\n')
+        separator = '-'
+        for i in xrange(len(report[0]) - 1):
+            separator += ' | -'
+        s.write(separator + '\n')
+
+        for row in report[1:]:
+            row = [field.replace('\n', '<br>') for field in row]
+            s.write(' | '.join(row) + '\n')
+        return s.getvalue()
+    finally:
+        s.close()
+
+def write_markdown(path, table):
+    with codecs.open(path, 'w', encoding='utf8') as f:
+        f.write(table)
+
+def write_html(path, table, role_priority):
+    with codecs.open(path, 'w', encoding='utf8') as f:
+        f.write("""
+<!DOCTYPE html>
+<html lang="en">
+<head>
+<meta charset="utf-8"/>
+<style>
+table {
+    border-width: 1px;
+    border-collapse: collapse;
+}
+td, th {
+    font-size: 0.75em;
+    border-width: 1px;
+    border-color: silver;
+    border-style: solid;
+    padding: 2px;
+}
+</style>
+</head>
+
+""")
+        f.write(markdown.markdown(table, extensions=['tables']))
+        script = """
+<script>
+var table = document.getElementsByTagName('table')[0];
+var tbody = table.getElementsByTagName('tbody')[0];
+var cells = tbody.getElementsByTagName('td');
+
+for (var i=0, len=cells.length; i<len; i++){
+"""
+        script += js_color_cell_values([v for v in role_priority if v.startswith('main')], 'green')
+        script += js_color_cell_values([v for v in role_priority if v.startswith('extra')], 'blue')
+        script += js_color_cell_values([v for v in role_priority if v.startswith('other')] + ['None'], 'tomato')
+        script += js_color_cell_values(['updates'], 'blue')
+        script += js_color_cell_values(['candidates'], 'orangered')
+        script += js_color_cell_values(['testing'], 'orangered')
+        script += js_color_cell_values(['ci'], 'orangered')
+        script += js_color_cell_values(['xcp-ng'], '#263740')
+        script += js_color_cell_values(['centos'], 'sienna')
+        script += js_color_cell_values(['epel'], 'orchid')
+        script += js_color_cell_values(['xs'], 'tomato')
+        script += js_color_cell_values(['unknown'], 'red')
+        script += """
+}
+</script>
+</html>
+"""
+        f.write(script)
+
 def main():
     parser = argparse.ArgumentParser(description='Format reports about XCP-ng RPMs')
     parser.add_argument('version', help='XCP-ng 2-digit version, e.g. 8.0')
     parser.add_argument('basedir', help='path to the base directory where repos must be present and where '
                                         'we\'ll read data from.')
     format_choices = ['csv', 'markdown', 'html']
-    parser.add_argument('format', help='output format: %s.' % " or ".join(format_choices), choices=format_choices)
+    parser.add_argument('formats', help='output formats, comma-separated: %s. The data is read and the rows '
+                                        'are computed only once for all of them.' % ", ".join(format_choices))
+    parser.add_argument('--sqlite-store', action='store_true',
+                        help='read and write the data shared between stages in workdir/{version}/%s '
+                             'instead of JSON files' % workdir_store.SQLITE_FILENAME)
     args = parser.parse_args()
 
-    format = args.format
-    shorten_output = format != 'csv'
-    elaborate_output = format != 'csv'
+    formats = args.formats.split(',')
+    for format in formats:
+        if format not in format_choices:
+            parser.error("invalid format '%s' (choose from %s)" % (format, ", ".join(format_choices)))
     base_dir = os.path.abspath(check_dir(args.basedir))
     xcp_version = args.version
     xcp_srpm_repo = check_dir(os.path.join(base_dir, 'xcp-ng', xcp_version))
@@ -145,10 +231,10 @@ def main():
         os.mkdir(reports_dir)
 
     # Read data from workdir
-    with open(os.path.join(work_dir, 'xcp-ng_builds.json')) as f:
-        xcp_builds = json.load(f)
-    with open(os.path.join(work_dir, 'xcp-ng_rpms.json')) as f:
-        xcp_rpms = json.load(f)
+    workdir = workdir_store.open_workdir(work_dir, args.sqlite_store)
+    xcp_builds = workdir.read('xcp-ng_builds.json')
+    xcp_rpms = workdir.read('xcp-ng_rpms.json')
+    workdir.close()
 
     role_priority = [
         'main',
@@ -212,9 +298,17 @@ def main():
         ]
     }
 
+    # functions which make a row of each report out of the values of the fields for a SRPM
+    row_formatters = dict((report_name, row_formatter(fields)) for report_name, fields in srpm_reports_ref.items())
+
+    # csv reports are neither shortened nor elaborate (links), the other formats are.
+    # Rows are computed once for each of those two kinds of output, and shared by the formats.
+    elaborate_kinds = sorted(set(format != 'csv' for format in formats))
     srpm_reports = {}
-    for report_name in srpm_reports_ref:
-        srpm_reports[report_name] = []
+    for elaborate_output in elaborate_kinds:
+        srpm_reports[elaborate_output] = {}
+        for report_name in srpm_reports_ref:
+            srpm_reports[elaborate_output][report_name] = []
 
     # data
     for srpm_nvr, build_info in xcp_builds.iteritems():
@@ -228,31 +322,13 @@ def main():
         # roles
         simplify_roles(build_info['roles'])
         main_role = None
-        roles_list = []
         for role in role_priority:
             if role in build_info['roles']:
-                if main_role is None:
-                    main_role = role
-                roles_list.append(format_role(xcp_builds, xcp_rpms, role, build_info['roles'][role],
-                                              max_entries=5 if shorten_output else None))
-        roles = "\n".join(roles_list)
+                main_role = role
+                break
         if main_role is None:
             main_role = 'None'
 
-        # build deps are present only for packages built by XCP-ng
-        direct_build_deps = ""
-        if 'build-deps' in build_info:
-            direct_build_deps_list = [xcp_rpms[rpm_nvra]['name'] for rpm_nvra in build_info['build-deps'][0]]
-            if shorten_output and len(direct_build_deps_list) > 10:
-                direct_build_deps_list = direct_build_deps_list[:10] + ['...']
-            direct_build_deps = " ".join(direct_build_deps_list)
-
-        # rpms
-        rpms_list = [xcp_rpms[rpm_nvra]['name'] for rpm_nvra in build_info['rpms']]
-        if shorten_output and len(rpms_list) > 10:
-            rpms_list = rpms_list[:10] + ['...']
-        rpms = " ".join(rpms_list)
-
         # versions: highest version in bold display
         # note: voluntarily avoiding epoch in version comparisons because we might have different epochs
         version = build_info['version'] + '-' + build_info['release']
@@ -270,7 +346,7 @@ def main():
             epel_version = ""
             epel_nvr_tuple = ('0', '0', '0')
 
-        max_nvr_tuple = max([nvr_tuple, centos_nvr_tuple, epel_nvr_tuple], key=cmp_to_key(rpm.labelCompare))
+        max_nvr_tuple = max([nvr_tuple, centos_nvr_tuple, epel_nvr_tuple], key=evrkey.evr_tuple_key)
         if max_nvr_tuple == nvr_tuple:
             if (centos_version or epel_version) and max_nvr_tuple not in [epel_nvr_tuple, centos_nvr_tuple]:
                 version = '**%s**' % version
@@ -279,49 +355,53 @@ def main():
         elif max_nvr_tuple == epel_nvr_tuple:
             epel_version = '**%s**' % epel_version
 
-        # add data to reports
-        for report_name, report in srpm_reports.iteritems():
-            row = []
-            for field in srpm_reports_ref[report_name]:
-                if field == 'srpm_name':
-                    if elaborate_output:
-                        value = "[%s](%s)" % (srpm_name, KOJI_BUILD_URL % urllib.quote(srpm_nvr))
-                    else:
-                        value = srpm_name
-                elif field == 'repo':
-                    value = repo
-                elif field == 'version':
-                    value = version
-                elif field == 'centos_version':
-                    if centos_version and elaborate_output:
-                        value = "[%s](%s)" % (centos_version, CENTOS_RPM_URL % srpm_name)
-                    else:
-                        value = centos_version
-                elif field == 'epel_version':
-                    if epel_version and elaborate_output:
-                        value = "[%s](%s)" % (epel_version, EPEL_RPM_URL % srpm_name)
-                    else:
-                        value = epel_version
-                elif field == 'summary':
-                    value = summary
-                elif field == 'built_by':
-                    value = built_by
-                elif field == 'added_by':
-                    value= added_by
-                elif field == 'import_reason':
-                    value= import_reason
-                elif field == 'main_role':
-                    value = main_role
-                elif field == 'roles':
-                    value = roles
-                elif field == 'direct_build_deps':
-                    value = direct_build_deps
-                elif field == 'rpms':
-                    value = rpms
-                else:
-                    raise Exception("Couldn't handle field '%s'" % field)
-                row.append(value)
-            report.append(row)
+        for elaborate_output in elaborate_kinds:
+            shorten_output = elaborate_output
+            roles_list = []
+            for role in role_priority:
+                if role in build_info['roles']:
+                    roles_list.append(format_role(xcp_builds, xcp_rpms, role, build_info['roles'][role],
+                                                  max_entries=5 if shorten_output else None))
+            roles = "\n".join(roles_list)
+
+            # build deps are present only for packages built by XCP-ng
+            direct_build_deps = ""
+            if 'build-deps' in build_info:
+                direct_build_deps_list = [xcp_rpms[rpm_nvra]['name'] for rpm_nvra in build_info['build-deps'][0]]
+                if shorten_output and len(direct_build_deps_list) > 10:
+                    direct_build_deps_list = direct_build_deps_list[:10] + ['...']
+                direct_build_deps = " ".join(direct_build_deps_list)
+
+            # rpms
+            rpms_list = [xcp_rpms[rpm_nvra]['name'] for rpm_nvra in build_info['rpms']]
+            if shorten_output and len(rpms_list) > 10:
+                rpms_list = rpms_list[:10] + ['...']
+            rpms = " ".join(rpms_list)
+
+            # add data to reports
+            values = {
+                'srpm_name': srpm_name,
+                'repo': repo,
+                'version': version,
+                'centos_version': centos_version,
+                'epel_version': epel_version,
+                'summary': summary,
+                'built_by': built_by,
+                'added_by': added_by,
+                'import_reason': import_reason,
+                'main_role': main_role,
+                'roles': roles,
+                'direct_build_deps': direct_build_deps,
+                'rpms': rpms,
+            }
+            if elaborate_output:
+                values['srpm_name'] = "[%s](%s)" % (srpm_name, KOJI_BUILD_URL % urllib.quote(srpm_nvr))
+                if centos_version:
+                    values['centos_version'] = "[%s](%s)" % (centos_version, CENTOS_RPM_URL % srpm_name)
+                if epel_version:
+                    values['epel_version'] = "[%s](%s)" % (epel_version, EPEL_RPM_URL % srpm_name)
+            for report_name, report in srpm_reports[elaborate_output].iteritems():
+                report.append(row_formatters[report_name](values))
 
     # sort rows in reports
     built_by_order = [
@@ -333,105 +413,30 @@ def main():
     ]
     role_priority.append('None')
 
-    for report_name, report in srpm_reports.iteritems():
-        headers = srpm_reports_ref[report_name]
-        def custom_cmp(row1, row2):
-            role_index = headers.index('main_role')
-            if role_priority.index(row1[role_index]) > role_priority.index(row2[role_index]):
-                return 1
-            if role_priority.index(row1[role_index]) < role_priority.index(row2[role_index]):
-                return -1
-
-            built_by_index = headers.index('built_by')
-            if built_by_order.index(row1[built_by_index]) > built_by_order.index(row2[built_by_index]):
-                return 1
-            if built_by_order.index(row1[built_by_index]) < built_by_order.index(row2[built_by_index]):
-                return -1
-
-            name_index = headers.index('srpm_name')
-            return cmp([row1[name_index]], [row2[name_index]])
-
-        report.sort(cmp=custom_cmp)
-        # add header
-        report.insert(0, [srpm_fields_ref[field] for field in srpm_reports_ref[report_name]])
-
-        # format and write output
-        if format == 'csv':
-            with codecs.open(os.path.join(reports_dir, 'report_%s.csv' % report_name), 'w', encoding='utf8') as f:
-                for row in report:
-                    row = [field.replace('\n', ' - ') for field in row]
-                    f.write(';'.join(row) + '\n')
-        elif format in ['markdown', 'html']:
-            s = StringIO.StringIO()
-            s.write(' | '.join(report[0]) + '\n')
-            separator = '-'
-            for i in xrange(len(report[0]) - 1):
-                separator += ' | -'
-            s.write(separator + '\n')
-
-            for row in report[1:]:
-                row = [field.replace('\n', '<br>') for field in row]
-                s.write(' | '.join(row) + '\n')
-            try:
-                if format == 'markdown':
-                    with codecs.open(os.path.join(reports_dir, 'report_%s.md' % report_name), 'w', encoding='utf8') as f:
-                        f.write(s.getvalue())
-                elif format == 'html':
-                    with codecs.open(os.path.join(reports_dir, 'report_%s.html' % report_name), 'w', encoding='utf8') as f:
-                        f.write("""
-<!DOCTYPE html>
-<html lang="en">
-<head>
-<meta charset="utf-8"/>
-<style>
-table {
-    border-width: 1px;
-    border-collapse: collapse;
-}
-td, th {
-    font-size: 0.75em;
-    border-width: 1px;
-    border-color: silver;
-    border-style: solid;
-    padding: 2px;
-}
-</style>
-</head>
-
-""")
-                        f.write(markdown.markdown(s.getvalue(), extensions=['tables']))
-                        script = """
-<script>
-var table = document.getElementsByTagName('table')[0];
-var tbody = table.getElementsByTagName('tbody')[0];
-var cells = tbody.getElementsByTagName('td');
-
-for (var i=0, len=cells.length; i<len; i++){
-"""
-                        script += js_color_cell_values([v for v in role_priority if v.startswith('main')], 'green')
-                        script += js_color_cell_values([v for v in role_priority if v.startswith('extra')], 'blue')
-                        script += js_color_cell_values([v for v in role_priority if v.startswith('other')] + ['None'], 'tomato')
-                        script += js_color_cell_values(['updates'], 'blue')
-                        script += js_color_cell_values(['candidates'], 'orangered')
-                        script += js_color_cell_values(['testing'], 'orangered')
-                        script += js_color_cell_values(['ci'], 'orangered')
-                        script += js_color_cell_values(['xcp-ng'], '#263740')
-                        script += js_color_cell_values(['centos'], 'sienna')
-                        script += js_color_cell_values(['epel'], 'orchid')
-                        script += js_color_cell_values(['xs'], 'tomato')
-                        script += js_color_cell_values(['unknown'], 'red')
-                        script += """
-}
-</script>
-</html>
-"""
-                        f.write(script)
-                else:
-                    raise("Unexpected.")
-            finally:
-                s.close()
-        else:
-            raise("Oops, I don't know how to handle format '%s'." % format)
+    role_ranks = dict((role, rank) for rank, role in enumerate(role_priority))
+    built_by_ranks = dict((built_by, rank) for rank, built_by in enumerate(built_by_order))
+
+    for report_name, headers in srpm_reports_ref.iteritems():
+        sort_key = row_sort_key(headers, role_ranks, built_by_ranks)
+        for elaborate_output in elaborate_kinds:
+            report = srpm_reports[elaborate_output][report_name]
+            report.sort(key=sort_key)
+            # add header
+            report.insert(0, [srpm_fields_ref[field] for field in headers])
+
+        # format and write output, the markdown table is shared by markdown and html
+        table = None
+        for format in formats:
+            report = srpm_reports[format != 'csv'][report_name]
+            if format == 'csv':
+                write_csv(os.path.join(reports_dir, 'report_%s.csv' % report_name), report)
+                continue
+            if table is None:
+                table = markdown_table(report)
+            if format == 'markdown':
+                write_markdown(os.path.join(reports_dir, 'report_%s.md' % report_name), table)
+            elif format == 'html':
+                write_html(os.path.join(reports_dir, 'report_%s.html' % report_name), table, role_priority)
 
 if __name__ == "__main__":
     main()
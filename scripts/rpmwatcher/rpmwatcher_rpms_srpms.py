@@ -0,0 +1,45 @@
+#!/bin/env python
+
+"""
+List the RPMs of a directory along with their source RPM and name.
+
+Output, one line per RPM, sorted by filename: {rpm filename},{srpm filename},{rpm name}
+It is used by sync_repos.sh to produce the xcp-ng-rpms-srpms.txt file read by rpmwatcher_update.py.
+"""
+
+from __future__ import print_function
+
+import argparse
+import os
+import sys
+
+import rpmheaders
+
+
+def check_dir(dirpath):
+    if not os.path.isdir(dirpath):
+        raise Exception("Directory %s doesn't exist" % dirpath)
+    return dirpath
+
+def main():
+    parser = argparse.ArgumentParser(description='List RPMs with their source RPM')
+    parser.add_argument('rpmdir', help='directory that contains the RPMs')
+    parser.add_argument('--header-cache', help='path to the SQLite RPM header cache')
+    parser.add_argument('--jobs', type=int, default=1, help='number of processes used to read RPM headers')
+    args = parser.parse_args()
+
+    rpm_dir = os.path.abspath(check_dir(args.rpmdir))
+    header_cache = rpmheaders.HeaderCache(args.header_cache) if args.header_cache else None
+
+    filenames = sorted(filename for filename in os.listdir(rpm_dir) if filename.endswith('.rpm'))
+    headers = rpmheaders.get_headers([os.path.join(rpm_dir, filename) for filename in filenames],
+                                     header_cache, args.jobs)
+    for filename, header in zip(filenames, headers):
+        print("%s,%s,%s" % (filename, rpmheaders.format_value(header.sourcerpm), header.name))
+
+    if header_cache is not None:
+        header_cache.close()
+        print(header_cache.stats(), file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
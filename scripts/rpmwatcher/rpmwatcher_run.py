@@ -0,0 +1,265 @@
+#!/bin/env python
+
+"""
+Run the whole rpmwatcher pipeline for a given XCP-ng version. This is what run.sh calls.
+
+The stages run one after the other:
+    sync_repos -> update -> extract_deps -> extract_roles -> format_reports (html, markdown, csv)
+
+Before running a stage, we compute a fingerprint of its inputs: its command line, the contents
+of the scripts it runs, the contents of the workdir files it reads and the listing (name, size,
+mtime) of the repository directories it reads. If the fingerprint matches the one recorded after
+the last successful run of that stage and its outputs are still present, the stage is skipped.
+This matters most for extract_deps, which takes hours: with --local-mirror, it only needs to run
+when RPMs changed.
+
+sync_repos and update always run: their inputs are remote (rsync mirrors, koji).
+Likewise, unless --local-mirror is used, extract_deps also depends on the online XCP-ng
+repositories used from within the container, which can't be fingerprinted, so it always runs.
+
+With --sqlite-store, the stages keep their documents in workdir/{version}/rpmwatcher.sqlite
+instead of JSON files, see workdir_store.py. Since all the stages write to that file, a stage's
+inputs and outputs are then the documents it reads and writes in the database: their digests
+are part of the fingerprint instead of the contents of the whole file.
+
+Fingerprints are stored in workdir/{version}/pipeline_state.json.
+"""
+
+from __future__ import print_function
+
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import subprocess
+import sys
+import time
+from collections import namedtuple
+
+import roleindex
+import workdir_store
+
+CENTOS_VERSION = '7.5.1804'
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+STATE_FILENAME = 'pipeline_state.json'
+
+# name: unique name of the stage
+# command: list of arguments to run
+# deps: names of the stages that must have completed before this one
+# scripts: scripts executed by the stage, part of the fingerprint
+# inputs: files, directories and store documents read by the stage, relative to basedir
+# outputs: files and store documents produced by the stage, relative to basedir
+# always: whether the stage must run even if its fingerprint is unchanged
+Stage = namedtuple('Stage', ['name', 'command', 'deps', 'scripts', 'inputs', 'outputs', 'always'])
+
+# document in the SQLite database of workdir_store, at path relative to basedir
+StoreDocument = namedtuple('StoreDocument', ['path', 'name'])
+
+def check_dir(dirpath):
+    if not os.path.isdir(dirpath):
+        raise Exception("Directory %s doesn't exist" % dirpath)
+    return dirpath
+
+def script(filename):
+    return os.path.join(SCRIPTS_DIR, filename)
+
+def get_stages(version, base_dir, jobs, local_mirror=False, sqlite_store=False, resolver='index'):
+    workdir = os.path.join('workdir', version)
+
+    def w(filename):
+        return os.path.join(workdir, filename)
+
+    def doc(name):
+        """ document managed by workdir_store """
+        if sqlite_store:
+            return StoreDocument(w(workdir_store.SQLITE_FILENAME), name)
+        return w(name)
+
+    python = sys.executable or 'python'
+    store_args = ['--sqlite-store'] if sqlite_store else []
+    stages = [
+        Stage(name='sync_repos',
+              command=['bash', script('sync_repos.sh')],
+              deps=[],
+              scripts=[script('sync_repos.sh'), script('rpmwatcher_rpms_srpms.py')],
+              inputs=[],
+              outputs=[],
+              always=True),
+        Stage(name='update',
+              command=[python, script('rpmwatcher_update.py'), version, '.', '--jobs', str(jobs), '--incremental']
+                      + store_args,
+              deps=['sync_repos'],
+              scripts=[script('rpmwatcher_update.py')],
+              inputs=[],
+              outputs=[doc('xcp-ng_builds_WIP.json'), doc('xcp-ng-rpms-srpms.json'), w('extra_installable.txt')],
+              always=True),
+        # using "host" network because "bridge" may fail in some hosting environments
+        Stage(name='extract_deps',
+              command=['docker', 'run', '--rm', '-t', '--privileged', '--network', 'host',
+                       '-v', '%s:/data' % base_dir, '-v', '%s:/scripts' % SCRIPTS_DIR, 'centos:%s' % CENTOS_VERSION,
+                       'python', '/scripts/rpmwatcher_extract_deps.py', version, '/data', '--jobs', str(jobs),
+                       '--resolver', resolver]
+                      + (['--local-mirror'] if local_mirror else []) + store_args,
+              deps=['update'],
+              scripts=[script('rpmwatcher_extract_deps.py'), script('workdir_store.py'), script('depcache.py'),
+                       script('depsolver.py'), script('depgraph.py'), script('repodata.py'), script('evrkey.py')],
+              inputs=[doc('xcp-ng_builds_WIP.json'), doc('xcp-ng-rpms-srpms.json'), w('extra_installable.txt'),
+                      os.path.join('xcp-ng_rpms', version)],
+              outputs=[doc('xcp-ng_rpms_WIP2.json'), doc('xcp-ng_builds_WIP2.json'),
+                       doc('rpms_installed_by_default_nvra.json'), doc('extra_installable_nvra.json')],
+              # its inputs are online unless local_mirror, see the module docstring
+              always=not local_mirror),
+        Stage(name='extract_roles',
+              command=[python, script('rpmwatcher_extract_roles.py'), version, '.', '--incremental'] + store_args,
+              deps=['extract_deps'],
+              scripts=[script('rpmwatcher_extract_roles.py'), script('workdir_store.py'), script('roleindex.py')],
+              inputs=[doc('xcp-ng_rpms_WIP2.json'), doc('xcp-ng_builds_WIP2.json'),
+                      doc('rpms_installed_by_default_nvra.json'), doc('extra_installable_nvra.json')],
+              # --incremental starts from the previous results, the state and the index
+              outputs=[doc('xcp-ng_rpms.json'), doc('xcp-ng_builds.json'), doc('xcp-ng_roles_state.json'),
+                       w(roleindex.INDEX_FILENAME)],
+              always=False),
+        # all formats in one run, which reads the data and computes the rows once
+        Stage(name='format_reports',
+              command=[python, script('rpmwatcher_format_reports.py'), version, '.', 'html,markdown,csv']
+                      + store_args,
+              deps=['extract_roles'],
+              scripts=[script('rpmwatcher_format_reports.py'), script('evrkey.py'), script('workdir_store.py')],
+              inputs=[doc('xcp-ng_rpms.json'), doc('xcp-ng_builds.json')],
+              outputs=[os.path.join(workdir, 'reports', 'report_%s.%s' % (report_name, extension))
+                       for report_name in ['roles_and_deps', 'versions'] for extension in ['html', 'md', 'csv']],
+              always=False),
+    ]
+    return stages
+
+def hash_file(h, filepath):
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(chunk)
+
+def store_document_digest(document):
+    """ None if the database or the document doesn't exist """
+    if not os.path.exists(document.path):
+        return None
+    workdir = workdir_store.SqliteWorkdir(document.path)
+    try:
+        return workdir.digest(document.name)
+    finally:
+        workdir.close()
+
+def output_exists(output):
+    if isinstance(output, StoreDocument):
+        return store_document_digest(output) is not None
+    return os.path.exists(output)
+
+def fingerprint(stage):
+    """ fingerprint of the inputs of the stage. Paths are relative to the current directory (basedir). """
+    h = hashlib.sha256()
+    h.update(json.dumps(stage.command).encode('utf-8'))
+    for path in stage.scripts + stage.inputs:
+        if isinstance(path, StoreDocument):
+            h.update(('\0%s:%s\0' % path).encode('utf-8'))
+            h.update((store_document_digest(path) or 'missing').encode('utf-8'))
+            continue
+        h.update(('\0%s\0' % path).encode('utf-8'))
+        if os.path.isdir(path):
+            # repository: the listing of the RPMs is enough, they are not modified in place.
+            # The repodata is left out since createrepo_c rewrites it at each sync.
+            for filename in sorted(f for f in os.listdir(path) if f.endswith('.rpm')):
+                st = os.stat(os.path.join(path, filename))
+                h.update(('%s %d %d\n' % (filename, st.st_size, int(st.st_mtime))).encode('utf-8'))
+        elif os.path.exists(path):
+            hash_file(h, path)
+        else:
+            h.update(b'missing')
+    return h.hexdigest()
+
+def read_state(state_path):
+    if not os.path.exists(state_path):
+        return {}
+    with open(state_path) as f:
+        return json.load(f)
+
+def write_state(state_path, state):
+    with open(state_path + '.tmp', 'w') as f:
+        f.write(json.dumps(state, sort_keys=True, indent=4))
+    os.rename(state_path + '.tmp', state_path)
+
+def run_stage(stage, state, force):
+    """ run the stage unless it is up to date. returns (status, fingerprint) """
+    stage_fingerprint = None
+    if not stage.always:
+        stage_fingerprint = fingerprint(stage)
+        if (stage.name not in force and state.get(stage.name) == stage_fingerprint
+                and all(output_exists(output) for output in stage.outputs)):
+            return 'skipped', stage_fingerprint
+    start = time.time()
+    print("*** Running %s: %s" % (stage.name, " ".join(stage.command)))
+    sys.stdout.flush()
+    subprocess.check_call(stage.command)
+    print("*** %s done in %ds" % (stage.name, time.time() - start))
+    if stage.always:
+        stage_fingerprint = fingerprint(stage)
+    return 'done', stage_fingerprint
+
+def run_pipeline(stages, state_path, force):
+    """ Run the stages in order, each one once all its dependencies completed """
+    state = read_state(state_path)
+    completed = set()
+    for stage in stages:
+        missing = [dep for dep in stage.deps if dep not in completed]
+        if missing:
+            raise Exception("Stage %s must come after %s" % (stage.name, ", ".join(missing)))
+        try:
+            status, stage_fingerprint = run_stage(stage, state, force)
+        except Exception as e:
+            print("*** %s failed: %s" % (stage.name, e))
+            # its outputs may be incomplete
+            state.pop(stage.name, None)
+            write_state(state_path, state)
+            raise
+        if status == 'skipped':
+            print("*** Skipping %s: inputs unchanged since the last successful run" % stage.name)
+        state[stage.name] = stage_fingerprint
+        write_state(state_path, state)
+        completed.add(stage.name)
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the rpmwatcher stages, skipping those whose inputs '
+                                                 'are unchanged since their last successful run')
+    parser.add_argument('version', help='XCP-ng 2-digit version, e.g. 8.0')
+    parser.add_argument('basedir', help='path to the base directory where repos must be present and where '
+                                        'we\'ll read data / output results.')
+    parser.add_argument('--force', action='append', default=[], metavar='STAGE',
+                        help='run STAGE even if its inputs are unchanged. Can be repeated.')
+    parser.add_argument('--jobs', type=int, default=multiprocessing.cpu_count(),
+                        help='number of processes given to the stages that support it')
+    parser.add_argument('--local-mirror', action='store_true',
+                        help='make extract_deps use the local xcp-ng_rpms/{version} mirror rather than the '
+                             'online XCP-ng repositories')
+    parser.add_argument('--resolver', choices=['index', 'yum', 'graph', 'compare'], default='index',
+                        help='how extract_deps resolves runtime dependencies, see rpmwatcher_extract_deps.py. '
+                             'index needs the repodata of xcp-ng_rpms/{version}, see sync_repos.sh. '
+                             'compare runs yum for every RPM and reports any difference with index.')
+    parser.add_argument('--sqlite-store', action='store_true',
+                        help='make the stages keep their documents in workdir/{version}/%s instead of JSON files'
+                             % workdir_store.SQLITE_FILENAME)
+    args = parser.parse_args()
+
+    base_dir = os.path.abspath(check_dir(args.basedir))
+    stages = get_stages(args.version, base_dir, args.jobs, args.local_mirror, args.sqlite_store, args.resolver)
+    stage_names = [stage.name for stage in stages]
+    for name in args.force:
+        if name not in stage_names:
+            raise Exception("Unknown stage %s. Stages are: %s" % (name, ", ".join(stage_names)))
+
+    # the stages expect to be run from basedir
+    os.chdir(base_dir)
+    work_dir = os.path.join(base_dir, 'workdir', args.version)
+    if not os.path.isdir(work_dir):
+        os.makedirs(work_dir)
+    run_pipeline(stages, os.path.join(work_dir, STATE_FILENAME), args.force)
+
+if __name__ == "__main__":
+    main()
@@ -9,28 +9,36 @@ Prerequisites:
   - a local EPEL repo of SRPMs, all SRPMs in the first-level directory. Directory name: epel.
   - a local XCP-ng repo of SRPMs, all SRPMs in the first-level directory. Directory name: xcp-ng/{version}, e.g. xcp-ng/8.0
   - a working directory: workdir
-- the user running the script must have access to koji through cli
+- the user running the script must have read access to koji (configuration in ~/.koji/config)
 """
 
 from __future__ import print_function
 import argparse
-import subprocess
 import os
-import rpm
 import json
-import urllib2
 
-DEVNULL = open(os.devnull, 'w')
+import evrkey
+import kojisession
+import repodata
+import rpmheaders
+import workdir_store
 
 MAIN_TAGS = ['base', 'updates', 'candidates', 'testing', 'ci']
 
+# as in the built-by-* koji tags
+BUILDERS = ['centos', 'epel', 'xs', 'xcp-ng']
+
+# data/ directory of this git repository, which contains the {version}/packages_provenance.csv files
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'data')
+PROVENANCE_CSV_HEADERS = ['SRPM_name', 'added_by', 'import_reason', 'latest_release_URL', 'latest_release_regexp']
+
 def check_dir(dirpath):
     if not os.path.isdir(dirpath):
         raise Exception("Directory %s doesn't exist" % dirpath)
     return dirpath
 
-def list_tags_for_version(version):
-    tags = subprocess.check_output(['koji', 'list-tags', 'v%s*' % version]).splitlines()
+def list_tags_for_version(koji_session, version):
+    tags = kojisession.list_tags(koji_session, 'v%s*' % version)
 
     sorted_tags = []
     # first get the main tags
@@ -47,45 +55,158 @@ def list_tags_for_version(version):
 
     return sorted_tags
 
-def get_builds_for_tag(tag, latest=False):
-    builds = []
-    param_latest = ['--latest'] if latest else []
-    lines = subprocess.check_output(['koji', 'list-tagged', tag, '--quiet'] + param_latest).splitlines()
-    for line in lines:
-        srpm_nvr = line.split()[0]
-        builds.append(srpm_nvr)
-    return sorted(builds)
+def query_koji(koji_session, version):
+    """
+    List the tags, then get everything else in a single multicall.
+    returns ({builder: build NVRs}, [(tag, NVRs of its latest builds)], names of the extra installable packages)
+    """
+    tags = list_tags_for_version(koji_session, version)
+    with koji_session.multicall(strict=True) as m:
+        built_by_calls = [(builder, m.listTagged('built-by-%s' % builder)) for builder in BUILDERS]
+        tagged_calls = [(tag, m.listTagged(tag, latest=True)) for tag in tags]
+        tag_groups_call = m.getTagGroups('V%s' % version)
 
-def get_info_from_srpm_file(filepath):
+    built_by = {}
+    for builder, call in built_by_calls:
+        built_by[builder] = kojisession.tagged_nvrs(call.result)
+    tagged_builds = [(tag, kojisession.tagged_nvrs(call.result)) for tag, call in tagged_calls]
+    # Get the list of RPMs that are considered "extra installable packages"
+    # rpmwatcher_extract_roles.py will need them and can't use koji since it is run within a container
+    extra_rpms = kojisession.group_packages(tag_groups_call.result, 'installable_extras')
+    return built_by, tagged_builds, extra_rpms
+
+# keys of the build information that are read from the SRPM itself
+SRPM_INFO_KEYS = ['name', 'vendor', 'summary', 'nvr', 'epoch', 'version', 'release']
+
+def format_epoch(epoch):
+    """
+    '' for no epoch, as rpm -qp gives (none), and for epoch 0: createrepo records a missing epoch as 0,
+    so the repodata can't tell them apart, and both sources must give the same EVR for the same package.
+    """
+    if epoch is None or str(epoch) in ('', '0'):
+        return ''
+    return str(epoch)
+
+def get_info_from_srpm_header(header):
+    return {
+        'name': header.name,
+        'vendor': rpmheaders.format_value(header.vendor),
+        'summary': header.summary,
+        'nvr': header.nvr,
+        'epoch': format_epoch(header.epoch),
+        'version': header.version,
+        'release': header.release,
+    }
+
+def get_info_from_srpm_file(filepath, header_cache=None):
     if not os.path.exists(filepath):
         return {}
-    output = subprocess.check_output(
-        ['rpm', '-qp', filepath, '--qf', '%{name};;%{vendor};;%{summary};;%{nvr};;%{epoch};;%{version};;%{release}'],
-        stderr=DEVNULL).split(';;')
+    return get_info_from_srpm_header(rpmheaders.get_header(filepath, header_cache))
+
+def get_info_from_repodata_package(pkg):
+    """ convert package metadata from repodata to the same format as get_info_from_srpm_file """
     return {
-        'name': output[0],
-        'vendor': output[1],
-        'summary': output[2],
-        'nvr': output[3],
-        'epoch': '' if output[4] == '(none)' else output[4],
-        'version': output[5],
-        'release': output[6],
+        'name': pkg['name'],
+        'vendor': pkg['vendor'] or '(none)',
+        'summary': pkg['summary'],
+        'nvr': '%s-%s-%s' % (pkg['name'], pkg['version'], pkg['release']),
+        'epoch': format_epoch(pkg['epoch']),
+        'version': pkg['version'],
+        'release': pkg['release'],
     }
 
-def get_latest_srpms_info_from_dir(dirpath):
+def get_latest_srpms_info_from_dir(dirpath, header_cache=None, jobs=1):
+    """
+    Read the SRPMs from dirpath and keep only the newest one for each SRPM name.
+
+    If dirpath contains repodata (e.g. from createrepo_c --update), metadata is taken from there.
+    Files that are missing from the repodata, or whose size doesn't match, have their header read,
+    using a pool of jobs processes if jobs > 1.
+    """
+    packages = repodata.get_packages_by_filename(dirpath)
+    infos = {}
+    to_read = []
+    filenames = [filename for filename in os.listdir(dirpath) if filename.endswith('.rpm')]
+    for filename in filenames:
+        filepath = os.path.join(dirpath, filename)
+        pkg = packages.get(filename)
+        if pkg is not None and pkg['size'] == os.path.getsize(filepath):
+            infos[filename] = get_info_from_repodata_package(pkg)
+        else:
+            to_read.append(filename)
+    headers = rpmheaders.get_headers([os.path.join(dirpath, filename) for filename in to_read], header_cache, jobs)
+    for filename, header in zip(to_read, headers):
+        infos[filename] = get_info_from_srpm_header(header)
+
+    # reduction done in directory listing order, so that the result doesn't depend on jobs
     result = {}
-    for filename in os.listdir(dirpath):
-        info = get_info_from_srpm_file(os.path.join(dirpath, filename))
+    for filename in filenames:
+        info = infos[filename]
         if info['name'] not in result:
             result[info['name']] = info
         else:
             # keep only the newest
             prev_info = result[info['name']]
-            if rpm.labelCompare((prev_info['epoch'], prev_info['version'], prev_info['release']),
-                                (info['epoch'], info['version'], info['release'])) < 0:
+            if (evrkey.evr_key(prev_info['epoch'], prev_info['version'], prev_info['release'])
+                    < evrkey.evr_key(info['epoch'], info['version'], info['release'])):
                 result[info['name']] = info
     return result
 
+def read_provenance_csv(filepath):
+    """
+    Read the "manually written" information about our packages.
+
+    returns (csv headers, dict {SRPM name: row})
+    """
+    with open(filepath) as f:
+        rows = [line.split(';') for line in f.read().splitlines()]
+    csv_headers = rows[0]
+    if csv_headers != PROVENANCE_CSV_HEADERS:
+        raise Exception("The headers in %s were different from what was expected. Expected %s, got %s."
+                        % (filepath, PROVENANCE_CSV_HEADERS, csv_headers))
+    srpm_name_index = csv_headers.index('SRPM_name')
+    provenance_by_name = {}
+    for row in rows[1:]:
+        name = row[srpm_name_index]
+        if name in provenance_by_name:
+            raise Exception("SRPM %s is listed twice in %s" % (name, filepath))
+        provenance_by_name[name] = row
+    return csv_headers, provenance_by_name
+
+def get_provenance_fields(csv_headers, provenance_by_name, name, build_info=None):
+    """
+    returns the provenance fields for SRPM name, from the CSV or, if given, from build_info
+    """
+    fields = {}
+    if build_info is not None:
+        for field_name in csv_headers:
+            if field_name != 'SRPM_name' and field_name in build_info:
+                fields[field_name] = build_info[field_name]
+    elif name in provenance_by_name:
+        row = provenance_by_name[name]
+        for i in xrange(len(csv_headers)):
+            if csv_headers[i] != 'SRPM_name':
+                fields[csv_headers[i]] = row[i]
+    return fields
+
+def is_build_unchanged(prev_build_info, tag, csv_headers, provenance_by_name):
+    """ whether a build from the previous run is still in the same koji tag, with the same provenance """
+    if prev_build_info is None or prev_build_info['koji_tag'] != tag:
+        return False
+    name = prev_build_info['name']
+    return (get_provenance_fields(csv_headers, provenance_by_name, name)
+            == get_provenance_fields(csv_headers, provenance_by_name, name, prev_build_info))
+
+def get_builds_delta(previous_builds, builds):
+    """ lists the builds that were added, removed or changed since the previous run """
+    # same types as previous_builds, which was loaded from JSON
+    builds = json.loads(json.dumps(builds))
+    return {
+        'added': sorted(nvr for nvr in builds if nvr not in previous_builds),
+        'removed': sorted(nvr for nvr in previous_builds if nvr not in builds),
+        'changed': sorted(nvr for nvr in builds if nvr in previous_builds and builds[nvr] != previous_builds[nvr]),
+    }
+
 def version_release(version, release):
     return version + '-' + release
 
@@ -94,6 +215,18 @@ def main():
     parser.add_argument('version', help='XCP-ng 2-digit version, e.g. 8.0')
     parser.add_argument('basedir', help='path to the base directory where repos must be present and where '
                                         'we\'ll output results.')
+    parser.add_argument('--koji-profile', default='koji', help='koji configuration profile to use')
+    parser.add_argument('--koji-server', help='URL of the koji hub, overrides the one from the koji configuration')
+    parser.add_argument('--provenance-csv',
+                        help='path to packages_provenance.csv, defaults to the one for this version in data/')
+    parser.add_argument('--incremental', action='store_true',
+                        help='reuse the information from the previous xcp-ng_builds_WIP.json for builds whose NVR, '
+                             'koji tag and provenance are unchanged')
+    parser.add_argument('--jobs', type=int, default=1,
+                        help='number of processes used to read SRPM headers from the CentOS and EPEL mirrors')
+    parser.add_argument('--sqlite-store', action='store_true',
+                        help='read and write the data shared between stages in workdir/{version}/%s '
+                             'instead of JSON files' % workdir_store.SQLITE_FILENAME)
     args = parser.parse_args()
 
     base_dir = os.path.abspath(check_dir(args.basedir))
@@ -102,54 +235,56 @@ def main():
     centos_srpm_repo = check_dir(os.path.join(base_dir, 'centos'))
     epel_srpm_repo = check_dir(os.path.join(base_dir, 'epel'))
     work_dir = check_dir(os.path.join(base_dir, 'workdir', xcp_version))
-
-    built_by = {}
-    built_by['centos'] = get_builds_for_tag('built-by-centos')
-    built_by['epel'] = get_builds_for_tag('built-by-epel')
-    built_by['xs'] = get_builds_for_tag('built-by-xs')
-    built_by['xcp-ng'] = get_builds_for_tag('built-by-xcp-ng')
-
+    workdir = workdir_store.open_workdir(work_dir, args.sqlite_store)
+    header_cache = rpmheaders.HeaderCache(os.path.join(base_dir, 'workdir', 'rpm_headers_cache.sqlite'))
+
+    # Query koji
+    koji_session = kojisession.open_session(args.koji_profile, args.koji_server)
+    built_by, tagged_builds, extra_rpms = query_koji(koji_session, xcp_version)
+    # index: build NVR => builder. If a build is in several built-by-* tags, the first builder wins.
+    builder_by_nvr = {}
+    for builder in built_by:
+        for srpm_nvr in built_by[builder]:
+            builder_by_nvr.setdefault(srpm_nvr, builder)
 
     # Get "manually written" information about our packages
-    expected_headers = ['SRPM_name', 'added_by', 'import_reason', 'latest_release_URL', 'latest_release_regexp']
-    filename = "packages_provenance.csv"
-    provenance_csv = urllib2.urlopen(
-        'https://raw.githubusercontent.com/xcp-ng/xcp/master/data/%s/%s' % (xcp_version, filename)
-    ).read()
-    provenance_csv = [line.split(';') for line in provenance_csv.splitlines()]
-    csv_headers = provenance_csv[0]
-    if csv_headers != expected_headers:
-        raise Exception("The headers in %s were different from what was expected. Expected %s, got %s."
-                        % (filename, expected_headers, csv_headers))
-    provenance_csv = provenance_csv[1:]
+    provenance_csv_path = args.provenance_csv
+    if provenance_csv_path is None:
+        provenance_csv_path = os.path.join(DATA_DIR, xcp_version, 'packages_provenance.csv')
+    csv_headers, provenance_by_name = read_provenance_csv(provenance_csv_path)
 
     # If we have information from previous runs, use that to detect updated packages
-    previous_centos_file_path = os.path.join(work_dir, 'centos-srpms.json')
     centos_srpms_previous = {}
-    if os.path.exists(previous_centos_file_path):
-        with open(previous_centos_file_path) as f:
-            centos_srpms_previous = json.load(f)
-    previous_epel_file_path = os.path.join(work_dir, 'epel-srpms.json')
+    if workdir.exists('centos-srpms.json'):
+        centos_srpms_previous = workdir.read('centos-srpms.json')
     epel_srpms_previous = {}
-    if os.path.exists(previous_epel_file_path):
-        with open(previous_epel_file_path) as f:
-            epel_srpms_previous = json.load(f)
+    if workdir.exists('epel-srpms.json'):
+        epel_srpms_previous = workdir.read('epel-srpms.json')
 
-    # Read centos and epel repos
-    # This takes time because each SRPM will be read by rpm -qp --qf
-    # We could speed this up a lot by parsing repodata
-    centos_srpms = get_latest_srpms_info_from_dir(centos_srpm_repo)
-    epel_srpms = get_latest_srpms_info_from_dir(epel_srpm_repo)
+    xcp_builds_previous = {}
+    if workdir.exists('xcp-ng_builds_WIP.json'):
+        xcp_builds_previous = workdir.read('xcp-ng_builds_WIP.json')
 
-    tags = list_tags_for_version(xcp_version)
+    # Read centos and epel repos
+    # This uses the repodata when available (see sync_repos.sh), else the header of each SRPM is read
+    centos_srpms = get_latest_srpms_info_from_dir(centos_srpm_repo, header_cache, args.jobs)
+    epel_srpms = get_latest_srpms_info_from_dir(epel_srpm_repo, header_cache, args.jobs)
 
     xcp_builds = {}
     excluded_builds = []
     latest_release_by_name = {}
-    for tag in tags:
-        builds = get_builds_for_tag(tag, latest=True)
+    for tag, builds in tagged_builds:
         for srpm_nvr in builds:
-            build_info = get_info_from_srpm_file(os.path.join(xcp_srpm_repo, srpm_nvr + '.src.rpm'))
+            srpm_path = os.path.join(xcp_srpm_repo, srpm_nvr + '.src.rpm')
+            prev_build_info = xcp_builds_previous.get(srpm_nvr)
+            if (args.incremental and os.path.exists(srpm_path)
+                    and is_build_unchanged(prev_build_info, tag, csv_headers, provenance_by_name)):
+                # reuse what we read from the SRPM during the previous run
+                build_info = dict((key, prev_build_info[key]) for key in SRPM_INFO_KEYS)
+                # runs before format_epoch() kept epoch 0 as '0'
+                build_info['epoch'] = format_epoch(build_info['epoch'])
+            else:
+                build_info = get_info_from_srpm_file(srpm_path, header_cache)
             if not build_info:
                 # SRPM not present in repos
                 excluded_builds.append(srpm_nvr)
@@ -160,8 +295,8 @@ def main():
             # Keep only the latest release for a given SRPM name
             if name in latest_release_by_name:
                 prev_info = latest_release_by_name[name]
-                is_latest = rpm.labelCompare((prev_info['epoch'],  prev_info['version'],  prev_info['release']),
-                                             (build_info['epoch'], build_info['version'], build_info['release'])) < 0
+                is_latest = (evrkey.evr_key(prev_info['epoch'], prev_info['version'], prev_info['release'])
+                             < evrkey.evr_key(build_info['epoch'], build_info['version'], build_info['release']))
                 if not is_latest:
                     # skip
                     continue
@@ -178,11 +313,7 @@ def main():
 
             build_info['koji_tag'] = tag
 
-            build_info['built-by'] = 'unknown'
-            for builder in built_by:
-                if srpm_nvr in built_by[builder]:
-                    build_info['built-by'] = builder
-                    break
+            build_info['built-by'] = builder_by_nvr.get(srpm_nvr, 'unknown')
 
             # Notify about updated packages in CentOS, EPEL...
             if name in centos_srpms:
@@ -203,16 +334,10 @@ def main():
                              version_release(build_info['version'], build_info['release'])))
 
             # provenance
-            srpm_name_index = csv_headers.index('SRPM_name')
-            for row in provenance_csv:
-                if row[srpm_name_index] == name:
-                    for i in xrange(len(csv_headers)):
-                        field_name = csv_headers[i]
-                        if field_name == 'SRPM_name':
-                            continue
-                        if field_name in build_info:
-                            raise("Key collision! I'm trying to add the '%s' key which already exists!" % field_name)
-                        build_info[field_name] = row[i]
+            for field_name, value in get_provenance_fields(csv_headers, provenance_by_name, name).items():
+                if field_name in build_info:
+                    raise Exception("Key collision! I'm trying to add the '%s' key which already exists!" % field_name)
+                build_info[field_name] = value
 
             xcp_builds[srpm_nvr] = build_info
 
@@ -232,27 +357,22 @@ def main():
             # also populate this dict that will be useful later
             xcp_ng_rpms_srpms[rpm_nvra] = {'name': rpm_shortname, 'srpm_nvr': srpm_nvr}
 
-    # Get the list of RPMs that are considered "extra installable packages"
-    # rpmwatcher_extract_roles.py will need them and can't use koji since it is run within a container
-    lines = subprocess.check_output(['koji', 'list-groups', 'V%s' % xcp_version, 'installable_extras']).splitlines()
-    lines = lines[1:]
-    extra_rpms = []
-    for line in lines:
-        extra_rpms.append(line.strip().split(':')[0])
-
     # Write files
     with open(os.path.join(work_dir, 'excluded_builds.txt'), 'w') as f:
         f.write('\n'.join(excluded_builds))
-    with open(os.path.join(work_dir, 'xcp-ng_builds_WIP.json'), 'w') as f:
-        f.write(json.dumps(xcp_builds, sort_keys=True, indent=4))
+    workdir.write('xcp-ng_builds_WIP.json', xcp_builds)
+    # a plain JSON file even with --sqlite-store, for whoever wants to know what changed
+    workdir_store.JsonWorkdir(work_dir).write('xcp-ng_builds_delta.json',
+                                              get_builds_delta(xcp_builds_previous, xcp_builds))
     with open(os.path.join(work_dir, 'extra_installable.txt'), 'w') as f:
         f.write('\n'.join(extra_rpms))
-    with open(os.path.join(work_dir, 'xcp-ng-rpms-srpms.json'), 'w') as f:
-        f.write(json.dumps(xcp_ng_rpms_srpms, sort_keys=True, indent=4))
-    with open(os.path.join(work_dir, 'centos-srpms.json'), 'w') as f:
-        f.write(json.dumps(centos_srpms, sort_keys=True, indent=4))
-    with open(os.path.join(work_dir, 'epel-srpms.json'), 'w') as f:
-        f.write(json.dumps(epel_srpms, sort_keys=True, indent=4))
+    workdir.write('xcp-ng-rpms-srpms.json', xcp_ng_rpms_srpms)
+    workdir.write('centos-srpms.json', centos_srpms)
+    workdir.write('epel-srpms.json', epel_srpms)
+
+    workdir.close()
+    header_cache.close()
+    print(header_cache.stats())
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,71 @@
+#!/bin/env python
+
+"""
+Explain why an RPM has a given role, as computed by rpmwatcher_extract_roles.py.
+
+Reads the roles index that rpmwatcher_extract_roles.py writes to workdir/{version}/roles_index.sqlite
+and prints the chain of RPMs that justifies the role, one line per RPM, e.g.:
+
+    $ rpmwatcher_why.py 8.2 /data NVRA main_indirect_builddep
+
+The chain ends with a main or extra RPM, or for other_* roles with an RPM that has no roles.
+See roleindex.py for how the chain is recorded. After a full computation, it is a shortest one.
+After an incremental one, the links of the RPMs that weren't recomputed are kept, so it may be longer.
+"""
+
+from __future__ import print_function
+
+import argparse
+import os
+import sys
+
+import roleindex
+
+
+def check_dir(dirpath):
+    if not os.path.isdir(dirpath):
+        raise Exception("Directory %s doesn't exist" % dirpath)
+    return dirpath
+
+def describe(link):
+    rpm_nvra, role, pred_nvra, pred_role, srpm_nvr = link
+    if role == 'main':
+        reason = "is installed by default"
+    elif role == 'extra':
+        reason = "is an extra installable package"
+    elif role in ('extra_dep', 'other_dep'):
+        reason = "is a dependency of %s" % pred_nvra
+    elif role.endswith('_indirect_builddep'):
+        reason = "is a build dependency, direct or pulled, of %s, which produces %s" % (srpm_nvr, pred_nvra)
+    elif role.endswith('_builddep_dep'):
+        reason = "is pulled by the build dependencies of %s, which produces %s" % (srpm_nvr, pred_nvra)
+    else:
+        reason = "is a build dependency of %s, which produces %s" % (srpm_nvr, pred_nvra)
+    if pred_nvra is not None and pred_role is None:
+        reason += ", which has no roles"
+    return "%s (%s) %s" % (rpm_nvra, role, reason)
+
+def main():
+    parser = argparse.ArgumentParser(description='Explain why an XCP-ng RPM has a given role')
+    parser.add_argument('version', help='XCP-ng 2-digit version, e.g. 8.0')
+    parser.add_argument('basedir', help='path to the base directory where the workdir is')
+    parser.add_argument('nvra', help='NVRA of the RPM')
+    parser.add_argument('role', help='role of the RPM, e.g. main_indirect_builddep')
+    args = parser.parse_args()
+
+    work_dir = check_dir(os.path.join(os.path.abspath(check_dir(args.basedir)), 'workdir', args.version))
+    index_path = os.path.join(work_dir, roleindex.INDEX_FILENAME)
+    if not os.path.exists(index_path):
+        raise Exception("%s doesn't exist, run rpmwatcher_extract_roles.py first" % index_path)
+
+    role_index = roleindex.RoleIndex(index_path)
+    chain = role_index.why(args.nvra, args.role)
+    role_index.close()
+    if not chain:
+        print("%s doesn't have the %s role" % (args.nvra, args.role))
+        sys.exit(1)
+    for link in chain:
+        print(describe(link))
+
+if __name__ == "__main__":
+    main()
@@ -7,9 +7,28 @@ for version in "8.3" "8.2"; do
     rsync -rlptv updates.xcp-ng.org::repo/$MAJOR/$version/{updates,base,candidates,testing,ci}/Source/SPackages/*.src.rpm xcp-ng/$version/
     rsync -rlptv updates.xcp-ng.org::repo/$MAJOR/$version/{updates,base,candidates,testing,ci}/x86_64/Packages/*.rpm xcp-ng_rpms/$version/
     mkdir -p workdir/$version
-    for f in $(ls xcp-ng_rpms/${version}/*.rpm); do echo "$(basename $f),$(rpm -qp $f --qf '%{sourcerpm},%{name}' 2>/dev/null)"; done > workdir/$version/xcp-ng-rpms-srpms.txt
+    python $(dirname $0)/rpmwatcher_rpms_srpms.py xcp-ng_rpms/$version --header-cache workdir/rpm_headers_cache.sqlite \
+        --jobs $(nproc) > workdir/$version/xcp-ng-rpms-srpms.txt
+    # repodata for rpmwatcher_extract_deps.py --resolver index (the default of rpmwatcher_run.py) and
+    # --local-mirror. It must be generated here: the CentOS container has no createrepo.
+    if command -v createrepo_c > /dev/null; then
+        createrepo_c --update --quiet xcp-ng_rpms/$version/
+    elif command -v createrepo > /dev/null; then
+        createrepo --update --quiet xcp-ng_rpms/$version/
+    else
+        echo "Neither createrepo_c nor createrepo found: no repodata for xcp-ng_rpms/$version" >&2
+    fi
 done
 mkdir -p epel
 rsync -rlptv --delete-delay rsync://mirror.in2p3.fr/pub/epel/7/SRPMS/Packages/*/*.rpm epel/
 mkdir -p centos
 rsync -rlptv --delete-delay mirror.nsc.liu.se::centos-store/centos/7/{os,updates}/Source/SPackages/*.src.rpm centos/
+# Generate repodata for the SRPM mirrors so that rpmwatcher_update.py can read package metadata from there
+# instead of reading every SRPM header. --update only reads the headers of new or modified SRPMs.
+if command -v createrepo_c > /dev/null; then
+    createrepo_c --update --quiet centos/
+    createrepo_c --update --quiet epel/
+elif command -v createrepo > /dev/null; then
+    createrepo --update --quiet centos/
+    createrepo --update --quiet epel/
+fi
@@ -0,0 +1,271 @@
+"""
+Storage for the data that rpmwatcher stages pass to each other through the workdir.
+
+By default, each document is a JSON file in the workdir, e.g. xcp-ng_builds_WIP.json, as
+it has always been. Documents which are dicts are written one top-level record at a time,
+see write_json_stream(). Optionally, the documents can be kept in a single SQLite database instead.
+There, builds, RPMs, their dependencies, build dependencies and roles are stored in separate
+tables indexed on NVR(A), name and SRPM NVR. Writes are incremental: only the records which
+changed since the document was last written are rewritten.
+
+Either way, stages use the same interface:
+    workdir = open_workdir(work_dir, use_sqlite)
+    xcp_builds = workdir.read('xcp-ng_builds_WIP.json')
+    workdir.write('xcp-ng_builds_WIP2.json', xcp_builds)
+    workdir.close()
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+
+SQLITE_FILENAME = 'rpmwatcher.sqlite'
+
+# documents which are dicts {SRPM NVR: build information}
+BUILD_DOCUMENTS = ['xcp-ng_builds_WIP.json', 'xcp-ng_builds_WIP2.json', 'xcp-ng_builds.json']
+# documents which are dicts {RPM NVRA: RPM information}
+RPM_DOCUMENTS = ['xcp-ng_rpms_WIP2.json', 'xcp-ng_rpms.json']
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS documents (doc TEXT PRIMARY KEY, data TEXT);
+CREATE TABLE IF NOT EXISTS builds (doc TEXT, nvr TEXT, name TEXT, digest TEXT, data TEXT, PRIMARY KEY (doc, nvr));
+CREATE INDEX IF NOT EXISTS builds_name ON builds (doc, name);
+CREATE TABLE IF NOT EXISTS rpms (doc TEXT, nvra TEXT, name TEXT, srpm_nvr TEXT, installable INTEGER, digest TEXT,
+                                 data TEXT, PRIMARY KEY (doc, nvra));
+CREATE INDEX IF NOT EXISTS rpms_name ON rpms (doc, name);
+CREATE INDEX IF NOT EXISTS rpms_srpm_nvr ON rpms (doc, srpm_nvr);
+CREATE TABLE IF NOT EXISTS deps (doc TEXT, rpm_nvra TEXT, position INTEGER, dep_nvra TEXT);
+CREATE INDEX IF NOT EXISTS deps_rpm_nvra ON deps (doc, rpm_nvra);
+CREATE INDEX IF NOT EXISTS deps_dep_nvra ON deps (doc, dep_nvra);
+CREATE TABLE IF NOT EXISTS build_deps (doc TEXT, srpm_nvr TEXT, direct INTEGER, position INTEGER, dep_nvra TEXT);
+CREATE INDEX IF NOT EXISTS build_deps_srpm_nvr ON build_deps (doc, srpm_nvr);
+CREATE INDEX IF NOT EXISTS build_deps_dep_nvra ON build_deps (doc, dep_nvra);
+CREATE TABLE IF NOT EXISTS roles (doc TEXT, nvr TEXT, role TEXT, related TEXT);
+CREATE INDEX IF NOT EXISTS roles_nvr ON roles (doc, nvr);
+"""
+
+class JsonSortAndEncode(json.JSONEncoder):
+    """ encodes sets as sorted lists """
+    def default(self, obj):
+        if isinstance(obj, set):
+            return sorted(list(obj))
+        return json.JSONEncoder.default(self, obj)
+
+def write_json_stream(f, data, cls=None):
+    """
+    Write the same as json.dumps(data, sort_keys=True, indent=4, cls=cls) to f, but for a dict,
+    encode and write one top-level item at a time instead of building the whole string.
+    """
+    encoder = (cls or json.JSONEncoder)(sort_keys=True, indent=4)
+    if not isinstance(data, dict) or not data:
+        f.write(encoder.encode(data))
+        return
+    f.write('{')
+    separator = '\n    '
+    for key in sorted(data):
+        # a JSON string can't contain a newline, so this only indents the encoded value by one level
+        value = encoder.encode(data[key]).replace('\n', '\n    ')
+        f.write(separator + encoder.encode(key) + encoder.key_separator + value)
+        separator = encoder.item_separator + '\n    '
+    f.write('\n}')
+
+class JsonWorkdir(object):
+    """ one JSON file per document """
+    def __init__(self, work_dir):
+        self.work_dir = work_dir
+
+    def exists(self, name):
+        return os.path.exists(os.path.join(self.work_dir, name))
+
+    def read(self, name):
+        with open(os.path.join(self.work_dir, name)) as f:
+            return json.load(f)
+
+    def write(self, name, data, cls=None):
+        # write to a temporary file first, so that readers never see a partially written document
+        path = os.path.join(self.work_dir, name)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            write_json_stream(f, data, cls)
+        os.rename(tmp_path, path)
+
+    def close(self):
+        pass
+
+def _digest(record):
+    return hashlib.sha1(json.dumps(record, sort_keys=True, cls=JsonSortAndEncode).encode('utf-8')).hexdigest()
+
+def _roles_rows(doc, nvr, roles):
+    if not roles:
+        # keep track of the fact that there are no roles
+        return [(doc, nvr, None, None)]
+    rows = []
+    for role, related in roles.items():
+        if not related:
+            # keep track of the role even without related packages
+            rows.append((doc, nvr, role, None))
+        for related_nvr in related:
+            rows.append((doc, nvr, role, related_nvr))
+    return rows
+
+class SqliteWorkdir(object):
+    """ all documents in a SQLite database """
+    def __init__(self, dbpath):
+        self.conn = sqlite3.connect(dbpath)
+        self.conn.executescript(SCHEMA)
+
+    def exists(self, name):
+        if name in BUILD_DOCUMENTS:
+            query = 'SELECT 1 FROM builds WHERE doc = ? LIMIT 1'
+        elif name in RPM_DOCUMENTS:
+            query = 'SELECT 1 FROM rpms WHERE doc = ? LIMIT 1'
+        else:
+            query = 'SELECT 1 FROM documents WHERE doc = ?'
+        return self.conn.execute(query, (name,)).fetchone() is not None
+
+    def digest(self, name):
+        """ digest of the contents of the document, None if it doesn't exist """
+        if name in BUILD_DOCUMENTS or name in RPM_DOCUMENTS:
+            # the digest of each record covers its deps, build deps and roles
+            table, key_column = ('builds', 'nvr') if name in BUILD_DOCUMENTS else ('rpms', 'nvra')
+            rows = self.conn.execute('SELECT %s, digest FROM %s WHERE doc = ? ORDER BY %s'
+                                     % (key_column, table, key_column), (name,)).fetchall()
+            if not rows:
+                return None
+            return _digest(rows)
+        row = self.conn.execute('SELECT data FROM documents WHERE doc = ?', (name,)).fetchone()
+        if row is None:
+            return None
+        return hashlib.sha1(row[0].encode('utf-8')).hexdigest()
+
+    def _read_roles(self, name):
+        roles = {}
+        for nvr, role, related in self.conn.execute('SELECT nvr, role, related FROM roles WHERE doc = ?', (name,)):
+            nvr_roles = roles.setdefault(nvr, {})
+            if role is None:
+                continue
+            related_list = nvr_roles.setdefault(role, [])
+            if related is not None:
+                related_list.append(related)
+        for nvr_roles in roles.values():
+            for related_list in nvr_roles.values():
+                related_list.sort()
+        return roles
+
+    def read(self, name):
+        # records are inserted in key order, as json.load() does from a JSON file written with sort_keys,
+        # so that the dicts iterate in the same order: rpmwatcher_extract_roles.py processes RPMs in that order
+        if name in BUILD_DOCUMENTS:
+            builds = {}
+            for nvr, data in self.conn.execute('SELECT nvr, data FROM builds WHERE doc = ? ORDER BY nvr', (name,)):
+                builds[nvr] = json.loads(data)
+            build_deps = {}
+            for srpm_nvr, direct, dep_nvra in self.conn.execute(
+                    'SELECT srpm_nvr, direct, dep_nvra FROM build_deps WHERE doc = ? ORDER BY position', (name,)):
+                if dep_nvra is None:
+                    build_deps.setdefault(srpm_nvr, [[], []])
+                else:
+                    build_deps.setdefault(srpm_nvr, [[], []])[0 if direct else 1].append(dep_nvra)
+            for srpm_nvr, deps in build_deps.items():
+                builds[srpm_nvr]['build-deps'] = deps
+            for nvr, roles in self._read_roles(name).items():
+                builds[nvr]['roles'] = roles
+            return builds
+
+        if name in RPM_DOCUMENTS:
+            rpms = {}
+            for nvra, data in self.conn.execute('SELECT nvra, data FROM rpms WHERE doc = ? ORDER BY nvra', (name,)):
+                rpms[nvra] = json.loads(data)
+                rpms[nvra]['deps'] = []
+            for rpm_nvra, dep_nvra in self.conn.execute(
+                    'SELECT rpm_nvra, dep_nvra FROM deps WHERE doc = ? ORDER BY position', (name,)):
+                rpms[rpm_nvra]['deps'].append(dep_nvra)
+            for nvra, roles in self._read_roles(name).items():
+                rpms[nvra]['roles'] = roles
+            return rpms
+
+        row = self.conn.execute('SELECT data FROM documents WHERE doc = ?', (name,)).fetchone()
+        if row is None:
+            raise Exception("Document %s not found in the workdir store" % name)
+        return json.loads(row[0])
+
+    def _write_records(self, name, table, key_column, records, insert_record):
+        """
+        Rewrite only the records of the document that were added or changed, and delete the removed ones.
+        insert_record(key, record, digest) must insert the record in all relevant tables.
+        """
+        previous_digests = dict(self.conn.execute('SELECT %s, digest FROM %s WHERE doc = ?' % (key_column, table),
+                                                  (name,)))
+        child_tables = [('roles', 'nvr')]
+        if table == 'builds':
+            child_tables.append(('build_deps', 'srpm_nvr'))
+        else:
+            child_tables.append(('deps', 'rpm_nvra'))
+
+        def delete(key):
+            self.conn.execute('DELETE FROM %s WHERE doc = ? AND %s = ?' % (table, key_column), (name, key))
+            for child_table, child_key_column in child_tables:
+                self.conn.execute('DELETE FROM %s WHERE doc = ? AND %s = ?' % (child_table, child_key_column),
+                                  (name, key))
+
+        for key, record in records.items():
+            digest = _digest(record)
+            if previous_digests.get(key) == digest:
+                continue
+            if key in previous_digests:
+                delete(key)
+            insert_record(key, record, digest)
+        for key in previous_digests:
+            if key not in records:
+                delete(key)
+
+    def _insert_build(self, name, srpm_nvr, build_info, digest):
+        data = dict((k, v) for k, v in build_info.items() if k not in ('build-deps', 'roles'))
+        self.conn.execute('INSERT INTO builds (doc, nvr, name, digest, data) VALUES (?, ?, ?, ?, ?)',
+                          (name, srpm_nvr, build_info.get('name'), digest, json.dumps(data)))
+        if 'build-deps' in build_info:
+            rows = []
+            for direct, deps in ((1, build_info['build-deps'][0]), (0, build_info['build-deps'][1])):
+                rows += [(name, srpm_nvr, direct, position, dep_nvra) for position, dep_nvra in enumerate(deps)]
+            if not rows:
+                # keep track of the fact that there are no build deps
+                rows.append((name, srpm_nvr, 1, 0, None))
+            self.conn.executemany('INSERT INTO build_deps (doc, srpm_nvr, direct, position, dep_nvra) '
+                                  'VALUES (?, ?, ?, ?, ?)', rows)
+        if 'roles' in build_info:
+            self.conn.executemany('INSERT INTO roles (doc, nvr, role, related) VALUES (?, ?, ?, ?)',
+                                  _roles_rows(name, srpm_nvr, build_info['roles']))
+
+    def _insert_rpm(self, name, rpm_nvra, rpm_info, digest):
+        data = dict((k, v) for k, v in rpm_info.items() if k not in ('deps', 'roles'))
+        self.conn.execute('INSERT INTO rpms (doc, nvra, name, srpm_nvr, installable, digest, data) '
+                          'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                          (name, rpm_nvra, rpm_info.get('name'), rpm_info.get('srpm_nvr'),
+                           rpm_info.get('installable'), digest, json.dumps(data)))
+        self.conn.executemany('INSERT INTO deps (doc, rpm_nvra, position, dep_nvra) VALUES (?, ?, ?, ?)',
+                              [(name, rpm_nvra, position, dep_nvra)
+                               for position, dep_nvra in enumerate(rpm_info.get('deps', []))])
+        if 'roles' in rpm_info:
+            self.conn.executemany('INSERT INTO roles (doc, nvr, role, related) VALUES (?, ?, ?, ?)',
+                                  _roles_rows(name, rpm_nvra, rpm_info['roles']))
+
+    def write(self, name, data, cls=None):
+        if name in BUILD_DOCUMENTS:
+            self._write_records(name, 'builds', 'nvr', data,
+                                lambda key, record, digest: self._insert_build(name, key, record, digest))
+        elif name in RPM_DOCUMENTS:
+            self._write_records(name, 'rpms', 'nvra', data,
+                                lambda key, record, digest: self._insert_rpm(name, key, record, digest))
+        else:
+            self.conn.execute('INSERT OR REPLACE INTO documents (doc, data) VALUES (?, ?)',
+                              (name, json.dumps(data, sort_keys=True, cls=cls or JsonSortAndEncode)))
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+def open_workdir(work_dir, use_sqlite=False):
+    if use_sqlite:
+        return SqliteWorkdir(os.path.join(work_dir, SQLITE_FILENAME))
+    return JsonWorkdir(work_dir)